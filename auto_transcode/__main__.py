@@ -0,0 +1,83 @@
+"""Command line of auto-transcode.
+
+Usage:
+    python -m auto_transcode backfill --dry-run
+    python -m auto_transcode backfill --jobs 4
+    python -m auto_transcode backfill --resume
+"""
+
+import argparse
+import sys
+
+from auto_transcode.backfill import Backfill, print_plan, print_summary
+from auto_transcode.settings import Settings
+from auto_transcode.utils.encoder import get_encoder
+from auto_transcode.utils.placement import placement
+
+
+def backfill(args: argparse.Namespace):
+    jobs = args.jobs or Settings.TRANSCODE_WORKERS
+    if jobs < 1:
+        print("--jobs must be at least 1", file=sys.stderr)
+        return 2
+    get_encoder()
+    placement.cleanup()
+    runner = Backfill(jobs)
+    if args.resume:
+        items = runner.load()
+        if not items:
+            print("No backfill plan to resume", file=sys.stderr)
+            return 1
+    else:
+        items = runner.plan(args.min_age, args.samples, args.remux_speed)
+        runner.save(items)
+    print_plan(items, jobs, verbose=args.list)
+    if args.dry_run:
+        return 0
+
+    ran, elapsed = runner.run(items)
+    print_summary(ran, elapsed)
+    return 0 if all(item.state == "done" for item in ran) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m auto_transcode")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_backfill = subparsers.add_parser(
+        "backfill", help="Remux and transcode the files already in the directories at once"
+    )
+    parser_backfill.add_argument(
+        "--dry-run", action="store_true", help="Only print and store the plan"
+    )
+    parser_backfill.add_argument(
+        "--resume", action="store_true", help="Run the files left in the stored plan"
+    )
+    parser_backfill.add_argument(
+        "--jobs", type=int, help="Files processed at once, TRANSCODE_WORKERS by default"
+    )
+    parser_backfill.add_argument(
+        "--min-age",
+        type=float,
+        help="Seconds since the last modification of the files to include, "
+        "DAYS_BEFORE_REMUX and DAYS_BEFORE_TRANSCODE by default",
+    )
+    parser_backfill.add_argument(
+        "--samples",
+        type=int,
+        default=3,
+        help="Files the compression rate and encode speed are sampled on",
+    )
+    parser_backfill.add_argument(
+        "--remux-speed", type=float, default=200, help="Expected remux throughput in MB/s"
+    )
+    parser_backfill.add_argument("--list", action="store_true", help="Print every file of the plan")
+    args = parser.parse_args()
+
+    Settings.init()
+    if args.command == "backfill":
+        return backfill(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
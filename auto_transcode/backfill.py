@@ -0,0 +1,454 @@
+import asyncio
+import json
+import os
+import time
+
+from auto_transcode.modules.remux import RemuxProcess
+from auto_transcode.modules.transcode import TranscodeProcess
+from auto_transcode.settings import Settings
+from auto_transcode.utils.db import get_connection, transaction
+from auto_transcode.utils.encoder import get_encoder
+from auto_transcode.utils.engine import engine
+from auto_transcode.utils.estimate import estimate_compression
+from auto_transcode.utils.failures import JobFailed
+from auto_transcode.utils.fingerprints import FingerprintIndex
+from auto_transcode.utils.fragments import FragmentIndex
+from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.media_info import probe_media
+from auto_transcode.utils.pool import WorkerPool
+from auto_transcode.utils.scan_index import ScanIndex
+
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backfill (
+    position INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    action TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    estimated_size INTEGER NOT NULL,
+    estimated_time REAL,
+    details TEXT NOT NULL,
+    state TEXT NOT NULL,
+    output_size INTEGER,
+    elapsed REAL
+);
+"""
+
+# What is done with each file, in the order of the report. "skip" files are only reported.
+ACTIONS = ["remux", "remux+transcode", "join", "transcode", "resume", "remove", "drop", "skip"]
+# Actions on flv files, run by the remux process
+REMUX_ACTIONS = {"remux", "remux+transcode", "remove", "drop"}
+# Actions that encode the video
+TRANSCODE_ACTIONS = {"remux+transcode", "join", "transcode"}
+
+
+class PlanItem:
+    __slots__ = (
+        "path",
+        "action",
+        "size",
+        "duration",
+        "estimated_size",
+        "estimated_time",
+        "details",
+        "state",
+        "output_size",
+        "elapsed",
+    )
+
+    def __init__(
+        self,
+        path: str,
+        action: str,
+        size: int,
+        duration: float,
+        details: dict | None = None,
+    ):
+        self.path = path
+        self.action = action
+        self.size = size
+        # duration of the video in seconds, 0 if unknown
+        self.duration = duration
+        # size in bytes of the output, and time in seconds of the job, None if unknown
+        self.estimated_size = 0
+        self.estimated_time: float | None = 0.0
+        # e.g. the original of a duplicate or the fragments to join
+        self.details = details or {}
+        # pending, done, failed or postponed
+        self.state = "pending"
+        self.output_size: int | None = None
+        self.elapsed: float | None = None
+
+
+class Backfill:
+    """Onboard an existing archive at once instead of through the watch loops. The due files are
+    planned first, with the action taken on each one and the estimated output size and time, then
+    the plan is run on a worker pool with the callbacks of the remux and transcode processes.
+
+    The plan is stored in CACHE_DIR and the state of each file is saved as soon as its job ends,
+    so that an interrupted backfill resumes with the files left. A file interrupted halfway
+    resumes at the step recorded in the journal, as with the watchers.
+    """
+
+    def __init__(self, jobs: int):
+        self.remux = RemuxProcess()
+        self.transcode = TranscodeProcess()
+        self.remux.prepare()
+        self.transcode.prepare()
+        self.pool = WorkerPool("Backfill", jobs, Settings.JOBS_PER_DEVICE)
+        self.remux.pool = self.pool
+        self.remux.fingerprints = FingerprintIndex()
+        self.jobs = jobs
+
+    def connection(self):
+        return get_connection("backfill", SCHEMA)
+
+    def plan(self, min_age: float | None, samples: int, remux_speed: float):
+        """Plan the due flv files of FLV_DIRS and mp4 files of REMUX_DIR.
+
+        Parameters:
+        - min_age: In seconds. How long the files have not been modified, DAYS_BEFORE_REMUX and
+        DAYS_BEFORE_TRANSCODE by default
+        - samples: Number of files the compression rate and encode speed are sampled on, see
+        `estimate_compression`
+        - remux_speed: In MB/s. Expected throughput of a remux
+
+        Returns:
+            list: The plan items.
+        """
+        flv_delay = Settings.DAYS_BEFORE_REMUX * 86400 if min_age is None else min_age
+        mp4_delay = Settings.DAYS_BEFORE_TRANSCODE * 86400 if min_age is None else min_age
+        items = self.plan_flv(flv_delay) + self.plan_mp4(mp4_delay)
+
+        # Sample the files to transcode evenly, the projection is applied to all of them. The path
+        # of a "join" item is only its first fragment while its duration is the whole broadcast.
+        transcoded = [item for item in items if item.action in TRANSCODE_ACTIONS - {"join"}]
+        compression_rate, realtime_factor = self.sample(
+            transcoded[:: max(1, len(transcoded) // samples)][:samples] if samples else []
+        )
+        # the copy encoder only remuxes
+        copy = get_encoder().codec_name is None
+        for item in items:
+            remux_time = item.size / (remux_speed * 1e6)
+            if item.action == "remux" or (copy and item.action in TRANSCODE_ACTIONS):
+                item.estimated_size = item.size
+                item.estimated_time = remux_time
+            elif item.action in TRANSCODE_ACTIONS:
+                item.estimated_size = int(item.size * compression_rate)
+                item.estimated_time = (
+                    item.duration / realtime_factor if realtime_factor is not None else None
+                )
+                if item.action == "join" and item.estimated_time is not None:
+                    item.estimated_time += remux_time
+        return items
+
+    def plan_flv(self, delay: float):
+        assert self.remux.journal is not None and self.remux.failures is not None
+        items: list[PlanItem] = []
+        due_files: list[tuple[str, str]] = []
+        for flv_dir in Settings.FLV_DIRS:
+            index = ScanIndex(flv_dir, ".flv")
+            index.scan()
+            for flv_path in index.due_files(delay):
+                item = self.plan_source(self.remux, flv_path)
+                if item is not None:
+                    items.append(item)
+                elif os.path.getsize(flv_path) < Settings.MIN_FLV_SIZE:
+                    items.append(PlanItem(flv_path, "remove", os.path.getsize(flv_path), 0.0))
+                else:
+                    due_files.append((flv_path, flv_dir))
+
+        unique, duplicates = self.remux.find_duplicates(due_files)
+        for flv_path, original_path in duplicates:
+            item = PlanItem(flv_path, "drop", os.path.getsize(flv_path), 0.0)
+            item.details["original"] = original_path
+            items.append(item)
+        for flv_path in unique:
+            size = os.path.getsize(flv_path)
+            info = probe_media(flv_path)
+            if info is None:
+                items.append(PlanItem(flv_path, "skip", size, 0.0, {"reason": "invalid"}))
+            elif info.duration < Settings.MIN_FLV_DURATION:
+                items.append(PlanItem(flv_path, "remove", size, info.duration))
+            else:
+                action = "remux+transcode" if self.remux.should_fuse(flv_path) else "remux"
+                items.append(PlanItem(flv_path, action, size, info.duration))
+        return items
+
+    def plan_mp4(self, delay: float):
+        items: list[PlanItem] = []
+        due_files: list[str] = []
+        index = ScanIndex(Settings.REMUX_DIR, ".mp4")
+        index.scan()
+        for source_path in index.due_files(delay):
+            item = self.plan_source(self.transcode, source_path)
+            if item is not None:
+                items.append(item)
+            else:
+                due_files.append(source_path)
+
+        groups, single = self.transcode.find_fragments(due_files)
+        for group in groups:
+            item = PlanItem(
+                group[0].path,
+                "join",
+                sum(os.path.getsize(fragment.path) for fragment in group),
+                max(fragment.end for fragment in group) - group[0].start,
+            )
+            item.details["fragments"] = [fragment.path for fragment in group]
+            items.append(item)
+        for source_path in single:
+            size = os.path.getsize(source_path)
+            info = probe_media(source_path)
+            if info is None:
+                items.append(PlanItem(source_path, "skip", size, 0.0, {"reason": "invalid"}))
+            else:
+                items.append(PlanItem(source_path, "transcode", size, info.duration))
+        return items
+
+    @staticmethod
+    def plan_source(process: RemuxProcess | TranscodeProcess, source_path: str):
+        """Plan the source file if it failed before or if its output was already produced.
+
+        Returns:
+            PlanItem: The item.
+            None: The file has to be probed.
+        """
+        assert process.journal is not None and process.failures is not None
+        size = os.path.getsize(source_path)
+        if process.failures.should_skip(source_path):
+            return PlanItem(source_path, "skip", size, 0.0, {"reason": "failed"})
+        entry = process.journal.get(source_path)
+        if entry is not None and entry.state in ("remuxed", "transcoded", "moved"):
+            return PlanItem(source_path, "resume", size, 0.0)
+
+    def sample(self, items: list[PlanItem]):
+        """Sample the compression rate and the encode speed on the files.
+
+        Returns:
+            tuple: The mean compression rate, 1 if unknown, and the mean ratio of the video duration
+            to the encode time, None if unknown.
+        """
+        backend = get_encoder()
+        rates = []
+        factors = []
+        for item in items:
+            estimate = estimate_compression(item.path, item.duration, backend)
+            if estimate is None:
+                continue
+            logger.info(
+                f"Sampled compression rate {estimate.compression_rate * 100:.0f}% and encode time "
+                f"{estimate.encode_time:.0f} sec for {repr(item.path)}"
+            )
+            rates.append(estimate.compression_rate)
+            if estimate.encode_time:
+                factors.append(item.duration / estimate.encode_time)
+        compression_rate = sum(rates) / len(rates) if rates else 1.0
+        realtime_factor = sum(factors) / len(factors) if factors else None
+        return compression_rate, realtime_factor
+
+    def save(self, items: list[PlanItem]):
+        """Store the plan, replacing the previous one."""
+        conn = self.connection()
+        with transaction(conn):
+            conn.execute("DELETE FROM backfill")
+            conn.executemany(
+                "INSERT INTO backfill (path, action, size, duration, estimated_size, "
+                "estimated_time, details, state) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        item.path,
+                        item.action,
+                        item.size,
+                        item.duration,
+                        item.estimated_size,
+                        item.estimated_time,
+                        json.dumps(item.details),
+                        item.state,
+                    )
+                    for item in items
+                ],
+            )
+
+    def load(self):
+        """Load the stored plan, with the state of each file."""
+        rows = self.connection().execute(
+            "SELECT path, action, size, duration, estimated_size, estimated_time, details, state, "
+            "output_size, elapsed FROM backfill ORDER BY position"
+        )
+        items = []
+        for row in rows:
+            item = PlanItem(*row[:4], json.loads(row[6]))
+            item.estimated_size, item.estimated_time = row[4:6]
+            item.state, item.output_size, item.elapsed = row[7:]
+            items.append(item)
+        return items
+
+    def checkpoint(self, item: PlanItem):
+        self.connection().execute(
+            "UPDATE backfill SET state=?, output_size=?, elapsed=? WHERE path=?",
+            (item.state, item.output_size, item.elapsed, item.path),
+        )
+
+    def run(self, items: list[PlanItem]):
+        """Run the items of the plan that are not done yet, `jobs` at once.
+
+        Returns:
+            tuple: The items run, and the elapsed time in seconds.
+        """
+        start = time.perf_counter()
+        pending = [item for item in items if item.state != "done" and item.action != "skip"]
+        logger.info(f"Backfilling {len(pending)} files with {self.jobs} jobs")
+        for item in pending:
+            self.pool.submit(item.path, self.execute, item, devices=[item.path, Settings.CACHE_DIR])
+        try:
+            while self.pool.pending_count():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            # the interrupted files are postponed, and resumed from the journal by the next run
+            logger.warning("Interrupted, killing the running ffmpeg processes")
+            if engine.loop is not None:
+                asyncio.run_coroutine_threadsafe(engine.stop(), engine.loop).result()
+        finally:
+            self.pool.shutdown()
+        return pending, time.perf_counter() - start
+
+    def execute(self, item: PlanItem):
+        """Run the callback of the process for the file, and checkpoint the result. A file that is
+        still there afterwards was postponed, e.g. for lack of cache space.
+        """
+        start = time.perf_counter()
+        process = self.remux if item.action in REMUX_ACTIONS else self.transcode
+        if item.action == "resume" and item.path.endswith(".flv"):
+            process = self.remux
+        try:
+            if item.action == "drop":
+                self.remux.drop_duplicate(item.path, item.details["original"])
+            elif item.action == "join":
+                self.join(item)
+            else:
+                process.callback(item.path)
+        except Exception:
+            # a job killed by an interrupt is resumed by the next run
+            item.state = "postponed" if engine.closed else "failed"
+            raise
+        else:
+            done = not os.path.exists(item.path) or (
+                item.action == "drop" and Settings.DEDUP_ACTION == "skip"
+            )
+            item.state = "done" if done else "postponed"
+            assert process.journal is not None
+            entry = process.journal.get(item.path)
+            if done and entry is not None and entry.output and os.path.exists(entry.output):
+                item.output_size = os.path.getsize(entry.output)
+        finally:
+            item.elapsed = time.perf_counter() - start
+            self.checkpoint(item)
+
+    def join(self, item: PlanItem):
+        """Join the fragments planned for the item, then transcode the joined file, or each
+        fragment if they could not be joined.
+        """
+        index = FragmentIndex(Settings.FRAGMENT_GAP)
+        group = []
+        for path in item.details["fragments"]:
+            info = probe_media(path) if os.path.exists(path) else None
+            fragment = index.add(path, info) if info is not None else None
+            if fragment is None:
+                raise JobFailed(f"Fragment {repr(path)} of {repr(item.path)} is gone or invalid")
+            group.append(fragment)
+        self.transcode.join(group)
+        if item.path in self.transcode.unjoinable:
+            for fragment in group:
+                self.transcode.callback(fragment.path)
+        elif not any(os.path.exists(fragment.path) for fragment in group[1:]):
+            self.transcode.callback(item.path)
+
+
+def format_size(size: float):
+    if size >= 1e9:
+        return f"{size / 1e9:.1f} GB"
+    return f"{size / 1e6:.1f} MB"
+
+
+def format_time(seconds: float | None):
+    if seconds is None:
+        return "unknown"
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f} h"
+    return f"{seconds / 60:.1f} min"
+
+
+def print_plan(items: list[PlanItem], jobs: int, verbose: bool = False):
+    """Print the files, the actions and the estimated output size and time of the plan."""
+    if verbose:
+        for item in items:
+            print(
+                f"{item.action:<16} {format_size(item.size):>10} -> "
+                f"{format_size(item.estimated_size):>10} {format_time(item.estimated_time):>9}  "
+                f"{item.path}"
+            )
+        print()
+    print(f"{'action':<16} {'files':>7} {'input':>10} {'output':>10} {'time':>9}")
+    for action in ACTIONS:
+        selected = [item for item in items if item.action == action]
+        if selected:
+            print(format_row(action, selected))
+    runnable = [item for item in items if item.action != "skip"]
+    print(format_row("total", runnable))
+    time = total_time(runnable)
+    if time is not None:
+        # the jobs share the ffmpeg processes of the engine
+        wall_time = time / min(jobs, Settings.FFMPEG_PROCESSES)
+        print(f"Estimated wall time with {jobs} jobs: {format_time(wall_time)}")
+
+
+def total_time(items: list[PlanItem]):
+    """The estimated time of the items in seconds, None if the time of any is unknown."""
+    time = 0.0
+    for item in items:
+        if item.estimated_time is None:
+            return
+        time += item.estimated_time
+    return time
+
+
+def format_row(action: str, items: list[PlanItem]):
+    time = total_time(items)
+    return (
+        f"{action:<16} {len(items):>7} {format_size(sum(item.size for item in items)):>10} "
+        f"{format_size(sum(item.estimated_size for item in items)):>10} {format_time(time):>9}"
+    )
+
+
+def print_summary(items: list[PlanItem], elapsed: float):
+    """Print the files done, failed and postponed, and the throughput of the run.
+
+    Parameters:
+    - items: The items run
+    """
+    for state in ("done", "failed", "postponed", "pending"):
+        selected = [item for item in items if item.state == state]
+        if selected:
+            print(f"{state:<10} {len(selected):>7} files")
+    # removed and duplicate files are not processed
+    done = [
+        item
+        for item in items
+        if item.state == "done" and item.action in TRANSCODE_ACTIONS | {"remux", "resume"}
+    ]
+    input_size = sum(item.size for item in done)
+    output_size = sum(item.output_size or 0 for item in done)
+    duration = sum(item.duration for item in done)
+    print(
+        f"Processed {format_size(input_size)} into {format_size(output_size)} in "
+        f"{elapsed:.0f} sec"
+    )
+    if elapsed > 0:
+        print(
+            f"Throughput {input_size / 1e6 / elapsed:.1f} MB/s, "
+            f"{duration / elapsed:.1f}x realtime"
+        )
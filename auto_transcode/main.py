@@ -1,25 +1,47 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
 from auto_transcode.modules.remux import RemuxProcess
 from auto_transcode.modules.transcode import TranscodeProcess
+from auto_transcode.routes import danmaku, failures, jobs, leases, metrics
 from auto_transcode.settings import Settings
+from auto_transcode.utils.admission import admission
+from auto_transcode.utils.encoder import get_encoder
+from auto_transcode.utils.engine import engine
+from auto_transcode.utils.placement import placement
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Detect the encoder once, before any job needs it
+    await asyncio.to_thread(get_encoder)
+    await asyncio.to_thread(placement.cleanup)
+    engine.start(asyncio.get_running_loop())
+    admission.start()
+
     remux_process = RemuxProcess()
     remux_process.start()
     transcode_process = TranscodeProcess()
     transcode_process.start()
+    # remote workers lease their jobs from the transcode process
+    app.state.transcode_process = transcode_process
 
     yield
 
-    # Clean up
-    remux_process.join()
-    transcode_process.join()
+    # Clean up. Resume the paused jobs and kill the running ffmpeg processes first, so that the jobs
+    # finish quickly.
+    await admission.stop()
+    await engine.stop()
+    await asyncio.gather(remux_process.stop(), transcode_process.stop())
 
 
 Settings.init()
 app = FastAPI(lifespan=lifespan)
+app.include_router(jobs.router)
+app.include_router(metrics.router)
+app.include_router(failures.router)
+app.include_router(danmaku.router)
+if Settings.REMOTE_WORKERS:
+    app.include_router(leases.router)
@@ -1,52 +1,83 @@
-import multiprocessing
+import asyncio
 import os
-import signal
 import time
-from typing import Callable, Literal
+from contextlib import contextmanager
+from typing import Any, Callable, Literal
 
 from auto_transcode.settings import Settings
+from auto_transcode.utils import metrics
+from auto_transcode.utils.danmaku import DANMAKU_EXTS, find_danmaku, split_danmaku_ext
+from auto_transcode.utils.danmaku_index import build_index, get_index_path
+from auto_transcode.utils.engine import engine
+from auto_transcode.utils.failures import FailureCache, JobFailed
+from auto_transcode.utils.file import safe_move_and_rename_file
+from auto_transcode.utils.journal import Journal, JournalEntry
 from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.placement import placement
+from auto_transcode.utils.watcher import InotifyWatcher, PollingWatcher, create_watcher
 
 
 logger = get_logger(__name__)
 
 
-class WatcherProcess(multiprocessing.Process):
+class WatcherProcess:
+    """A watch loop run as an asyncio task on the app event loop. Each iteration of `main` runs in
+    a worker thread, and the jobs it starts run on worker pools, with their ffmpeg processes on the
+    ffmpeg engine.
+    """
+
     def __init__(self, process_name: str, wakeup_time: float = Settings.WAKEUP_TIME):
-        super().__init__(name=process_name)
         self.process_name = process_name
         self.wakeup_time = wakeup_time
+        self.task: asyncio.Task | None = None
+        # Created lazily when the process starts
+        self.watchers: dict[tuple[str, str], InotifyWatcher | PollingWatcher] = {}
+        self.journal: Journal | None = None
+        self.failures: FailureCache | None = None
 
-    def run(self):
-        signal.signal(signal.SIGINT, self.__signal_handler)
-        signal.signal(signal.SIGTERM, self.__signal_handler)
-        logger.info(f"{self.process_name} process started")
+    def start(self):
+        self.task = asyncio.create_task(self.run(), name=self.process_name)
 
-        while True:
-            try:
-                self.main()
-                time.sleep(self.wakeup_time)
-            except KeyboardInterrupt:
-                logger.info(f"{self.process_name} process received a keyboard interrupt")
-                break
-            except SystemExit:
-                logger.info(f"{self.process_name} process received a system exit")
-                break
-            except Exception as e:
-                logger.exception(f"{self.process_name} encountered an error: {repr(e)}")
+    async def stop(self):
+        """Stop the watch loop, then wait for the running jobs to finish."""
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
 
-        logger.info(f"{self.process_name} process stopped")
+    async def run(self):
+        logger.info(f"{self.process_name} process started")
+        try:
+            await asyncio.to_thread(self.prepare)
+            while True:
+                iteration = asyncio.create_task(asyncio.to_thread(self.main))
+                try:
+                    await asyncio.shield(iteration)
+                except asyncio.CancelledError:
+                    # A thread cannot be interrupted, let the iteration finish before cleaning up
+                    await asyncio.wait([iteration])
+                    raise
+                except Exception as e:
+                    logger.exception(f"{self.process_name} encountered an error: {repr(e)}")
+                await asyncio.sleep(self.wakeup_time)
+        except asyncio.CancelledError:
+            logger.info(f"{self.process_name} process is stopping")
+        finally:
+            await asyncio.to_thread(self.cleanup)
+            logger.info(f"{self.process_name} process stopped")
 
-    def __signal_handler(self, signum, frame):
-        logger.info(f"Received signal: {signum}")
-        if signum == signal.SIGINT:
-            raise KeyboardInterrupt()
-        elif signum == signal.SIGTERM:
-            raise SystemExit()
+    def prepare(self):
+        """Open the journal and the failure cache, before the first iteration or a backfill."""
+        self.journal = Journal(self.process_name)
+        self.failures = FailureCache(self.process_name)
 
     def main(self):
         raise NotImplementedError()
 
+    def cleanup(self):
+        for watcher in self.watchers.values():
+            watcher.close()
+
     def watch(
         self, dir: str, ext: Literal[".flv", ".mp4"], delay: float, callback: Callable[[str], None]
     ):
@@ -60,15 +91,128 @@ class WatcherProcess(multiprocessing.Process):
         modification time, before the watcher calls the callback function upon the file.
         - callback: The function to call upon the file. Takes one argument, the full file path.
         """
-        for root, _, files in os.walk(dir):
-            for file in files:
-                # filter out files with the wrong extension
-                _, file_ext = os.path.splitext(file)
-                if file_ext != ext:
-                    continue
-
-                # check if the elapsed time since last modification is greater than the delay
-                file_path = os.path.join(root, file)
-                last_modified = os.path.getmtime(file_path)
-                if time.time() - last_modified > delay:
-                    callback(file_path)
+        watcher = self.watchers.get((dir, ext))
+        if watcher is None:
+            watcher = self.watchers[(dir, ext)] = create_watcher(dir, ext)
+
+        start = time.perf_counter()
+        files_due = watcher.due_files(delay)
+        watcher_type = "inotify" if isinstance(watcher, InotifyWatcher) else "polling"
+        metrics.scan_duration.observe(
+            time.perf_counter() - start, process=self.process_name, watcher=watcher_type
+        )
+        metrics.scan_files_visited.inc(
+            watcher.last_visited, process=self.process_name, watcher=watcher_type
+        )
+
+        assert self.failures is not None
+        for file_path in files_due:
+            # Failed files wait for their next attempt without being probed again
+            if self.failures.should_skip(file_path):
+                continue
+            callback(file_path)
+
+    @contextmanager
+    def track_failures(self, source_path: str):
+        """Record a failure of the source file if the `with` block raises, and quarantine the file
+        after MAX_FAILURES consecutive failures. Clear its failures if the block succeeds. Failures
+        caused by the shutdown of the ffmpeg engine are not counted.
+        """
+        assert self.failures is not None and self.journal is not None
+        try:
+            yield
+        except Exception as e:
+            if engine.closed or not os.path.exists(source_path):
+                raise
+            reason = str(e) if isinstance(e, JobFailed) else repr(e)
+            failure = self.failures.record(source_path, reason)
+            if Settings.MAX_FAILURES and failure.count >= Settings.MAX_FAILURES:
+                path = self.failures.quarantine(source_path)
+                self.journal.forget(source_path)
+                logger.error(
+                    f"Quarantined {repr(source_path)} as {repr(path)} after {failure.count} "
+                    f"failures: {reason}"
+                )
+            else:
+                logger.warning(
+                    f"{repr(source_path)} failed {failure.count} times, retrying in "
+                    f"{failure.retry_at - failure.failed_at:.0f} sec"
+                )
+            raise
+        else:
+            self.failures.clear(source_path)
+
+    def resume(self, source_path: str):
+        """Finish the source file from its journal entry if its output was already produced, without
+        probing the files again.
+
+        Returns:
+            bool: True if the source file was finished, False if it has to be processed.
+        """
+        assert self.journal is not None
+        entry = self.journal.get(source_path)
+        if entry is None or entry.state not in ("remuxed", "transcoded", "moved"):
+            return False
+        if not self.journal.verify(entry):
+            logger.info(f"Journaled output of {repr(source_path)} changed, starting over")
+            return False
+        logger.info(f"Resuming {repr(source_path)} from state {repr(entry.state)}")
+        self.finish(source_path, entry)
+        return True
+
+    def finish(
+        self,
+        source_path: str,
+        entry: JournalEntry,
+        validate: Callable[[str], Any] | None = None,
+    ):
+        """Move the output of the journal entry and the xml file to the directory and basename
+        recorded in the entry, then remove the source and its xml file. Each step is journaled.
+
+        Parameters:
+        - validate: Called with the moved output, the source is kept if the result is falsy. Not
+        needed when resuming, since the output checksum was verified instead.
+        """
+        assert self.journal is not None
+        dir, filename = os.path.split(source_path)
+        basename, _ = os.path.splitext(filename)
+        danmaku_from = find_danmaku(dir, basename)
+        danmaku_to = None
+        for ext in DANMAKU_EXTS:
+            danmaku_to = placement.find(f"{basename}{ext}")
+            if danmaku_to is not None:
+                break
+        new_dir = entry.details["dir"]
+        new_basename = entry.details["basename"]
+
+        if entry.state != "moved":
+            assert entry.output is not None
+            if new_basename != basename:
+                logger.info(f"Renaming {repr(basename)} to {repr(new_basename)}")
+            new_path = os.path.join(new_dir, f"{new_basename}.mp4")
+            new_path = safe_move_and_rename_file(entry.output, new_path)
+            entry = self.journal.record(
+                source_path, "moved", new_path, entry.checksum, entry.details
+            )
+        if danmaku_to is not None:
+            _, ext = split_danmaku_ext(danmaku_to)
+            safe_move_and_rename_file(danmaku_to, os.path.join(new_dir, f"{new_basename}{ext}"))
+            try:
+                build_index(new_dir, new_basename)
+            except Exception as e:
+                # the index is rebuilt when it is queried
+                logger.warning(f"Failed to index the danmaku of {repr(new_basename)}: {repr(e)}")
+
+        assert entry.output is not None
+        if validate is not None and not validate(entry.output):
+            self.journal.forget(source_path)
+            raise JobFailed(f"Moved output {repr(entry.output)} of {repr(source_path)} is invalid")
+        os.remove(source_path)
+        if danmaku_from is not None:
+            os.remove(danmaku_from)
+        index_from = get_index_path(dir, basename)
+        if os.path.exists(index_from):
+            os.remove(index_from)
+        self.journal.record(
+            source_path, "source_deleted", entry.output, entry.checksum, entry.details
+        )
@@ -1,16 +1,26 @@
 import os
-import shutil
+import time
+from datetime import timedelta
 
 import ffmpeg
 
 from auto_transcode.modules.base import WatcherProcess
+from auto_transcode.modules.transcode import TranscodeProcess
 from auto_transcode.settings import Settings
-from auto_transcode.utils.file import (
-    get_video_duration,
-    get_video_metadata,
-    safe_move_and_rename_file,
-)
+from auto_transcode.utils import metrics
+from auto_transcode.utils.admission import admission
+from auto_transcode.utils.danmaku import find_danmaku, store_danmaku
+from auto_transcode.utils.encoder import get_encoder
+from auto_transcode.utils.engine import run_ffmpeg
+from auto_transcode.utils.estimate import CompressionAborted, estimate_compression
+from auto_transcode.utils.failures import JobFailed
+from auto_transcode.utils.file import claim_file
+from auto_transcode.utils.fingerprints import Fingerprint, FingerprintIndex
+from auto_transcode.utils.jobs import registry
 from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.media_info import MediaInfo, probe_media
+from auto_transcode.utils.placement import InsufficientSpace, placement
+from auto_transcode.utils.pool import WorkerPool
 
 
 logger = get_logger(__name__)
@@ -19,15 +29,131 @@ logger = get_logger(__name__)
 class RemuxProcess(WatcherProcess):
     def __init__(self):
         super().__init__(process_name="Remux")
+        # Created lazily when the process starts
+        self.pool: WorkerPool | None = None
+        self.fingerprints: FingerprintIndex | None = None
+        # duplicates already reported
+        self.duplicates: set[str] = set()
 
     def main(self):
+        if self.pool is None:
+            self.pool = WorkerPool("Remux", Settings.REMUX_WORKERS, Settings.JOBS_PER_DEVICE)
+            metrics.queue_depth.set_function(self.pool.queue_depth, process=self.process_name)
+            admission.add_recording_source(self.flv_files)
+        if self.fingerprints is None:
+            self.fingerprints = FingerprintIndex()
+        due_files: list[tuple[str, str]] = []
         for flv_dir in Settings.FLV_DIRS:
+            dir_files: list[str] = []
             self.watch(
                 dir=flv_dir,
                 ext=".flv",
                 delay=Settings.DAYS_BEFORE_REMUX * 86400,
-                callback=self.callback,
+                callback=dir_files.append,
             )
+            due_files.extend((flv_path, flv_dir) for flv_path in dir_files)
+        for flv_path in self.deduplicate(due_files):
+            self.submit(flv_path)
+
+    def flv_files(self):
+        """Get the flv files seen by the watchers, including the ones still being recorded."""
+        return [
+            file_path
+            for watcher in list(self.watchers.values())
+            if watcher.ext == ".flv"
+            for file_path in watcher.files()
+        ]
+
+    def deduplicate(self, due_files: list[tuple[str, str]]):
+        """Find the copies of the same broadcast written by redundant recorders into different
+        FLV_DIRS, before any ffmpeg work. The most complete copy, the longest, is kept. The copies
+        it covers within DUPLICATE_TOLERANCE seconds, or that are byte-identical to it, are skipped
+        or deleted depending on DEDUP_ACTION. Copies already processed are still compared against,
+        from the fingerprint index.
+
+        Parameters:
+        - due_files: The due flv files, with the watched directory they were found in
+
+        Returns:
+            list: The flv files to remux.
+        """
+        unique, duplicates = self.find_duplicates(due_files)
+        for flv_path, original_path in duplicates:
+            self.drop_duplicate(flv_path, original_path)
+        return unique
+
+    def find_duplicates(self, due_files: list[tuple[str, str]]):
+        """Split the due flv files into the ones to remux and the duplicates, see `deduplicate`.
+
+        Returns:
+            tuple: The flv files to remux, and the duplicates with the path of their original.
+        """
+        if Settings.DEDUP_ACTION == "off":
+            return [flv_path for flv_path, _ in due_files], []
+        assert self.pool is not None and self.fingerprints is not None
+        unique = []
+        fingerprints: list[Fingerprint] = []
+        for flv_path, flv_dir in due_files:
+            fingerprint = None
+            # queued files are left alone, they may be remuxing already
+            if not self.pool.is_pending(flv_path):
+                fingerprint = self.fingerprints.get(flv_path, flv_dir)
+            if fingerprint is None:
+                unique.append(flv_path)
+            else:
+                fingerprints.append(fingerprint)
+
+        due_paths = {fingerprint.path for fingerprint in fingerprints}
+        seen: dict[str, list[Fingerprint]] = {}
+        kept: list[Fingerprint] = []
+        duplicates: list[tuple[str, str]] = []
+        for fingerprint in sorted(fingerprints, key=lambda f: (f.duration, f.size), reverse=True):
+            if fingerprint.room not in seen:
+                seen[fingerprint.room] = [
+                    other
+                    for other in self.fingerprints.room(fingerprint.room)
+                    if other.path not in due_paths
+                ]
+            original = next(
+                (
+                    other
+                    for other in kept + seen[fingerprint.room]
+                    if other.covers(fingerprint, Settings.DUPLICATE_TOLERANCE)
+                ),
+                None,
+            )
+            if original is None:
+                kept.append(fingerprint)
+                unique.append(fingerprint.path)
+            else:
+                duplicates.append((fingerprint.path, original.path))
+        return unique, duplicates
+
+    def drop_duplicate(self, flv_path: str, original_path: str):
+        assert self.fingerprints is not None
+        if Settings.DEDUP_ACTION == "delete":
+            dir, filename = os.path.split(flv_path)
+            basename, _ = os.path.splitext(filename)
+            danmaku_path = find_danmaku(dir, basename)
+            os.remove(flv_path)
+            if danmaku_path is not None:
+                os.remove(danmaku_path)
+            self.fingerprints.forget(flv_path)
+            logger.info(f"Removed {repr(flv_path)}, a duplicate of {repr(original_path)}")
+        elif flv_path not in self.duplicates:
+            self.duplicates.add(flv_path)
+            logger.info(f"Skipping {repr(flv_path)}, a duplicate of {repr(original_path)}")
+
+    def cleanup(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        super().cleanup()
+
+    def submit(self, flv_path: str):
+        """Queue the flv file to be remuxed by the worker pool."""
+        assert self.pool is not None and self.journal is not None
+        self.journal.discover(flv_path)
+        self.pool.submit(flv_path, self.callback, flv_path, devices=[flv_path, Settings.CACHE_DIR])
 
     def callback(self, flv_path: str):
         """Remux the flv file to mp4. Move the mp4 and xml files to REMUX_DIR. Rename the filenames
@@ -36,91 +162,234 @@ class RemuxProcess(WatcherProcess):
         dir, filename = os.path.split(flv_path)
         basename, ext = os.path.splitext(filename)
         assert ext == ".flv"
+        # Claimed in CACHE_DIR whichever cache directory the mp4 is placed in
         mp4_path = os.path.join(Settings.CACHE_DIR, f"{basename}.mp4")
+        with claim_file(mp4_path) as claimed:
+            if not claimed:
+                logger.info(f"{repr(basename)} is being processed by another worker")
+                return
+            with self.track_failures(flv_path), registry.track("remux", flv_path):
+                self.handle(flv_path, mp4_path)
+
+    def handle(self, flv_path: str, mp4_path: str):
+        assert self.journal is not None
+        dir, filename = os.path.split(flv_path)
+        basename, _ = os.path.splitext(filename)
         xml_from = os.path.join(dir, f"{basename}.xml")
-        xml_to = os.path.join(Settings.CACHE_DIR, f"{basename}.xml")
+
+        # Pick up where a previous run stopped
+        if self.resume(flv_path):
+            return
 
         # Remove small files
         flv_size = os.path.getsize(flv_path)
         if flv_size < Settings.MIN_FLV_SIZE:
-            os.remove(mp4_path)
+            os.remove(flv_path)
             if os.path.exists(xml_from):
                 os.remove(xml_from)
+            self.journal.record(flv_path, "source_deleted")
             logger.info(f"Removed small file ({flv_size} B): {flv_path}")
             return
 
         # Remove short videos
-        duration = get_video_duration(flv_path)
-        if duration is None:
-            logger.error(f"Flv is invalid: {repr(flv_path)}")
-            return
+        registry.set_stage("probing")
+        flv_info = probe_media(flv_path)
+        if flv_info is None:
+            raise JobFailed(f"Flv is invalid: {repr(flv_path)}")
+        duration = flv_info.duration
         if duration < Settings.MIN_FLV_DURATION:
             os.remove(flv_path)
             if os.path.exists(xml_from):
                 os.remove(xml_from)
+            self.journal.record(flv_path, "source_deleted")
             logger.info(f"Removed short video ({duration:.0f} sec): {flv_path}")
             return
 
+        # Remux and transcode in one pass if the flv is already due for transcoding
+        fuse = self.should_fuse(flv_path)
+        # The mp4 is about the size of the flv, and so is the transcoded mp4 at worst. The segments
+        # of a chunked transcode take about as much again
+        size = flv_size
+        if fuse and Settings.CHUNKED_TRANSCODE:
+            size *= 2
+        try:
+            reservation = placement.reserve(f"{basename}.mp4", size)
+        except InsufficientSpace as e:
+            logger.warning(f"Postponed {repr(flv_path)}: {e}")
+            return
+        with reservation:
+            if fuse:
+                self.fuse(flv_path, reservation.path, flv_info)
+            else:
+                self.process(flv_path, reservation.path, flv_info)
+
+    def process(self, flv_path: str, mp4_path: str, flv_info: MediaInfo):
+        """Remux the flv file to mp4 and save it in REMUX_DIR with the xml file."""
+        assert self.journal is not None
+        dir, filename = os.path.split(flv_path)
+        basename, _ = os.path.splitext(filename)
+        danmaku_path = find_danmaku(dir, basename)
+
         # Remux
-        if self.validate_video(mp4_path, flv_path, quiet=True):
+        mp4_info = self.validate_video(mp4_path, flv_info, quiet=True)
+        if mp4_info is not None:
             logger.info(f"File already remuxed: {repr(flv_path)}")
         else:
-            if os.path.exists(xml_from):
-                shutil.copyfile(xml_from, xml_to)
+            if danmaku_path is not None:
+                store_danmaku(danmaku_path, os.path.dirname(mp4_path), basename)
             logger.info(f"Remuxing {repr(flv_path)}")
+            self.journal.record(flv_path, "remuxing")
+            registry.set_stage("remuxing", flv_info.duration)
             self.remux(flv_path, mp4_path)
-            if not self.validate_video(mp4_path, flv_path):
-                logger.error(f"Failed to remux {repr(flv_path)}")
+            registry.set_stage("validating")
+            mp4_info = self.validate_video(mp4_path, flv_info)
+            if mp4_info is None:
                 if os.path.exists(mp4_path):
                     os.remove(mp4_path)
-                return
+                raise JobFailed(f"Failed to remux {repr(flv_path)}")
             logger.info(f"Remuxed {repr(flv_path)}")
 
         # Rename
-        new_basename = self.get_new_basename(basename)
-        logger.info(f"Renaming {repr(basename)} to {repr(new_basename)}")
-        new_mp4_path = os.path.join(Settings.REMUX_DIR, f"{new_basename}.mp4")
-        safe_move_and_rename_file(mp4_path, new_mp4_path)
-        new_xml_path = os.path.join(Settings.REMUX_DIR, f"{new_basename}.xml")
-        safe_move_and_rename_file(xml_to, new_xml_path)
-        if self.validate_video(new_mp4_path, flv_path):
-            os.remove(flv_path)
-            os.remove(xml_from)
+        registry.set_stage("moving")
+        new_basename = self.get_new_basename(basename, mp4_info)
+        entry = self.journal.record(
+            flv_path,
+            "remuxed",
+            mp4_path,
+            details={"dir": Settings.REMUX_DIR, "basename": new_basename},
+        )
+        self.finish(flv_path, entry, validate=lambda path: self.validate_video(path, flv_info))
 
-    def validate_video(self, mp4_path: str, flv_path: str, quiet: bool = False):
-        """Validate the remuxed mp4 file.
+    def should_fuse(self, flv_path: str):
+        """Whether the flv has waited long enough for both remux and transcode, e.g. during a
+        backfill or after downtime.
+        """
+        if not Settings.FUSED_PIPELINE:
+            return False
+        delay = (Settings.DAYS_BEFORE_REMUX + Settings.DAYS_BEFORE_TRANSCODE) * 86400
+        return time.time() - os.path.getmtime(flv_path) > delay
+
+    def fuse(self, flv_path: str, mp4_path: str, flv_info: MediaInfo):
+        """Transcode the flv file straight to the final mp4 and save it in SAVE_DIR with the xml
+        file, skipping the intermediate remuxed mp4 in REMUX_DIR.
+        """
+        assert self.journal is not None
+        dir, filename = os.path.split(flv_path)
+        basename, _ = os.path.splitext(filename)
+        danmaku_path = find_danmaku(dir, basename)
+
+        # Transcode
+        mp4_info = TranscodeProcess.validate_video(mp4_path, flv_info, quiet=True)
+        if mp4_info is not None:
+            logger.info(f"File already transcoded: {repr(flv_path)}")
+        else:
+            if danmaku_path is not None:
+                store_danmaku(danmaku_path, os.path.dirname(mp4_path), basename)
+            backend = get_encoder()
+            estimate = estimate_compression(flv_path, flv_info.duration, backend)
+            if estimate is not None:
+                logger.info(
+                    f"Estimated compression rate {estimate.compression_rate * 100:.0f}% and "
+                    f"encode time {estimate.encode_time:.0f} sec in "
+                    f"{estimate.estimate_time:.0f} sec for {repr(flv_path)}"
+                )
+            if estimate is not None and estimate.compression_rate >= Settings.SKIP_COMPRESSION_RATE:
+                logger.warning(
+                    f"Skipped transcoding {repr(flv_path)}, saved about "
+                    f"{estimate.encode_time - estimate.estimate_time:.0f} sec"
+                )
+                if os.path.exists(mp4_path):
+                    os.remove(mp4_path)
+            else:
+                logger.info(f"Remuxing and transcoding {repr(flv_path)}")
+                self.journal.record(flv_path, "transcoding")
+                registry.set_stage("transcoding", flv_info.duration)
+                try:
+                    TranscodeProcess.transcode(flv_path, mp4_path, backend, flv_info.duration)
+                except CompressionAborted as e:
+                    logger.warning(
+                        f"Stopped transcoding {repr(flv_path)}: {e}, saved about "
+                        f"{e.time_saved:.0f} sec"
+                    )
+                else:
+                    registry.set_stage("validating")
+                    mp4_info = TranscodeProcess.validate_video(mp4_path, flv_info)
+                    if mp4_info is None:
+                        if os.path.exists(mp4_path):
+                            os.remove(mp4_path)
+                        raise JobFailed(f"Failed to transcode {repr(flv_path)}")
+                    logger.info(f"Remuxed and transcoded {repr(flv_path)}")
+
+        # Check compression rate. Save the remuxed flv if compression rate >= 1.0
+        if os.path.exists(mp4_path):
+            compression_rate = os.path.getsize(mp4_path) / os.path.getsize(flv_path)
+            logger.info(f"Compression rate is {compression_rate * 100:.0f}% for {repr(mp4_path)}")
+        else:
+            # skipped after the estimate or stopped by the watchdog
+            compression_rate = 1.0
+        if compression_rate >= 1.0:
+            logger.warning(
+                f"Compression rate {compression_rate * 100:.0f}% is greater than 1. "
+                "Saving the remuxed file instead."
+            )
+            if os.path.exists(mp4_path):
+                os.remove(mp4_path)
+            registry.set_stage("remuxing", flv_info.duration)
+            self.remux(flv_path, mp4_path)
+            mp4_info = self.validate_video(mp4_path, flv_info)
+            if mp4_info is None:
+                if os.path.exists(mp4_path):
+                    os.remove(mp4_path)
+                raise JobFailed(f"Failed to remux {repr(flv_path)}")
+
+        # Rename
+        registry.set_stage("moving")
+        assert mp4_info is not None
+        new_basename = self.get_new_basename(basename, mp4_info)
+        entry = self.journal.record(
+            flv_path,
+            "transcoded",
+            mp4_path,
+            details={"dir": Settings.SAVE_DIR, "basename": new_basename},
+        )
+        self.finish(flv_path, entry, validate=lambda path: self.validate_video(path, flv_info))
+
+    def validate_video(self, mp4_path: str, flv_info: MediaInfo, quiet: bool = False):
+        """Validate the remuxed mp4 file against the media info of the flv file.
 
         Returns:
-            bool: True if the remuxed mp4 is valid, otherwise False
+            MediaInfo: The media info of the mp4 if it is valid.
+            None: The remuxed mp4 is invalid.
         """
 
         def info(msg):
             if not quiet:
                 logger.info(msg)
 
-        flv_duration = get_video_duration(flv_path)
-        assert flv_duration is not None
-
         if os.path.exists(mp4_path):
-            mp4_duration = get_video_duration(mp4_path)
+            mp4_info = probe_media(mp4_path)
         else:
             info(f"File not found: {repr(mp4_path)}")
-            return False
-        if mp4_duration is None:
+            return
+        if mp4_info is None:
             info(f"Failed to probe {repr(mp4_path)}")
-            return False
+            return
 
-        diff = abs(flv_duration - mp4_duration)
+        diff = abs(flv_info.duration - mp4_info.duration)
         if diff > 1:
             info(f"Mp4 duration differ from flv by {diff:.1f} sec: {repr(mp4_path)}")
-            return False
+            return
 
-        return True
+        return mp4_info
 
     def remux(self, flv_path: str, mp4_path: str):
+        start = time.perf_counter()
         try:
-            ffmpeg.input(flv_path).output(mp4_path, c="copy").run(
-                overwrite_output=True, capture_stdout=True, capture_stderr=True
+            run_ffmpeg(
+                ffmpeg.input(flv_path).output(mp4_path, c="copy"), timeout=Settings.REMUX_TIMEOUT
+            )
+            metrics.remux_speed.observe(
+                os.path.getsize(flv_path) / 1e6 / (time.perf_counter() - start)
             )
         except ffmpeg.Error as e:
             logger.error(f"Failed to remux {repr(flv_path)}")
@@ -129,9 +398,7 @@ class RemuxProcess(WatcherProcess):
             if os.path.exists(mp4_path):
                 os.remove(mp4_path)
 
-    def get_new_basename(self, basename: str):
-        mp4_path = os.path.join(Settings.CACHE_DIR, f"{basename}.mp4")
-
+    def get_new_basename(self, basename: str, mp4_info: MediaInfo):
         # parse basename
         if basename.startswith("录制"):
             roomid, date_str, time_str, title = [basename.split("-", 5)[i] for i in [1, 2, 3, 5]]
@@ -139,16 +406,14 @@ class RemuxProcess(WatcherProcess):
             roomid, date_str, time_str, title = basename.split("_", 3)
 
         # correct the time zone
-        metadata = get_video_metadata(mp4_path)
-        assert metadata is not None
-        record_time_str = (
-            metadata["format"]["tags"]["comment"].split("录制时间: ")[1].split("\n")[0]
-        )
+        record_time = mp4_info.record_time
+        assert record_time is not None
         # check that user time zone is Pacific, modify this line if you are in a different time zone
-        assert record_time_str[-6:] in ["-07:00", "-08:00"]
-        date_str = record_time_str[:10].replace("-", "")
-        time_str = record_time_str[11:19].replace(":", "")
+        assert record_time.utcoffset() in [timedelta(hours=-7), timedelta(hours=-8)]
+        date_str = record_time.strftime("%Y%m%d")
+        time_str = record_time.strftime("%H%M%S")
         new_basename = "_".join([roomid, date_str, time_str, title])
-        # TODO: add overlap detection
+        # fragments of the same broadcast are joined before transcoding, see
+        # TranscodeProcess.group_fragments
 
         return new_basename
@@ -1,16 +1,46 @@
 import os
 import shutil
+import threading
+import time
+from contextlib import ExitStack
 
 import ffmpeg
 
 from auto_transcode.modules.base import WatcherProcess
 from auto_transcode.settings import Settings
-from auto_transcode.utils.file import (
-    get_video_codec_name,
-    get_video_duration,
-    safe_move_and_rename_file,
+from auto_transcode.utils import metrics
+from auto_transcode.utils.chunked import chunked_transcode
+from auto_transcode.utils.danmaku import (
+    DANMAKU_EXTS,
+    InvalidDanmaku,
+    find_danmaku,
+    get_danmaku_ext,
+    merge_danmaku,
+    store_danmaku,
 )
+from auto_transcode.utils.danmaku_index import get_index_path
+from auto_transcode.utils.encoder import ENCODERS, EncoderBackend, get_encoder
+from auto_transcode.utils.estimate import (
+    CompressionAborted,
+    encode_with_watchdog,
+    estimate_compression,
+)
+from auto_transcode.utils.failures import JobFailed
+from auto_transcode.utils.file import claim_file, safe_move_and_rename_file
+from auto_transcode.utils.fragments import (
+    Fragment,
+    FragmentIndex,
+    concat_fragments,
+    expected_duration,
+    place_fragments,
+)
+from auto_transcode.utils.jobs import registry
+from auto_transcode.utils.leases import Lease, leases
 from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.media_info import MediaInfo, probe_media
+from auto_transcode.utils.placement import InsufficientSpace, placement
+from auto_transcode.utils.pool import WorkerPool
+from auto_transcode.utils.scheduler import JobScheduler
 
 
 logger = get_logger(__name__)
@@ -19,106 +49,639 @@ logger = get_logger(__name__)
 class TranscodeProcess(WatcherProcess):
     def __init__(self):
         super().__init__(process_name="Transcode")
+        # Created lazily when the process starts
+        self.pool: WorkerPool | None = None
+        self.scheduler: JobScheduler | None = None
+        self.dispatch_lock = threading.Lock()
+        # fragments that failed to be joined, transcoded on their own instead
+        self.unjoinable: set[str] = set()
 
     def main(self):
+        if self.scheduler is None:
+            self.scheduler = JobScheduler(
+                "Transcode", Settings.TRANSCODE_POLICY, Settings.MAX_DAYS_IN_QUEUE * 86400
+            )
+            metrics.queue_depth.set_function(self.scheduler.queue_depth, process=self.process_name)
+        if self.pool is None:
+            self.pool = WorkerPool(
+                "Transcode", Settings.TRANSCODE_WORKERS, Settings.JOBS_PER_DEVICE
+            )
+        due_files: list[str] = []
         self.watch(
             dir=Settings.REMUX_DIR,
             ext=".mp4",
             delay=Settings.DAYS_BEFORE_TRANSCODE * 86400,
-            callback=self.callback,
+            callback=due_files.append,
         )
+        for source_path in self.group_fragments(due_files):
+            self.submit(source_path)
+        self.expire_leases()
+        self.dispatch()
+
+    def cleanup(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        super().cleanup()
+
+    def submit(self, source_path: str):
+        """Queue the mp4 file in the scheduler."""
+        assert self.scheduler is not None and self.journal is not None
+        self.journal.discover(source_path)
+        self.scheduler.push(source_path)
+
+    def group_fragments(self, source_paths: list[str]):
+        """Queue a job joining the fragments of each broadcast split by connection drops, see
+        `join`. The recordings of a room are held back until FRAGMENT_WAIT seconds after the end
+        of their broadcast, when no more fragments are expected.
+
+        Returns:
+            list: The files to transcode on their own.
+        """
+        assert self.pool is not None
+        groups, single = self.find_fragments(source_paths)
+        for group in groups:
+            self.pool.submit(
+                f"join:{group[0].path}",
+                self.join,
+                group,
+                devices=[group[0].path, Settings.CACHE_DIR],
+            )
+        return single
+
+    def find_fragments(self, source_paths: list[str]):
+        """Group the fragments of the broadcasts that are due to be joined, see `group_fragments`.
+
+        Returns:
+            tuple: The groups of fragments to join, and the files to transcode on their own.
+        """
+        if not Settings.MERGE_FRAGMENTS:
+            return [], source_paths
+        index = FragmentIndex(Settings.FRAGMENT_GAP)
+        single = []
+        groups = []
+        for source_path in source_paths:
+            info = None
+            # queued files are left alone, they may be transcoding already
+            queued = self.scheduler is not None and self.scheduler.is_queued(source_path)
+            if not queued and source_path not in self.unjoinable:
+                info = probe_media(source_path)
+            if info is None or index.add(source_path, info) is None:
+                single.append(source_path)
+
+        now = time.time()
+        for group in index.groups():
+            if now < max(fragment.end for fragment in group) + Settings.FRAGMENT_WAIT:
+                continue
+            if len(group) == 1:
+                single.append(group[0].path)
+            else:
+                groups.append(group)
+        return groups, single
+
+    def join(self, group: list[Fragment]):
+        """Join the fragments of a broadcast into the mp4 file of the first one without
+        re-encoding, and their xml files into its xml file on the same timeline. The joined file
+        is transcoded as a whole in a later iteration. If they cannot be joined, the fragments
+        are transcoded on their own.
+        """
+        first_path = group[0].path
+        with ExitStack() as stack:
+            for fragment in group:
+                basename, _ = os.path.splitext(os.path.basename(fragment.path))
+                # Claimed in CACHE_DIR the same as for transcoding
+                claim_path = os.path.join(Settings.CACHE_DIR, f"{basename}.mp4")
+                if not stack.enter_context(claim_file(claim_path)):
+                    logger.info(f"{repr(basename)} is being processed by another worker")
+                    return
+            # another job may have joined some of the fragments already
+            if not all(os.path.exists(fragment.path) for fragment in group):
+                return
+            try:
+                with registry.track("join", first_path):
+                    self.join_fragments(group)
+            except (JobFailed, InvalidDanmaku) as e:
+                self.unjoinable.update(fragment.path for fragment in group)
+                logger.warning(
+                    f"Transcoding the {len(group)} fragments of {repr(first_path)} separately: {e}"
+                )
+
+    def join_fragments(self, group: list[Fragment]):
+        assert self.journal is not None and self.failures is not None
+        dir, filename = os.path.split(group[0].path)
+        basename, _ = os.path.splitext(filename)
+        parts, covered = place_fragments(group)
+
+        size = sum(os.path.getsize(part.fragment.path) for part in parts)
+        try:
+            reservation = placement.reserve(f"{basename}.joined.mp4", size)
+        except InsufficientSpace as e:
+            logger.warning(f"Postponed joining the fragments of {repr(group[0].path)}: {e}")
+            return
+        with reservation:
+            target_path = reservation.path
+            cache_dir = os.path.dirname(target_path)
+            logger.info(f"Joining {len(parts)} fragments into {repr(group[0].path)}")
+            shortest, longest = expected_duration(parts)
+            registry.set_stage("joining", shortest + 1)
+            concat_fragments(parts, target_path)
+            registry.set_stage("validating")
+            target_info = probe_media(target_path) if os.path.exists(target_path) else None
+            if target_info is None or not shortest <= target_info.duration <= longest:
+                if os.path.exists(target_path):
+                    os.remove(target_path)
+                raise JobFailed(f"Failed to join the fragments into {repr(target_path)}")
+
+            danmaku_parts = []
+            for part in parts:
+                fragment_dir, fragment_filename = os.path.split(part.fragment.path)
+                fragment_basename, _ = os.path.splitext(fragment_filename)
+                danmaku_path = find_danmaku(fragment_dir, fragment_basename)
+                if danmaku_path is not None:
+                    danmaku_parts.append((danmaku_path, part.inpoint, part.offset))
+            danmaku_ext = get_danmaku_ext()
+            danmaku_target = os.path.join(cache_dir, f"{basename}.joined{danmaku_ext}")
+            if danmaku_parts:
+                try:
+                    merge_danmaku(danmaku_parts, danmaku_target)
+                except InvalidDanmaku:
+                    os.remove(target_path)
+                    raise
+
+            # Bring the joined files next to the first fragment, then swap them in with two renames
+            registry.set_stage("moving")
+            mtime = max(os.path.getmtime(fragment.path) for fragment in group)
+            staged_path = self.stage_joined(target_path, os.path.join(dir, f"{filename}.joining"))
+            os.utime(staged_path, (mtime, mtime))
+            staged_danmaku = None
+            if danmaku_parts:
+                staged_danmaku = self.stage_joined(
+                    danmaku_target, os.path.join(dir, f"{basename}{danmaku_ext}.joining")
+                )
+        os.replace(staged_path, group[0].path)
+        if staged_danmaku is not None:
+            os.replace(staged_danmaku, os.path.join(dir, f"{basename}{danmaku_ext}"))
+
+        # Remove the other fragments, and the outdated files of the first one
+        for ext in DANMAKU_EXTS:
+            danmaku_path = os.path.join(dir, f"{basename}{ext}")
+            if (ext != danmaku_ext or staged_danmaku is None) and os.path.exists(danmaku_path):
+                os.remove(danmaku_path)
+        for fragment in group:
+            fragment_dir, fragment_filename = os.path.split(fragment.path)
+            fragment_basename, _ = os.path.splitext(fragment_filename)
+            if fragment is not group[0]:
+                os.remove(fragment.path)
+                for ext in DANMAKU_EXTS:
+                    danmaku_path = os.path.join(fragment_dir, f"{fragment_basename}{ext}")
+                    if os.path.exists(danmaku_path):
+                        os.remove(danmaku_path)
+            index_path = get_index_path(fragment_dir, fragment_basename)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            self.journal.forget(fragment.path)
+            self.failures.clear(fragment.path)
+        logger.info(f"Joined {len(parts)} fragments into {repr(group[0].path)}")
+        if covered:
+            logger.info(f"Removed {len(covered)} fragments covered by the others")
+
+    @staticmethod
+    def stage_joined(from_path: str, staged_path: str):
+        """Move a joined file out of the cache directory to `staged_path`, which the watchers
+        ignore, replacing what a failed run left there.
+        """
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+        return safe_move_and_rename_file(from_path, staged_path)
+
+    def dispatch(self):
+        """Start the next jobs from the scheduler while there are idle workers."""
+        assert self.pool is not None and self.scheduler is not None
+        with self.dispatch_lock:
+            # jobs leased to remote workers do not take a local worker
+            while self.scheduler.running_count() - leases.count() < Settings.TRANSCODE_WORKERS:
+                source_path = self.scheduler.pop()
+                if source_path is None:
+                    break
+                if not self.start_local(source_path):
+                    # dispatched again when the job still on the pool finishes
+                    break
+
+    def start_local(self, source_path: str):
+        """Run the job popped from the scheduler on the local worker pool.
+
+        Returns:
+            bool: False if the previous job of the file is still on the pool, in which case the
+                job is put back in the queue.
+        """
+        assert self.pool is not None and self.scheduler is not None
+        if not self.pool.submit(
+            source_path,
+            self.run_job,
+            source_path,
+            devices=[source_path, Settings.CACHE_DIR],
+        ):
+            self.scheduler.requeue(source_path)
+            return False
+        return True
+
+    def run_job(self, source_path: str):
+        assert self.scheduler is not None
+        try:
+            self.callback(source_path)
+        finally:
+            self.scheduler.done(source_path)
+            self.dispatch()
+
+    def lease(self, worker: str):
+        """Hand out the next job from the scheduler to the remote `worker`, see `routes.leases`.
+        The job is held under a lease of LEASE_TIME seconds, renewed by the heartbeats of the
+        worker, and queued again if the lease expires.
+
+        Returns:
+            Lease: The lease.
+            None: No job is waiting.
+        """
+        if self.scheduler is None or self.journal is None:
+            return
+        self.expire_leases()
+        while True:
+            with self.dispatch_lock:
+                source_path = self.scheduler.pop()
+            if source_path is None:
+                return
+            # Outputs left by a previous run are finished locally, without transcoding
+            entry = self.journal.get(source_path)
+            if entry is not None and entry.state in ("transcoded", "moved"):
+                if not self.start_local(source_path):
+                    return
+                continue
+
+            basename, _ = os.path.splitext(os.path.basename(source_path))
+            claim = ExitStack()
+            # Claimed in CACHE_DIR the same as for a local job
+            if not claim.enter_context(
+                claim_file(os.path.join(Settings.CACHE_DIR, f"{basename}.mp4"))
+            ):
+                claim.close()
+                logger.info(f"{repr(basename)} is being processed by another worker")
+                self.scheduler.done(source_path)
+                continue
+            source_info = probe_media(source_path)
+            if source_info is None:
+                claim.close()
+                self.scheduler.done(source_path)
+                self.fail(source_path, f"Mp4 is invalid: {repr(source_path)}")
+                continue
+
+            status = registry.start("transcode", source_path)
+            with registry.attach(status):
+                registry.set_stage(f"transcoding on {worker}", source_info.duration)
+            self.journal.record(source_path, "transcoding")
+            lease = Lease(
+                source_path, worker, source_info.duration, status, claim, Settings.LEASE_TIME
+            )
+            leases.add(lease)
+            logger.info(f"Leased {repr(source_path)} to {repr(worker)}")
+            return lease
+
+    def renew(self, lease_id: str, progress: dict[str, float] | None = None):
+        """Renew the lease on a heartbeat of the worker, with the progress of its encode.
+
+        Returns:
+            Lease: The renewed lease.
+            None: The lease expired, the worker has to stop.
+        """
+        lease = leases.renew(lease_id, Settings.LEASE_TIME)
+        if lease is not None and progress:
+            registry.report(lease.status, progress)
+        return lease
+
+    def complete(
+        self,
+        lease_id: str,
+        target_path: str,
+        backend: EncoderBackend,
+        keep_source: bool = False,
+    ):
+        """Accept the result of a lease and save it in SAVE_DIR like a local job.
+
+        Parameters:
+        - target_path: The transcoded file uploaded by the worker, in a cache directory
+        - backend: The encoder backend the worker transcoded with
+        - keep_source: The worker stopped since the video would not shrink, the source is saved
+        instead, copied to `target_path`
+
+        Returns:
+            bool: True if the result was saved, False if the lease expired.
+
+        Raises:
+            JobFailed: The result is invalid.
+        """
+        assert self.scheduler is not None
+        lease = leases.remove(lease_id)
+        if lease is None:
+            return False
+        source_path = lease.source
+        state = "failed"
+        try:
+            with self.track_failures(source_path), registry.attach(lease.status):
+                self.accept(source_path, target_path, backend, keep_source)
+            state = "done"
+        finally:
+            self.end_lease(lease, state)
+            self.scheduler.done(source_path)
+            self.dispatch()
+        return True
+
+    def accept(
+        self, source_path: str, target_path: str, backend: EncoderBackend, keep_source: bool
+    ):
+        dir, filename = os.path.split(source_path)
+        basename, _ = os.path.splitext(filename)
+        registry.set_stage("validating")
+        source_info = probe_media(source_path)
+        if source_info is None:
+            raise JobFailed(f"Mp4 is invalid: {repr(source_path)}")
+        danmaku_path = find_danmaku(dir, basename)
+        if danmaku_path is not None:
+            store_danmaku(danmaku_path, os.path.dirname(target_path), basename)
+        if keep_source:
+            logger.warning(f"Saving the original file of {repr(source_path)} instead")
+            shutil.copyfile(source_path, target_path)
+            backend = ENCODERS["copy"]
+        elif not self.validate_video(target_path, source_info, backend=backend):
+            os.remove(target_path)
+            raise JobFailed(f"Invalid {backend.name} result uploaded for {repr(source_path)}")
+        else:
+            logger.info(f"Transcoded {repr(source_path)} remotely with {backend.name}")
+        self.save(source_path, target_path, source_info, backend)
+
+    def abandon(self, lease_id: str, reason: str):
+        """End the lease on a failure of the worker, which counts as a failure of the job.
+
+        Returns:
+            bool: False if the lease expired.
+        """
+        assert self.scheduler is not None
+        lease = leases.remove(lease_id)
+        if lease is None:
+            return False
+        self.end_lease(lease, "failed")
+        self.scheduler.done(lease.source)
+        self.fail(lease.source, f"Worker {repr(lease.worker)} failed: {reason}")
+        self.dispatch()
+        return True
+
+    def expire_leases(self):
+        """Queue the jobs of the expired leases again, e.g. of workers that crashed."""
+        if self.scheduler is None:
+            return
+        for lease in leases.expired():
+            logger.warning(
+                f"Lease of {repr(lease.source)} to {repr(lease.worker)} expired, queued again"
+            )
+            self.end_lease(lease, "failed")
+            self.scheduler.requeue(lease.source)
+
+    @staticmethod
+    def end_lease(lease: Lease, state: str):
+        lease.claim.close()
+        registry.finish(lease.status, state)
+
+    def fail(self, source_path: str, reason: str):
+        """Record a failure of a job that did not run under `track_failures`."""
+        try:
+            with self.track_failures(source_path):
+                raise JobFailed(reason)
+        except JobFailed as e:
+            logger.error(f"Transcode job {repr(source_path)} failed: {e}")
 
     def callback(self, source_path: str):
         """Transcode x264 videos to av1. Move the transcoded mp4 and xml files to SAVE_DIR."""
         dir, filename = os.path.split(source_path)
         basename, ext = os.path.splitext(filename)
         assert ext == ".mp4"
+        # Claimed in CACHE_DIR whichever cache directory the target is placed in
         target_path = os.path.join(Settings.CACHE_DIR, f"{basename}.mp4")
-        xml_from = os.path.join(dir, f"{basename}.xml")
-        xml_to = os.path.join(Settings.CACHE_DIR, f"{basename}.xml")
+        with claim_file(target_path) as claimed:
+            if not claimed:
+                logger.info(f"{repr(basename)} is being processed by another worker")
+                return
+            with self.track_failures(source_path), registry.track("transcode", source_path):
+                self.handle(source_path)
+
+    def handle(self, source_path: str):
+        dir, filename = os.path.split(source_path)
+        basename, _ = os.path.splitext(filename)
+
+        # Pick up where a previous run stopped
+        if self.resume(source_path):
+            return
+
+        registry.set_stage("probing")
+        source_info = probe_media(source_path)
+        if source_info is None:
+            raise JobFailed(f"Mp4 is invalid: {repr(source_path)}")
+
+        # The target is at most the size of the source, the segments of a chunked transcode take
+        # about as much again
+        size = os.path.getsize(source_path)
+        if Settings.CHUNKED_TRANSCODE:
+            size *= 2
+        try:
+            reservation = placement.reserve(f"{basename}.mp4", size)
+        except InsufficientSpace as e:
+            logger.warning(f"Postponed {repr(source_path)}: {e}")
+            return
+        with reservation:
+            self.process(source_path, reservation.path, source_info)
+
+    def process(self, source_path: str, target_path: str, source_info: MediaInfo):
+        """Transcode the mp4 file and save it in SAVE_DIR with the xml file."""
+        assert self.journal is not None
+        dir, filename = os.path.split(source_path)
+        basename, _ = os.path.splitext(filename)
+        danmaku_path = find_danmaku(dir, basename)
 
         # Transcode
-        if self.validate_video(target_path, source_path, quiet=True):
+        backend = get_encoder()
+        if self.validate_video(target_path, source_info, quiet=True):
             logger.info(f"File already transcoded: {repr(source_path)}")
         else:
-            if os.path.exists(xml_from):
-                shutil.copyfile(xml_from, xml_to)
-            logger.info(f"Transcodeing {repr(source_path)}")
-            self.transcode(source_path, target_path)
-            if not self.validate_video(target_path, source_path):
-                logger.error(f"Failed to transcode {repr(source_path)}")
-                if os.path.exists(target_path):
-                    os.remove(target_path)
-                return
-            logger.info(f"Transcoded {repr(source_path)}")
+            if danmaku_path is not None:
+                store_danmaku(danmaku_path, os.path.dirname(target_path), basename)
+            duration = source_info.duration
+            estimate = estimate_compression(source_path, duration, backend)
+            if estimate is not None:
+                logger.info(
+                    f"Estimated compression rate {estimate.compression_rate * 100:.0f}% and "
+                    f"encode time {estimate.encode_time:.0f} sec in "
+                    f"{estimate.estimate_time:.0f} sec for {repr(source_path)}"
+                )
+            if estimate is not None and estimate.compression_rate >= Settings.SKIP_COMPRESSION_RATE:
+                logger.warning(
+                    f"Skipped transcoding {repr(source_path)}, saved about "
+                    f"{estimate.encode_time - estimate.estimate_time:.0f} sec. "
+                    "Saving the original file instead."
+                )
+                shutil.copyfile(source_path, target_path)
+                backend = ENCODERS["copy"]
+            else:
+                logger.info(f"Transcodeing {repr(source_path)}")
+                self.journal.record(source_path, "transcoding")
+                registry.set_stage("transcoding", duration)
+                try:
+                    self.transcode(source_path, target_path, backend, duration)
+                except CompressionAborted as e:
+                    logger.warning(
+                        f"Stopped transcoding {repr(source_path)}: {e}, saved about "
+                        f"{e.time_saved:.0f} sec. Saving the original file instead."
+                    )
+                    shutil.copyfile(source_path, target_path)
+                    backend = ENCODERS["copy"]
+                else:
+                    registry.set_stage("validating")
+                    if not self.validate_video(target_path, source_info):
+                        if os.path.exists(target_path):
+                            os.remove(target_path)
+                        raise JobFailed(f"Failed to transcode {repr(source_path)}")
+                    logger.info(f"Transcoded {repr(source_path)}")
+                    if estimate is not None:
+                        actual_rate = os.path.getsize(target_path) / os.path.getsize(source_path)
+                        logger.info(
+                            f"Estimated compression rate {estimate.compression_rate * 100:.0f}%, "
+                            f"actual {actual_rate * 100:.0f}% for {repr(source_path)}"
+                        )
+
+        self.save(source_path, target_path, source_info, backend)
+
+    def save(
+        self,
+        source_path: str,
+        target_path: str,
+        source_info: MediaInfo,
+        backend: EncoderBackend,
+    ):
+        """Save the transcoded mp4 file in SAVE_DIR with the xml file, or the source instead if the
+        transcoded file is not smaller.
+        """
+        assert self.journal is not None
+        basename, _ = os.path.splitext(os.path.basename(source_path))
 
         # Check compression rate. Use the source file if compression rate >= 1.0
         source_size = os.path.getsize(source_path)
         target_size = os.path.getsize(target_path)
         compression_rate = target_size / source_size
         logger.info(f"Compression rate is {compression_rate * 100:.0f}% for {repr(target_path)}")
-        if compression_rate >= 1.0:
+        metrics.compression_ratio.observe(compression_rate, backend=backend.name)
+        if compression_rate >= 1.0 and backend.codec_name is not None:
             logger.warn(
                 f"Compression rate {compression_rate * 100:.0f}% is greater than 1. Saving the original file instead."
             )
             os.remove(target_path)
             shutil.copyfile(source_path, target_path)
+            backend = ENCODERS["copy"]
 
         # Rename
-        new_target_path = os.path.join(Settings.SAVE_DIR, f"{basename}.mp4")
-        safe_move_and_rename_file(target_path, new_target_path)
-        new_xml_path = os.path.join(Settings.SAVE_DIR, f"{basename}.xml")
-        safe_move_and_rename_file(xml_to, new_xml_path)
-        if self.validate_video(new_target_path, source_path):
-            os.remove(source_path)
-            os.remove(xml_from)
+        registry.set_stage("moving")
+        entry = self.journal.record(
+            source_path,
+            "transcoded",
+            target_path,
+            details={"dir": Settings.SAVE_DIR, "basename": basename},
+        )
+        self.finish(
+            source_path,
+            entry,
+            validate=lambda path: self.validate_video(path, source_info, backend=backend),
+        )
 
-    def validate_video(self, target_path: str, source_path: str, quiet: bool = False):
-        """Validate the transcoded mp4 file.
+    @staticmethod
+    def validate_video(
+        target_path: str,
+        source_info: MediaInfo,
+        quiet: bool = False,
+        backend: EncoderBackend | None = None,
+    ):
+        """Validate the transcoded mp4 file against the media info of the source.
+
+        Parameters:
+        - backend: The encoder backend the video was transcoded with. Defaults to the selected one.
 
         Returns:
-            bool: True if the transcoded mp4 is valid, otherwise False
+            MediaInfo: The media info of the transcoded mp4 if it is valid.
+            None: The transcoded mp4 is invalid.
         """
 
         def info(msg):
             if not quiet:
                 logger.info(msg)
 
-        source_duration = get_video_duration(source_path)
-        assert source_duration is not None
+        backend = backend or get_encoder()
 
         if os.path.exists(target_path):
-            target_duration = get_video_duration(target_path)
+            target_info = probe_media(target_path)
         else:
             info(f"File not found: {repr(target_path)}")
-            return False
-        if target_duration is None:
+            return
+        if target_info is None:
             info(f"Failed to probe {repr(target_path)}")
-            return False
+            return
 
-        diff = abs(source_duration - target_duration)
+        diff = abs(source_info.duration - target_info.duration)
         if diff > 1:
             info(
                 f"Transcoded video duration differ from source by {diff:.1f} sec: {repr(target_path)}"
             )
-            return False
+            return
 
-        source_codec = get_video_codec_name(source_path)
-        target_codec = get_video_codec_name(target_path)
-        if source_codec == "av1" or target_codec != "av1":
-            info(f"Invalid codec: source_codec={source_codec}, target_codec={target_codec}")
-            return False
+        source_codec = source_info.video_codec
+        target_codec = target_info.video_codec
+        if backend.codec_name is None:
+            valid = target_codec == source_codec
+        else:
+            valid = source_codec != backend.codec_name and target_codec == backend.codec_name
+        if not valid:
+            info(
+                f"Invalid codec for {backend.name}: "
+                f"source_codec={source_codec}, target_codec={target_codec}"
+            )
+            return
 
-        return True
+        return target_info
 
-    def transcode(self, source_path: str, target_path: str):
-        try:
-            ffmpeg.input(source_path).output(
-                target_path, vcodec="av1_nvenc", cq=Settings.CONSTANT_QUALITY, acodec="copy"
-            ).run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
-        except ffmpeg.Error as e:
-            logger.error(f"Failed to transcode {repr(source_path)}")
-            logger.error("stdout:", e.stdout.decode("utf8"))
-            logger.error("stderr:", e.stderr.decode("utf8"))
-            if os.path.exists(target_path):
-                os.remove(target_path)
+    @staticmethod
+    def transcode(
+        source_path: str,
+        target_path: str,
+        backend: EncoderBackend | None = None,
+        duration: float | None = None,
+    ):
+        """Transcode the video with the encoder backend, the selected one by default.
+
+        Parameters:
+        - duration: The duration of the source, probed if not given.
+
+        Raises:
+            CompressionAborted: The watchdog stopped the encode since the video would not shrink.
+        """
+        backend = backend or get_encoder()
+        if duration is None:
+            source_info = probe_media(source_path)
+            duration = source_info.duration if source_info is not None else 0
+
+        start = time.perf_counter()
+        if Settings.CHUNKED_TRANSCODE and backend.chunkable:
+            chunked_transcode(source_path, target_path, backend)
+        else:
+            try:
+                encode_with_watchdog(source_path, target_path, duration, backend)
+            except ffmpeg.Error as e:
+                logger.error(f"Failed to transcode {repr(source_path)}")
+                logger.error(f"stderr: {e.stderr.decode('utf8', errors='replace')}")
+                if os.path.exists(target_path):
+                    os.remove(target_path)
+        if duration and os.path.exists(target_path):
+            metrics.encode_realtime_factor.observe(
+                duration / (time.perf_counter() - start), backend=backend.name
+            )
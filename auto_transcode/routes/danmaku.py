@@ -0,0 +1,56 @@
+import heapq
+import os
+
+from fastapi import APIRouter, HTTPException, Query
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.danmaku import find_danmaku
+from auto_transcode.utils.danmaku_index import INDEX_EXT, find_peaks, get_index, load_density
+
+
+router = APIRouter(prefix="/danmaku", tags=["danmaku"])
+
+
+def find_recording_dir(recording: str):
+    """Get the directory of the recording, transcoded or only remuxed."""
+    if os.path.basename(recording) == recording and not recording.startswith("."):
+        for dir in (Settings.SAVE_DIR, Settings.REMUX_DIR):
+            if find_danmaku(dir, recording) is not None:
+                return dir
+    raise HTTPException(status_code=404, detail="Recording not found")
+
+
+@router.get("/peaks")
+def get_archive_peaks(k: int = Query(10, ge=1, le=1000), window: int = Query(10, ge=1)):
+    """The `k` busiest windows of `window` seconds across the indexed recordings of SAVE_DIR."""
+    peaks = []
+    with os.scandir(Settings.SAVE_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(INDEX_EXT) or not entry.is_file():
+                continue
+            recording = entry.name[: -len(INDEX_EXT)]
+            # a recording cannot contribute more than k peaks
+            for peak in find_peaks(load_density(entry.path), k, window):
+                peaks.append({"recording": recording, **peak})
+    return heapq.nlargest(k, peaks, key=lambda peak: peak["count"])
+
+
+@router.get("/{recording}")
+def get_danmaku(
+    recording: str,
+    start: float = Query(0, alias="from"),
+    end: float = Query(float("inf"), alias="to"),
+    limit: int = Query(1000, ge=1, le=100000),
+):
+    """The danmaku of the recording from `from` to `to` seconds."""
+    index = get_index(find_recording_dir(recording), recording)
+    assert index is not None
+    return index.range(start, end, limit)
+
+
+@router.get("/{recording}/peaks")
+def get_peaks(recording: str, k: int = Query(10, ge=1, le=1000), window: int = Query(10, ge=1)):
+    """The `k` busiest windows of `window` seconds of the recording."""
+    index = get_index(find_recording_dir(recording), recording)
+    assert index is not None
+    return index.peaks(k, window)
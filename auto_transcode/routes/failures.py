@@ -0,0 +1,18 @@
+from fastapi import APIRouter
+
+from auto_transcode.utils.failures import list_failures
+
+
+router = APIRouter(prefix="/failures", tags=["failures"])
+
+
+@router.get("")
+def get_failures():
+    """The files that failed, waiting for their next attempt or quarantined, most recent first."""
+    return list_failures()
+
+
+@router.get("/quarantine")
+def get_quarantine():
+    """The quarantined files, most recent first."""
+    return list_failures(quarantined=True)
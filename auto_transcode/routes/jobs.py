@@ -0,0 +1,52 @@
+import asyncio
+import json
+import time
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from auto_transcode.utils.jobs import registry
+
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+# Time in seconds between two checks of the registry by the event stream
+STREAM_INTERVAL = 1
+# Time in seconds after which the event stream sends a comment to keep the connection open
+KEEPALIVE_INTERVAL = 15
+
+
+@router.get("")
+def list_jobs():
+    """The running jobs, then the recently finished jobs, most recent first."""
+    return registry.snapshot()
+
+
+@router.get("/stream")
+async def stream_jobs(request: Request):
+    """Server-sent events with the list of jobs, sent whenever a job changes."""
+
+    async def events():
+        version = None
+        last_sent = 0.0
+        while not await request.is_disconnected():
+            if registry.version != version:
+                version = registry.version
+                last_sent = time.monotonic()
+                yield f"data: {json.dumps(registry.snapshot())}\n\n"
+            elif time.monotonic() - last_sent > KEEPALIVE_INTERVAL:
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
+            await asyncio.sleep(STREAM_INTERVAL)
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@router.get("/{job_id}")
+def get_job(job_id: int):
+    job = registry.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
@@ -0,0 +1,198 @@
+import asyncio
+import os
+import re
+import secrets
+
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.requests import ClientDisconnect
+
+from auto_transcode.modules.transcode import TranscodeProcess
+from auto_transcode.settings import Settings
+from auto_transcode.utils.encoder import ENCODERS, EncoderBackend
+from auto_transcode.utils.failures import JobFailed
+from auto_transcode.utils.leases import leases
+from auto_transcode.utils.placement import InsufficientSpace, placement
+
+
+# Size in bytes of the chunks of the source sent to the workers
+CHUNK_SIZE = 1024 * 1024
+
+
+def check_token(authorization: str | None = Header(None)):
+    # compared as bytes, which unlike str may hold any character of the header
+    if Settings.WORKER_TOKEN and not secrets.compare_digest(
+        (authorization or "").encode(), f"Bearer {Settings.WORKER_TOKEN}".encode()
+    ):
+        raise HTTPException(status_code=401, detail="Invalid worker token")
+
+
+router = APIRouter(prefix="/leases", tags=["leases"], dependencies=[Depends(check_token)])
+
+
+def get_process(request: Request) -> TranscodeProcess:
+    return request.app.state.transcode_process
+
+
+def get_lease(lease_id: str):
+    lease = leases.get(lease_id)
+    if lease is None:
+        raise HTTPException(status_code=410, detail="Lease expired")
+    return lease
+
+
+@router.get("")
+def list_leases():
+    """The jobs held by remote workers."""
+    return leases.snapshot()
+
+
+@router.post("")
+def create_lease(request: Request, worker: str):
+    """Lease the next transcode job to the worker. No content if no job is waiting."""
+    lease = get_process(request).lease(worker)
+    if lease is None:
+        return Response(status_code=204)
+    return {
+        **lease.to_dict(),
+        # for workers reading the source from a shared mount of REMUX_DIR
+        "name": os.path.relpath(lease.source, Settings.REMUX_DIR),
+        "size": os.path.getsize(lease.source),
+        "lease_time": Settings.LEASE_TIME,
+    }
+
+
+@router.post("/{lease_id}/heartbeat")
+def renew_lease(request: Request, lease_id: str, progress: dict[str, float] | None = Body(None)):
+    """Renew the lease, with the progress of the encode. Gone if the lease expired, in which case
+    the worker has to stop.
+    """
+    lease = get_process(request).renew(lease_id, progress)
+    if lease is None:
+        raise HTTPException(status_code=410, detail="Lease expired")
+    return lease.to_dict()
+
+
+@router.get("/{lease_id}/source")
+def get_source(lease_id: str, range: str | None = Header(None)):
+    """Download the source of the lease. A single byte range may be requested, so that an
+    interrupted download is resumed.
+    """
+    lease = get_lease(lease_id)
+    size = os.path.getsize(lease.source)
+    start, end = 0, size - 1
+    headers = {"Accept-Ranges": "bytes"}
+    status_code = 200
+    if range is not None:
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", range.strip())
+        if match is None or not (match[1] or match[2]):
+            raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        if match[1]:
+            start = int(match[1])
+            end = min(int(match[2]), size - 1) if match[2] else size - 1
+        else:
+            # the last bytes of the file
+            start = max(0, size - int(match[2]))
+        if start > end:
+            raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        status_code = 206
+    headers["Content-Length"] = str(end - start + 1)
+
+    def content():
+        with open(lease.source, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    return StreamingResponse(
+        content(), status_code=status_code, headers=headers, media_type="video/mp4"
+    )
+
+
+@router.put("/{lease_id}/result")
+async def put_result(request: Request, lease_id: str, encoder: str):
+    """Upload the transcoded video of the lease. It is validated against the source like a local
+    transcode before the job is done.
+    """
+    lease = get_lease(lease_id)
+    backend = ENCODERS.get(encoder)
+    if backend is None:
+        raise HTTPException(status_code=422, detail=f"Unknown encoder {repr(encoder)}")
+    size = int(request.headers.get("content-length") or 0)
+
+    async def write(target_path: str):
+        try:
+            with open(target_path, "wb") as f:
+                async for chunk in request.stream():
+                    await asyncio.to_thread(f.write, chunk)
+        except (ClientDisconnect, OSError):
+            os.remove(target_path)
+            raise HTTPException(status_code=400, detail="Upload interrupted")
+
+    return await save_result(request, lease.source, lease_id, size, backend, write)
+
+
+@router.post("/{lease_id}/skip")
+async def skip_transcode(request: Request, lease_id: str):
+    """The worker stopped since the video would not shrink, the source is saved instead."""
+    lease = get_lease(lease_id)
+
+    async def write(target_path: str):
+        pass
+
+    size = os.path.getsize(lease.source)
+    return await save_result(
+        request, lease.source, lease_id, size, ENCODERS["copy"], write, keep_source=True
+    )
+
+
+@router.delete("/{lease_id}")
+def abandon_lease(request: Request, lease_id: str, reason: str = ""):
+    """The worker failed, which counts as a failure of the job."""
+    if not get_process(request).abandon(lease_id, reason):
+        raise HTTPException(status_code=410, detail="Lease expired")
+    return {}
+
+
+async def save_result(
+    request: Request,
+    source_path: str,
+    lease_id: str,
+    size: int,
+    backend: EncoderBackend,
+    write,
+    keep_source: bool = False,
+):
+    """Reserve the space of the result in a cache directory, write it with `write` and complete
+    the lease. The result is removed if it is not saved.
+    """
+    basename, _ = os.path.splitext(os.path.basename(source_path))
+    try:
+        reservation = await asyncio.to_thread(placement.reserve, f"{basename}.mp4", size)
+    except InsufficientSpace as e:
+        raise HTTPException(status_code=507, detail=str(e))
+    with reservation:
+        await write(reservation.path)
+        saved = False
+        try:
+            saved = await asyncio.to_thread(
+                get_process(request).complete,
+                lease_id,
+                reservation.path,
+                backend,
+                keep_source=keep_source,
+            )
+        except JobFailed as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        finally:
+            if not saved and os.path.exists(reservation.path):
+                os.remove(reservation.path)
+    if not saved:
+        raise HTTPException(status_code=410, detail="Lease expired")
+    return {}
@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from auto_transcode.utils import metrics
+
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
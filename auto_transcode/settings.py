@@ -1,5 +1,6 @@
 import os
 import sys
+from functools import partial
 
 from dotenv import load_dotenv
 
@@ -15,16 +16,68 @@ class Settings:
     FLV_DIRS: list[str] = ["test/flv"]
     REMUX_DIR: str = "test/remux"
     SAVE_DIR: str = "test/save"
+    CACHE_DIRS: list[str] = ["test/cache"]
+    # The first of CACHE_DIRS, which also holds the databases
     CACHE_DIR: str = "test/cache"
     MIN_FLV_SIZE: int = 1000
     MIN_FLV_DURATION: float = 30
     DAYS_BEFORE_REMUX: float = 0
     DAYS_BEFORE_TRANSCODE: float = 0
-    CONSTANT_QUALITY: int = 51
     WAKEUP_TIME: float = 60
+    PROBE_CACHE_SIZE: int = 10000
+    NATIVE_PROBE: bool = True
+    WATCHER_BACKEND: str = "auto"
+    REMUX_WORKERS: int = 2
+    JOBS_PER_DEVICE: int = 2
+    TRANSCODE_WORKERS: int = 1
+    TRANSCODE_POLICY: str = "oldest"
+    MAX_DAYS_IN_QUEUE: float = 3
+    FFMPEG_PROCESSES: int = 8
+    REMUX_TIMEOUT: float = 3600
+    TRANSCODE_TIMEOUT: float = 86400
+    REMOTE_WORKERS: bool = False
+    LEASE_TIME: float = 300
+    WORKER_TOKEN: str = ""
+    ADMISSION_CONTROL: bool = True
+    ADMISSION_INTERVAL: int = 5
+    RECORDING_ACTIVE_TIME: int = 60
+    PAUSE_LOAD: float = 1.5
+    PAUSE_DISK_BUSY: float = 90
+    PAUSE_DISK_MBPS: float = 0
+    FAILURE_BACKOFF: float = 600
+    MAX_FAILURES: int = 5
+    QUARANTINE_DIR: str = ""
+    DANMAKU_COMPRESSION: str = "gzip"
+    DEDUP_ACTION: str = "skip"
+    DUPLICATE_TOLERANCE: float = 10
+    FUSED_PIPELINE: bool = True
+    MERGE_FRAGMENTS: bool = True
+    FRAGMENT_GAP: float = 60
+    FRAGMENT_WAIT: float = 1800
+    CHUNKED_TRANSCODE: bool = False
+    CHUNK_DURATION: float = 300
+    CHUNK_WORKERS: int = 4
+    ENCODER: str = "auto"
+    ENCODER_THREADS: int = 0
+    NVENC_CQ: int = 51
+    NVENC_PRESET: str = "p4"
+    SVTAV1_CRF: int = 35
+    SVTAV1_PRESET: int = 8
+    AOM_CRF: int = 35
+    AOM_CPU_USED: int = 6
+    ESTIMATE_SAMPLES: int = 3
+    ESTIMATE_SAMPLE_DURATION: float = 10
+    SKIP_COMPRESSION_RATE: float = 0.95
+    ABORT_COMPRESSION_RATE: float = 1.0
+    WATCHDOG_MIN_PROGRESS: float = 0.05
 
     @classmethod
-    def init(cls):
+    def init(cls, names: list[str] | None = None):
+        """Load the settings from the environment variables.
+
+        Parameters:
+        - names: Only load these settings, e.g. the encoder settings on a remote worker
+        """
         # Skip initialization if running in development mode
         USE_DEV_SETTINGS = cls.load_bool("USE_DEV_SETTINGS", "false")
         if USE_DEV_SETTINGS:
@@ -37,15 +90,91 @@ class Settings:
             ("FLV_DIRS", cls.load_dirs, None),
             ("REMUX_DIR", cls.load_dir, None),
             ("SAVE_DIR", cls.load_dir, None),
-            ("CACHE_DIR", cls.load_dir, None),
+            # CACHE_DIR is the single cache directory of older configurations
+            ("CACHE_DIRS", cls.load_dirs, os.getenv("CACHE_DIR")),
             ("MIN_FLV_SIZE", cls.load_non_negative_int, None),
             ("MIN_FLV_DURATION", cls.load_non_negative_float, None),
             ("DAYS_BEFORE_REMUX", cls.load_non_negative_float, None),
             ("DAYS_BEFORE_TRANSCODE", cls.load_non_negative_float, None),
-            ("CONSTANT_QUALITY", cls.load_int, cls.CONSTANT_QUALITY),
             ("WAKEUP_TIME", cls.load_non_negative_float, cls.WAKEUP_TIME),
+            ("PROBE_CACHE_SIZE", cls.load_non_negative_int, cls.PROBE_CACHE_SIZE),
+            ("NATIVE_PROBE", cls.load_bool, str(cls.NATIVE_PROBE)),
+            (
+                "WATCHER_BACKEND",
+                partial(cls.load_choice, choices=["auto", "inotify", "polling"]),
+                cls.WATCHER_BACKEND,
+            ),
+            ("REMUX_WORKERS", cls.load_positive_int, cls.REMUX_WORKERS),
+            ("JOBS_PER_DEVICE", cls.load_positive_int, cls.JOBS_PER_DEVICE),
+            ("TRANSCODE_WORKERS", cls.load_positive_int, cls.TRANSCODE_WORKERS),
+            (
+                "TRANSCODE_POLICY",
+                partial(cls.load_choice, choices=["oldest", "smallest", "fair", "savings"]),
+                cls.TRANSCODE_POLICY,
+            ),
+            ("MAX_DAYS_IN_QUEUE", cls.load_non_negative_float, cls.MAX_DAYS_IN_QUEUE),
+            ("FFMPEG_PROCESSES", cls.load_positive_int, cls.FFMPEG_PROCESSES),
+            ("REMUX_TIMEOUT", cls.load_non_negative_float, cls.REMUX_TIMEOUT),
+            ("TRANSCODE_TIMEOUT", cls.load_non_negative_float, cls.TRANSCODE_TIMEOUT),
+            ("REMOTE_WORKERS", cls.load_bool, str(cls.REMOTE_WORKERS)),
+            ("LEASE_TIME", cls.load_non_negative_float, cls.LEASE_TIME),
+            ("WORKER_TOKEN", cls.load_str, cls.WORKER_TOKEN),
+            ("ADMISSION_CONTROL", cls.load_bool, str(cls.ADMISSION_CONTROL)),
+            ("ADMISSION_INTERVAL", cls.load_positive_int, cls.ADMISSION_INTERVAL),
+            ("RECORDING_ACTIVE_TIME", cls.load_positive_int, cls.RECORDING_ACTIVE_TIME),
+            ("PAUSE_LOAD", cls.load_non_negative_float, cls.PAUSE_LOAD),
+            ("PAUSE_DISK_BUSY", cls.load_non_negative_float, cls.PAUSE_DISK_BUSY),
+            ("PAUSE_DISK_MBPS", cls.load_non_negative_float, cls.PAUSE_DISK_MBPS),
+            ("FAILURE_BACKOFF", cls.load_non_negative_float, cls.FAILURE_BACKOFF),
+            ("MAX_FAILURES", cls.load_non_negative_int, cls.MAX_FAILURES),
+            ("QUARANTINE_DIR", cls.load_optional_dir, cls.QUARANTINE_DIR),
+            (
+                "DANMAKU_COMPRESSION",
+                partial(cls.load_choice, choices=["gzip", "zstd", "none"]),
+                cls.DANMAKU_COMPRESSION,
+            ),
+            (
+                "DEDUP_ACTION",
+                partial(cls.load_choice, choices=["off", "skip", "delete"]),
+                cls.DEDUP_ACTION,
+            ),
+            ("DUPLICATE_TOLERANCE", cls.load_non_negative_float, cls.DUPLICATE_TOLERANCE),
+            ("FUSED_PIPELINE", cls.load_bool, str(cls.FUSED_PIPELINE)),
+            ("MERGE_FRAGMENTS", cls.load_bool, str(cls.MERGE_FRAGMENTS)),
+            ("FRAGMENT_GAP", cls.load_non_negative_float, cls.FRAGMENT_GAP),
+            ("FRAGMENT_WAIT", cls.load_non_negative_float, cls.FRAGMENT_WAIT),
+            ("CHUNKED_TRANSCODE", cls.load_bool, str(cls.CHUNKED_TRANSCODE)),
+            ("CHUNK_DURATION", cls.load_positive_float, cls.CHUNK_DURATION),
+            ("CHUNK_WORKERS", cls.load_positive_int, cls.CHUNK_WORKERS),
+            (
+                "ENCODER",
+                partial(
+                    cls.load_choice,
+                    choices=["auto", "av1_nvenc", "libsvtav1", "libaom-av1", "copy"],
+                ),
+                cls.ENCODER,
+            ),
+            ("ENCODER_THREADS", cls.load_non_negative_int, cls.ENCODER_THREADS),
+            ("NVENC_CQ", cls.load_int, cls.NVENC_CQ),
+            ("NVENC_PRESET", cls.load_str, cls.NVENC_PRESET),
+            ("SVTAV1_CRF", cls.load_non_negative_int, cls.SVTAV1_CRF),
+            ("SVTAV1_PRESET", cls.load_int, cls.SVTAV1_PRESET),
+            ("AOM_CRF", cls.load_non_negative_int, cls.AOM_CRF),
+            ("AOM_CPU_USED", cls.load_non_negative_int, cls.AOM_CPU_USED),
+            ("ESTIMATE_SAMPLES", cls.load_non_negative_int, cls.ESTIMATE_SAMPLES),
+            (
+                "ESTIMATE_SAMPLE_DURATION",
+                cls.load_non_negative_float,
+                cls.ESTIMATE_SAMPLE_DURATION,
+            ),
+            ("SKIP_COMPRESSION_RATE", cls.load_non_negative_float, cls.SKIP_COMPRESSION_RATE),
+            ("ABORT_COMPRESSION_RATE", cls.load_non_negative_float, cls.ABORT_COMPRESSION_RATE),
+            ("WATCHDOG_MIN_PROGRESS", cls.load_non_negative_float, cls.WATCHDOG_MIN_PROGRESS),
         ]
 
+        if names is not None:
+            loaders = [loader for loader in loaders if loader[0] in names]
+
         check_passed = True
         for name, loader, default in loaders:
             value = loader(name, default)
@@ -56,6 +185,7 @@ class Settings:
         if not check_passed:
             logger.critical("Environment variable check failed")
             sys.exit(1)
+        cls.CACHE_DIR = cls.CACHE_DIRS[0]
 
         cls.print_settings()
         logger.info("Successfully loaded environment variables")
@@ -81,6 +211,13 @@ class Settings:
             return
         return value
 
+    @classmethod
+    def load_optional_dir(cls, var_name: str, default: str | None = None):
+        value = cls.load_str(var_name, default)
+        if not value:
+            return value
+        return cls.load_dir(var_name, value)
+
     @classmethod
     def load_dirs(cls, var_name: str, default: str | None = None):
         value = cls.load_str(var_name, default)
@@ -105,6 +242,16 @@ class Settings:
         logger.critical(f"{var_name}={value} is not a boolean")
         return
 
+    @classmethod
+    def load_choice(cls, var_name: str, default: str | None = None, choices: list[str] = []):
+        value = cls.load_str(var_name, default)
+        if value is None:
+            return
+        if value.lower() not in choices:
+            logger.critical(f"{var_name}={value} must be one of {choices}")
+            return
+        return value.lower()
+
     @classmethod
     def load_float(cls, var_name: str, default: str | None = None):
         value = cls.load_str(var_name, default)
@@ -151,6 +298,26 @@ class Settings:
             return
         return value
 
+    @classmethod
+    def load_positive_float(cls, var_name: str, default: str | None = None):
+        value = cls.load_float(var_name, default)
+        if value is None:
+            return
+        if value <= 0:
+            logger.critical(f"{var_name}={value} must be greater than 0")
+            return
+        return value
+
+    @classmethod
+    def load_positive_int(cls, var_name: str, default: str | None = None):
+        value = cls.load_int(var_name, default)
+        if value is None:
+            return
+        if value <= 0:
+            logger.critical(f"{var_name}={value} must be greater than 0")
+            return
+        return value
+
     @classmethod
     def print_settings(cls):
         for key, value in cls.__dict__.items():
@@ -0,0 +1,280 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import platform
+import signal
+import threading
+import time
+from typing import Callable, Iterable
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils import metrics
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+RUN = "run"
+THROTTLE = "throttle"
+PAUSE = "pause"
+STATES = (RUN, THROTTLE, PAUSE)
+
+# Niceness of the ffmpeg processes while throttled
+THROTTLE_NICE = 19
+# Paused jobs resume once the readings fall below this fraction of the pause thresholds
+RESUME_RATIO = 0.8
+# Minimum time in seconds spent paused, so that pausing the jobs, which lowers the load, does not
+# resume them right away
+MIN_PAUSE_TIME = 60
+SECTOR_SIZE = 512
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_IDLE = 3
+# ioprio_set has no libc wrapper
+SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314}
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        _libc = ctypes.CDLL(libc_name, use_errno=True)
+    return _libc
+
+
+class Reading:
+    """Load of the host at one point in time."""
+
+    __slots__ = ("load_per_cpu", "disk_busy", "disk_mbps", "recording")
+
+    def __init__(self, load_per_cpu: float, disk_busy: float, disk_mbps: float, recording: bool):
+        self.load_per_cpu = load_per_cpu
+        # busiest device of the flv directories, in percent of the time spent doing I/O
+        self.disk_busy = disk_busy
+        # highest read and write throughput of the devices of the flv directories
+        self.disk_mbps = disk_mbps
+        # whether a flv file is still being written
+        self.recording = recording
+
+    def __repr__(self):
+        return (
+            f"load {self.load_per_cpu:.2f}/cpu, disk {self.disk_busy:.0f}% busy "
+            f"{self.disk_mbps:.1f} MB/s, recording {self.recording}"
+        )
+
+
+class AdmissionController:
+    """Protect the live recordings from the remux and transcode jobs.
+
+    While no flv file is growing the jobs run freely. While something is recording, the ffmpeg
+    processes are throttled with the lowest CPU and I/O priorities, and when the load average or
+    the disk of the flv directories is past the PAUSE_* thresholds, the processes are stopped with
+    SIGSTOP and no new job or copy starts until the load goes down.
+
+    The readings are taken every ADMISSION_INTERVAL seconds by an asyncio task. The ffmpeg engine
+    registers its processes, and the worker threads call `wait` at safe points.
+    """
+
+    def __init__(self):
+        self.state = RUN
+        self.paused_at = 0.0
+        self.lock = threading.Lock()
+        self.pids: set[int] = set()
+        # set unless paused
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.recording_sources: list[Callable[[], Iterable[str]]] = []
+        self.last_disk_stats: dict[tuple[int, int], tuple[float, int, int]] = {}
+        self.reading: Reading | None = None
+        self.task: asyncio.Task | None = None
+        metrics.admission_state.set_function(self.state_value)
+
+    def start(self):
+        if not Settings.ADMISSION_CONTROL:
+            return
+        self.task = asyncio.create_task(self.run(), name="AdmissionController")
+
+    async def stop(self):
+        """Stop taking readings and let every job run, so that they can be stopped."""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.set_state(RUN)
+
+    async def run(self):
+        while True:
+            try:
+                reading = await asyncio.to_thread(self.read)
+                self.set_state(self.decide(reading))
+            except Exception as e:
+                logger.exception(f"Admission control encountered an error: {repr(e)}")
+            await asyncio.sleep(Settings.ADMISSION_INTERVAL)
+
+    def add_recording_source(self, source: Callable[[], Iterable[str]]):
+        """Register a function returning flv files that may be recording, e.g. the candidates of a
+        watcher.
+        """
+        with self.lock:
+            self.recording_sources.append(source)
+
+    def read(self):
+        reading = Reading(
+            load_per_cpu=os.getloadavg()[0] / (os.cpu_count() or 1),
+            disk_busy=0.0,
+            disk_mbps=0.0,
+            recording=self.is_recording(),
+        )
+        reading.disk_busy, reading.disk_mbps = self.read_disks(Settings.FLV_DIRS)
+        self.reading = reading
+        return reading
+
+    def is_recording(self):
+        deadline = time.time() - Settings.RECORDING_ACTIVE_TIME
+        with self.lock:
+            sources = list(self.recording_sources)
+        for source in sources:
+            for file_path in source():
+                try:
+                    if os.path.getmtime(file_path) > deadline:
+                        return True
+                except FileNotFoundError:
+                    continue
+        return False
+
+    def read_disks(self, dirs: list[str]):
+        """Get the busy percent and the throughput of the busiest device of `dirs` since the last
+        call, from /proc/diskstats.
+
+        Returns:
+            tuple: The busy percent and the throughput in MB/s, 0 if unknown.
+        """
+        devices = set()
+        for dir in dirs:
+            try:
+                st_dev = os.stat(dir).st_dev
+            except FileNotFoundError:
+                continue
+            devices.add((os.major(st_dev), os.minor(st_dev)))
+        try:
+            with open("/proc/diskstats") as f:
+                lines = f.readlines()
+        except OSError:
+            return 0.0, 0.0
+
+        now = time.monotonic()
+        busy = mbps = 0.0
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 13:
+                continue
+            device = (int(fields[0]), int(fields[1]))
+            if device not in devices:
+                continue
+            # sectors read, sectors written, milliseconds spent doing I/O
+            sectors = int(fields[5]) + int(fields[9])
+            io_ticks = int(fields[12])
+            last = self.last_disk_stats.get(device)
+            self.last_disk_stats[device] = (now, sectors, io_ticks)
+            if last is None or now <= last[0]:
+                continue
+            elapsed = now - last[0]
+            busy = max(busy, min(100.0, (io_ticks - last[2]) / 10 / elapsed))
+            mbps = max(mbps, (sectors - last[1]) * SECTOR_SIZE / 1e6 / elapsed)
+        return busy, mbps
+
+    def decide(self, reading: Reading):
+        if not reading.recording:
+            return RUN
+        # harder to leave the pause than to enter it
+        ratio = RESUME_RATIO if self.state == PAUSE else 1.0
+        overloaded = any(
+            threshold and value >= threshold * ratio
+            for value, threshold in (
+                (reading.load_per_cpu, Settings.PAUSE_LOAD),
+                (reading.disk_busy, Settings.PAUSE_DISK_BUSY),
+                (reading.disk_mbps, Settings.PAUSE_DISK_MBPS),
+            )
+        )
+        if overloaded:
+            return PAUSE
+        if self.state == PAUSE and time.monotonic() - self.paused_at < MIN_PAUSE_TIME:
+            return PAUSE
+        return THROTTLE
+
+    def set_state(self, state: str):
+        with self.lock:
+            if state == self.state:
+                return
+            previous, self.state = self.state, state
+            pids = list(self.pids)
+        logger.info(f"Admission {previous} -> {state} ({self.reading})")
+        if state == PAUSE:
+            self.paused_at = time.monotonic()
+            self.resumed.clear()
+        for pid in pids:
+            self.apply(pid, state, previous)
+        if state != PAUSE:
+            self.resumed.set()
+
+    def register(self, pid: int):
+        """Put a new ffmpeg process under admission control."""
+        with self.lock:
+            self.pids.add(pid)
+            state = self.state
+        self.apply(pid, state, RUN)
+
+    def unregister(self, pid: int):
+        with self.lock:
+            self.pids.discard(pid)
+
+    def apply(self, pid: int, state: str, previous: str):
+        try:
+            if state == PAUSE:
+                os.kill(pid, signal.SIGSTOP)
+            elif previous == PAUSE:
+                os.kill(pid, signal.SIGCONT)
+            if state == RUN:
+                set_priority(pid, 0, IOPRIO_CLASS_NONE)
+            elif previous == RUN:
+                set_priority(pid, THROTTLE_NICE, IOPRIO_CLASS_IDLE)
+        except ProcessLookupError:
+            pass
+
+    def wait(self):
+        """Block the worker thread while the jobs are paused."""
+        self.resumed.wait()
+
+    def state_value(self):
+        return STATES.index(self.state)
+
+
+def set_priority(pid: int, nice: int, ioprio_class: int):
+    """Set the niceness and the I/O scheduling class of every thread of the process. Both are per
+    thread on Linux. Lowering the niceness needs privileges, it is kept as is if not permitted.
+    """
+    try:
+        tids = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except FileNotFoundError:
+        raise ProcessLookupError(pid)
+    syscall_nr = SYS_IOPRIO_SET.get(platform.machine())
+    for tid in tids:
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+        except PermissionError:
+            pass
+        except ProcessLookupError:
+            continue
+        if syscall_nr is not None:
+            _get_libc().syscall(
+                syscall_nr, IOPRIO_WHO_PROCESS, tid, ioprio_class << IOPRIO_CLASS_SHIFT
+            )
+
+
+admission = AdmissionController()
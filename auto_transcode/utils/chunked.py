@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import ffmpeg
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.encoder import EncoderBackend
+from auto_transcode.utils.engine import run_ffmpeg
+from auto_transcode.utils.estimate import CompressionAborted
+from auto_transcode.utils.file import get_video_duration
+from auto_transcode.utils.jobs import registry
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def chunked_transcode(source_path: str, target_path: str, backend: EncoderBackend):
+    """Transcode the video in segments encoded in parallel, for software encoders that cannot use
+    all cores on their own.
+
+    The video stream is split at keyframes into segments of about CHUNK_DURATION seconds without
+    re-encoding. The segments are encoded by CHUNK_WORKERS ffmpeg processes, joined losslessly with
+    the concat demuxer, and muxed with the untouched audio of the source. The target is removed if
+    its duration does not match the source.
+
+    Like `encode_with_watchdog`, the encode is stopped once the segments done cover at least
+    WATCHDOG_MIN_PROGRESS of the video and their compression rate reaches ABORT_COMPRESSION_RATE.
+
+    Parameters:
+    - backend: The software encoder backend
+
+    Raises:
+        CompressionAborted: The watchdog stopped the encode.
+    """
+    # next to the target, in the cache directory reserved for the job
+    work_dir = tempfile.mkdtemp(prefix=".chunks-", dir=os.path.dirname(target_path))
+    status = registry.current()
+    try:
+        registry.set_stage("splitting")
+        segments = split_video(source_path, work_dir)
+        logger.info(f"Split {repr(source_path)} into {len(segments)} segments")
+
+        registry.set_stage("transcoding segments", get_video_duration(source_path))
+        threads = max(1, (os.cpu_count() or 1) // Settings.CHUNK_WORKERS)
+        # the segments only hold the video stream, their sizes are compared with the encoded ones
+        source_size = sum(os.path.getsize(path) for path in segments)
+        done = {"source": 0, "encoded": 0}
+        aborted: list[CompressionAborted] = []
+        lock = threading.Lock()
+        start = time.perf_counter()
+
+        def stop(block: dict[str, str]):
+            if aborted:
+                raise aborted[0]
+
+        def encode(path: str):
+            if aborted:
+                raise aborted[0]
+            with registry.attach(status):
+                encoded_path = encode_segment(path, backend.output_kwargs(threads), stop)
+            with lock:
+                done["source"] += os.path.getsize(path)
+                done["encoded"] += os.path.getsize(encoded_path)
+                progress = done["source"] / source_size
+                compression_rate = done["encoded"] / done["source"]
+                if (
+                    not aborted
+                    and Settings.ABORT_COMPRESSION_RATE
+                    and progress >= Settings.WATCHDOG_MIN_PROGRESS
+                    and compression_rate >= Settings.ABORT_COMPRESSION_RATE
+                ):
+                    aborted.append(
+                        CompressionAborted(compression_rate, progress, time.perf_counter() - start)
+                    )
+            if aborted:
+                raise aborted[0]
+            return encoded_path
+
+        with ThreadPoolExecutor(max_workers=Settings.CHUNK_WORKERS) as executor:
+            encoded = list(executor.map(encode, segments))
+
+        registry.set_stage("joining segments")
+
+        list_path = os.path.join(work_dir, "segments.txt")
+        with open(list_path, "w") as f:
+            for path in encoded:
+                f.write(f"file '{os.path.basename(path)}'\n")
+        video = ffmpeg.input(list_path, f="concat", safe=0)
+        source = ffmpeg.input(source_path)
+        run_ffmpeg(ffmpeg.output(video["v"], source["a?"], target_path, c="copy", map_metadata=1))
+    except ffmpeg.Error as e:
+        logger.error(f"Failed to transcode {repr(source_path)} in segments")
+        logger.error(f"stdout: {e.stdout.decode('utf8')}")
+        logger.error(f"stderr: {e.stderr.decode('utf8')}")
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        return
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    source_duration = get_video_duration(source_path)
+    target_duration = get_video_duration(target_path)
+    if source_duration is None or target_duration is None:
+        diff = None
+    else:
+        diff = abs(source_duration - target_duration)
+    if diff is None or diff > 1:
+        logger.error(f"Joined segments do not match the source duration: {repr(target_path)}")
+        os.remove(target_path)
+
+
+def split_video(source_path: str, work_dir: str):
+    """Split the video stream at keyframes into segments of about CHUNK_DURATION seconds.
+
+    Returns:
+        list: The paths of the segments, in order.
+    """
+    pattern = os.path.join(work_dir, "source_%05d.mkv")
+    run_ffmpeg(
+        ffmpeg.input(source_path).output(
+            pattern,
+            map="0:v:0",
+            c="copy",
+            f="segment",
+            segment_time=Settings.CHUNK_DURATION,
+            reset_timestamps=1,
+        )
+    )
+    return sorted(
+        os.path.join(work_dir, name) for name in os.listdir(work_dir) if name.startswith("source_")
+    )
+
+
+def encode_segment(
+    segment_path: str,
+    encoder_kwargs: dict,
+    progress: Callable[[dict[str, str]], None] | None = None,
+):
+    """Encode one segment.
+
+    Parameters:
+    - progress: Called with each block of the progress of ffmpeg, see `run_ffmpeg`
+
+    Returns:
+        str: The path of the encoded segment.
+    """
+    dir, name = os.path.split(segment_path)
+    encoded_path = os.path.join(dir, name.replace("source_", "encoded_"))
+    run_ffmpeg(
+        ffmpeg.input(segment_path).output(encoded_path, **encoder_kwargs),
+        timeout=Settings.TRANSCODE_TIMEOUT,
+        progress=progress,
+    )
+    return encoded_path
@@ -0,0 +1,306 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Callable, Iterator
+from xml.sax.saxutils import quoteattr
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.logger import get_logger
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = get_logger(__name__)
+
+# Extensions of the danmaku files, compressed first
+DANMAKU_EXTS = (".xml.zst", ".xml.gz", ".xml")
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class InvalidDanmaku(Exception):
+    """Raised when a danmaku file is not a recorder danmaku XML document."""
+
+
+def split_danmaku_ext(path: str):
+    """Split `path` into the path without extension and the danmaku extension.
+
+    Returns:
+        tuple: The path without extension and the extension, which is empty if `path` is not a
+        danmaku file.
+    """
+    for ext in DANMAKU_EXTS:
+        if path.endswith(ext):
+            return path[: -len(ext)], ext
+    return path, ""
+
+
+def find_danmaku(dir: str, basename: str):
+    """Get the danmaku file of the video `basename` in `dir`, compressed or not.
+
+    Returns:
+        str: The path.
+        None: The video has no danmaku file.
+    """
+    for ext in DANMAKU_EXTS:
+        path = os.path.join(dir, f"{basename}{ext}")
+        if os.path.exists(path):
+            return path
+
+
+def get_compression():
+    """Get the danmaku compression to use, falling back to gzip if zstandard is not installed."""
+    if Settings.DANMAKU_COMPRESSION == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, compressing danmaku with gzip instead")
+        return "gzip"
+    return Settings.DANMAKU_COMPRESSION
+
+
+def get_danmaku_ext():
+    """Get the extension of the danmaku files compacted with the DANMAKU_COMPRESSION compression."""
+    return {"gzip": ".xml.gz", "zstd": ".xml.zst", "none": ".xml"}[get_compression()]
+
+
+def store_danmaku(from_path: str, to_dir: str, basename: str):
+    """Store the danmaku file in `to_dir` as `basename`. A plain XML file is compacted with the
+    DANMAKU_COMPRESSION compression, a compressed file is copied as is. The original is kept.
+
+    Returns:
+        str: The stored file.
+    """
+    _, ext = split_danmaku_ext(from_path)
+    to_ext = get_danmaku_ext()
+    if ext != ".xml" or to_ext == ".xml":
+        to_path = os.path.join(to_dir, f"{basename}{ext}")
+        shutil.copyfile(from_path, to_path)
+        return to_path
+
+    to_path = os.path.join(to_dir, f"{basename}{to_ext}")
+    try:
+        compact_danmaku(from_path, to_path)
+    except InvalidDanmaku as e:
+        logger.warning(f"Copying {repr(from_path)} unchanged: {e}")
+        to_path = os.path.join(to_dir, f"{basename}.xml")
+        shutil.copyfile(from_path, to_path)
+        return to_path
+    logger.info(
+        f"Compacted {repr(from_path)} from {os.path.getsize(from_path) / 1e6:.1f} MB to "
+        f"{os.path.getsize(to_path) / 1e6:.1f} MB"
+    )
+    return to_path
+
+
+def compact_danmaku(xml_path: str, to_path: str):
+    """Normalize the danmaku XML file and write it compressed to `to_path`, by extension.
+
+    The XML is parsed in one streaming pass with constant memory: each child of the root element
+    is written out and dropped as soon as it ends. The output has one element per line. A file cut
+    short by a crash of the recorder is repaired by closing the root after the last complete
+    element.
+
+    Both compressed formats carry a checksum of the content, gzip a CRC-32 and zstd a XXH64, which
+    is checked whenever the file is read. The written file is read back once before returning.
+
+    Raises:
+        InvalidDanmaku: The file is not a danmaku XML document, nothing is written.
+    """
+    write_danmaku(to_path, lambda out: normalize_danmaku(xml_path, out))
+
+
+def write_danmaku(to_path: str, write: Callable[[BinaryIO], str]):
+    """Write the XML produced by `write` to `to_path`, compressed by extension, through a temporary
+    file. `write` returns the digest of the XML, which is checked by reading the file back.
+    """
+    to_dir, filename = os.path.split(to_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{filename}.", suffix=".part", dir=to_dir or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            with open_compressed_writer(f, to_path) as out:
+                digest = write(out)
+        if read_digest(tmp_path, to_path) != digest:
+            raise OSError(f"Written danmaku does not match {repr(to_path)}")
+        os.replace(tmp_path, to_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def normalize_danmaku(xml_path: str, out: BinaryIO):
+    """Write the normalized XML of the danmaku file to `out`.
+
+    Returns:
+        str: The hex digest of the written XML.
+    """
+    h = hashlib.blake2b(digest_size=16)
+
+    def write(text: str):
+        data = text.encode("utf8")
+        h.update(data)
+        out.write(data)
+
+    write('<?xml version="1.0" encoding="utf-8"?>\n')
+    for event, elem in iter_root_children(xml_path):
+        if event == "root":
+            write(format_root(elem))
+        else:
+            write(ET.tostring(elem, encoding="unicode") + "\n")
+    write("</i>\n")
+    return h.hexdigest()
+
+
+def merge_danmaku(parts: list[tuple[str, float, float]], to_path: str):
+    """Merge the danmaku files of the fragments of a recording into one file on the timeline of the
+    joined video, written compressed to `to_path` by extension.
+
+    Each part is the danmaku file of a fragment, the time in seconds its video was cut at, and the
+    time its video starts at in the joined video. Danmaku before the cut are dropped, the others are
+    shifted. The root and the recorder metadata elements are taken from the first part.
+
+    Raises:
+        InvalidDanmaku: A file is not a danmaku XML document, nothing is written.
+    """
+
+    def merge(out: BinaryIO):
+        h = hashlib.blake2b(digest_size=16)
+
+        def write(text: str):
+            data = text.encode("utf8")
+            h.update(data)
+            out.write(data)
+
+        write('<?xml version="1.0" encoding="utf-8"?>\n')
+        for i, (path, inpoint, offset) in enumerate(parts):
+            for event, elem in iter_root_children(path):
+                if event == "pi":
+                    if i == 0:
+                        write(ET.tostring(elem, encoding="unicode") + "\n")
+                elif event == "root":
+                    if i == 0:
+                        write(format_root(elem))
+                elif shift_danmaku(elem, inpoint, offset) or i == 0:
+                    write(ET.tostring(elem, encoding="unicode") + "\n")
+        write("</i>\n")
+        return h.hexdigest()
+
+    write_danmaku(to_path, merge)
+
+
+def iter_root_children(path: str) -> Iterator[tuple[str, ET.Element]]:
+    """Stream the danmaku file, compressed or not, with constant memory. A file cut short is read up
+    to its last complete element.
+
+    Yields:
+        tuple: ("pi", element) for the processing instructions before the root, ("root", element)
+        for the root without children, and ("child", element) for each child of the root.
+    """
+    root = None
+    depth = 0
+    with open_danmaku(path) as f:
+        try:
+            for event, elem in ET.iterparse(f, events=("start", "end", "pi")):
+                if event == "pi":
+                    if root is None:
+                        yield "pi", elem
+                elif event == "start":
+                    depth += 1
+                    if depth == 1:
+                        if elem.tag != "i":
+                            raise InvalidDanmaku(f"Unexpected root element {repr(elem.tag)}")
+                        root = elem
+                        yield "root", elem
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        assert root is not None
+                        elem.tail = None
+                        yield "child", elem
+                        del root[:]
+        except ET.ParseError as e:
+            if root is None:
+                raise InvalidDanmaku(f"Not an XML document: {e}")
+            logger.warning(f"Danmaku file {repr(path)} is cut short ({e})")
+
+
+def format_root(elem: ET.Element):
+    """The start tag of the root element, on its own line."""
+    attrs = "".join(f" {k}={quoteattr(v)}" for k, v in elem.attrib.items())
+    return f"<i{attrs}>\n"
+
+
+def shift_danmaku(elem: ET.Element, inpoint: float, offset: float):
+    """Move the timed element from the timeline of its fragment, cut at `inpoint`, to the timeline
+    of the joined video starting the fragment at `offset`.
+
+    Returns:
+        bool: True if the element is kept, False if it is before the cut or has no time.
+    """
+    # danmaku have the time first in "p", gifts, super chats and guards in "ts"
+    if elem.tag == "d":
+        fields = elem.get("p", "").split(",")
+    elif elem.get("ts") is not None:
+        fields = [elem.get("ts", "")]
+    else:
+        return False
+    try:
+        time = float(fields[0])
+    except ValueError:
+        return False
+    if time < inpoint:
+        return False
+    fields[0] = f"{time - inpoint + offset:.3f}"
+    if elem.tag == "d":
+        elem.set("p", ",".join(fields))
+    else:
+        elem.set("ts", fields[0])
+    return True
+
+
+def open_compressed_writer(f: BinaryIO, path: str) -> BinaryIO:
+    if path.endswith(".zst"):
+        assert zstandard is not None
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, write_checksum=True)
+        return compressor.stream_writer(f, closefd=False)
+    if path.endswith(".gz"):
+        return gzip.GzipFile(filename="", mode="wb", fileobj=f, compresslevel=GZIP_LEVEL, mtime=0)
+    return f
+
+
+def open_danmaku(path: str, compressed_as: str | None = None) -> BinaryIO:
+    """Open the danmaku file for reading its XML, decompressing it on the fly. The checksum of a
+    compressed file is verified when the end is reached.
+
+    Parameters:
+    - compressed_as: The path whose extension tells the compression, if not `path` itself
+    """
+    _, ext = split_danmaku_ext(compressed_as or path)
+    if ext == ".xml.zst":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed, cannot read zstd danmaku")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    if ext == ".xml.gz":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def iter_danmaku(path: str, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """Stream the XML of the danmaku file in chunks, see `open_danmaku`."""
+    with open_danmaku(path) as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def read_digest(path: str, compressed_as: str | None = None):
+    h = hashlib.blake2b(digest_size=16)
+    with open_danmaku(path, compressed_as) as f:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,232 @@
+import array
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+import zlib
+
+import numpy as np
+
+from auto_transcode.utils.danmaku import find_danmaku, open_danmaku
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+INDEX_EXT = ".danmaku.npz"
+INDEX_VERSION = 1
+
+
+class DanmakuIndex:
+    """Columnar index of the danmaku of a recording, stored as a `.danmaku.npz` sidecar next to
+    the video, so that time ranges and peaks are queried without parsing the XML.
+
+    Arrays:
+    - times: Time of each danmaku in seconds from the start of the recording, sorted
+    - users: Hash of the user of each danmaku
+    - text_offsets: Offsets of the text of each danmaku in `text`, one more than the danmaku
+    - text: The UTF-8 texts of the danmaku, concatenated
+    - density: Number of danmaku in each second of the recording
+    """
+
+    def __init__(
+        self,
+        times: np.ndarray,
+        users: np.ndarray,
+        text_offsets: np.ndarray,
+        text: np.ndarray,
+        density: np.ndarray,
+    ):
+        self.times = times
+        self.users = users
+        self.text_offsets = text_offsets
+        self.text = text
+        self.density = density
+
+    @classmethod
+    def build(cls, danmaku_path: str):
+        """Build the index of a danmaku file, compressed or not, in one streaming pass."""
+        times = array.array("d")
+        users = array.array("I")
+        text_offsets = array.array("q", [0])
+        text = bytearray()
+        root = None
+        depth = 0
+        with open_danmaku(danmaku_path) as f:
+            try:
+                for event, elem in ET.iterparse(f, events=("start", "end")):
+                    if event == "start":
+                        depth += 1
+                        if depth == 1:
+                            root = elem
+                        continue
+                    depth -= 1
+                    if depth != 1:
+                        continue
+                    if elem.tag == "d":
+                        fields = elem.get("p", "").split(",")
+                        try:
+                            time = float(fields[0])
+                        except ValueError:
+                            time = None
+                        if time is not None:
+                            times.append(time)
+                            users.append(hash_user(fields[6] if len(fields) > 6 else ""))
+                            text.extend((elem.text or "").encode("utf8"))
+                            text_offsets.append(len(text))
+                    # keep the memory constant
+                    assert root is not None
+                    del root[:]
+            except ET.ParseError as e:
+                logger.warning(f"Danmaku file {repr(danmaku_path)} is cut short ({e})")
+
+        times_array = np.frombuffer(times, dtype=np.float64)
+        # the recorder writes danmaku in arrival order, which is almost sorted by time
+        order = np.argsort(times_array, kind="stable")
+        offsets = np.frombuffer(text_offsets, dtype=np.int64)
+        starts = offsets[:-1][order]
+        lengths = offsets[1:][order] - starts
+        sorted_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        # gather the texts in time order: byte j of the text of danmaku i moves from starts[i] + j
+        # to sorted_offsets[i] + j
+        gather = np.arange(sorted_offsets[-1]) - np.repeat(sorted_offsets[:-1] - starts, lengths)
+        sorted_text = np.frombuffer(bytes(text), dtype=np.uint8)[gather]
+        sorted_times = times_array[order]
+        seconds = np.floor(np.clip(sorted_times, 0, None)).astype(np.int64)
+        return cls(
+            times=sorted_times,
+            users=np.frombuffer(users, dtype=np.uint32)[order],
+            text_offsets=sorted_offsets,
+            text=sorted_text,
+            density=np.bincount(seconds).astype(np.int32),
+        )
+
+    def save(self, index_path: str):
+        dir, filename = os.path.split(index_path)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{filename}.", suffix=".part", dir=dir or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    version=np.array([INDEX_VERSION]),
+                    times=self.times,
+                    users=self.users,
+                    text_offsets=self.text_offsets,
+                    text=self.text,
+                    density=self.density,
+                )
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, index_path: str):
+        with np.load(index_path) as data:
+            if int(data["version"][0]) != INDEX_VERSION:
+                raise ValueError(f"Unsupported danmaku index version in {repr(index_path)}")
+            return cls(
+                data["times"], data["users"], data["text_offsets"], data["text"], data["density"]
+            )
+
+    def range(self, start: float, end: float, limit: int | None = None):
+        """Get the danmaku from `start` to `end` seconds, found by binary search.
+
+        Returns:
+            list: The danmaku in time order, as dicts with time, user and text.
+        """
+        lo, hi = np.searchsorted(self.times, [start, end], side="left")
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        offsets = self.text_offsets
+        return [
+            {
+                "time": float(self.times[i]),
+                "user": f"{int(self.users[i]):08x}",
+                "text": self.text[offsets[i] : offsets[i + 1]].tobytes().decode("utf8", "replace"),
+            }
+            for i in range(lo, hi)
+        ]
+
+    def peaks(self, k: int, window: int = 1):
+        """Get the `k` busiest non-overlapping windows of `window` seconds."""
+        return find_peaks(self.density, k, window)
+
+
+def find_peaks(density: np.ndarray, k: int, window: int = 1):
+    """Get the `k` busiest non-overlapping windows of `window` seconds of a per-second density.
+
+    Returns:
+        list: Dicts with the start time in seconds and the count of the windows, busiest first.
+    """
+    if len(density) == 0 or k <= 0:
+        return []
+    window = max(1, min(window, len(density)))
+    # danmaku count of the window starting at each second
+    cumsum = np.concatenate([[0], np.cumsum(density, dtype=np.int64)])
+    counts = cumsum[window:] - cumsum[:-window]
+    peaks = []
+    for _ in range(k):
+        start = int(np.argmax(counts))
+        if counts[start] <= 0:
+            break
+        peaks.append({"time": start, "count": int(counts[start])})
+        # windows overlapping the peak cannot be picked again
+        counts[max(0, start - window + 1) : start + window] = -1
+    return peaks
+
+
+def hash_user(user: str):
+    """The recorder writes the CRC32 of the user id in hex, other values are hashed the same way."""
+    try:
+        return int(user, 16) & 0xFFFFFFFF
+    except ValueError:
+        return zlib.crc32(user.encode("utf8"))
+
+
+def get_index_path(dir: str, basename: str):
+    return os.path.join(dir, f"{basename}{INDEX_EXT}")
+
+
+def build_index(dir: str, basename: str):
+    """Build the index sidecar of the danmaku of the video `basename` in `dir`.
+
+    Returns:
+        str: The index path.
+        None: The video has no danmaku file.
+    """
+    danmaku_path = find_danmaku(dir, basename)
+    if danmaku_path is None:
+        return
+    index = DanmakuIndex.build(danmaku_path)
+    index_path = get_index_path(dir, basename)
+    index.save(index_path)
+    logger.info(f"Indexed {len(index.times)} danmaku of {repr(danmaku_path)}")
+    return index_path
+
+
+def get_index(dir: str, basename: str):
+    """Load the index of the video `basename` in `dir`, building it if it is missing or older than
+    the danmaku file.
+
+    Returns:
+        DanmakuIndex: The index.
+        None: The video has no danmaku file.
+    """
+    danmaku_path = find_danmaku(dir, basename)
+    if danmaku_path is None:
+        return
+    index_path = get_index_path(dir, basename)
+    try:
+        fresh = os.path.getmtime(index_path) >= os.path.getmtime(danmaku_path)
+    except FileNotFoundError:
+        fresh = False
+    if not fresh:
+        build_index(dir, basename)
+    return DanmakuIndex.load(index_path)
+
+
+def load_density(index_path: str):
+    """Load only the per-second density of an index."""
+    with np.load(index_path) as data:
+        return data["density"]
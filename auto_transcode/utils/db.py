@@ -0,0 +1,50 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from auto_transcode.settings import Settings
+
+
+_local = threading.local()
+
+
+def get_connection(name: str, schema: str) -> sqlite3.Connection:
+    """Get a connection to the sqlite database `name` located in CACHE_DIR.
+
+    Connections are opened lazily and kept per process and per thread, so that a database can be
+    shared by both watcher processes. The connection is in autocommit mode, use `BEGIN IMMEDIATE`
+    for transactions spanning several statements.
+
+    Parameters:
+    - name: The database name, without extension
+    - schema: SQL script executed when the connection is opened. Must be idempotent.
+    """
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        # Connections must not be shared with a forked child
+        _local.pid = pid
+        _local.connections = {}
+    connections: dict[str, sqlite3.Connection] = _local.connections
+
+    if name not in connections:
+        db_path = os.path.join(Settings.CACHE_DIR, f"{name}.sqlite3")
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(schema)
+        connections[name] = conn
+
+    return connections[name]
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    """Run the statements in the `with` block in one write transaction."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
@@ -0,0 +1,162 @@
+import functools
+import subprocess
+
+import ffmpeg
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class EncoderBackend:
+    """A video encoder and the mapping of the settings to its ffmpeg options.
+
+    Attributes:
+    - name: The ffmpeg encoder name
+    - codec_name: The codec name of the encoded video, as reported by ffprobe. None if the video is
+    not re-encoded and keeps the codec of the source.
+    - chunkable: Whether the encoder benefits from splitting the video into segments encoded in
+    parallel, see `chunked_transcode`
+    - hardware: Whether the encoder needs a GPU
+    """
+
+    def __init__(
+        self, name: str, codec_name: str | None, chunkable: bool = False, hardware: bool = False
+    ):
+        self.name = name
+        self.codec_name = codec_name
+        self.chunkable = chunkable
+        self.hardware = hardware
+
+    def output_kwargs(self, threads: int = 0) -> dict:
+        """Get the ffmpeg output options of the video stream.
+
+        Parameters:
+        - threads: Number of threads the encoder may use, 0 to let the encoder decide
+        """
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return self.name
+
+
+class NvencAV1Backend(EncoderBackend):
+    def __init__(self):
+        super().__init__("av1_nvenc", "av1", hardware=True)
+
+    def output_kwargs(self, threads: int = 0):
+        return {"vcodec": self.name, "cq": Settings.NVENC_CQ, "preset": Settings.NVENC_PRESET}
+
+
+class SvtAV1Backend(EncoderBackend):
+    def __init__(self):
+        super().__init__("libsvtav1", "av1", chunkable=True)
+
+    def output_kwargs(self, threads: int = 0):
+        kwargs = {"vcodec": self.name, "crf": Settings.SVTAV1_CRF, "preset": Settings.SVTAV1_PRESET}
+        if threads:
+            kwargs["svtav1-params"] = f"lp={threads}"
+        return kwargs
+
+
+class AomAV1Backend(EncoderBackend):
+    def __init__(self):
+        super().__init__("libaom-av1", "av1", chunkable=True)
+
+    def output_kwargs(self, threads: int = 0):
+        # b:v 0 selects the constant quality mode
+        kwargs = {
+            "vcodec": self.name,
+            "crf": Settings.AOM_CRF,
+            "b:v": 0,
+            "cpu-used": Settings.AOM_CPU_USED,
+            "row-mt": 1,
+        }
+        if threads:
+            kwargs["threads"] = threads
+        return kwargs
+
+
+class CopyBackend(EncoderBackend):
+    def __init__(self):
+        super().__init__("copy", None)
+
+    def output_kwargs(self, threads: int = 0):
+        return {"vcodec": "copy"}
+
+
+# Ordered from the fastest to the slowest
+ENCODERS: dict[str, EncoderBackend] = {
+    backend.name: backend
+    for backend in [NvencAV1Backend(), SvtAV1Backend(), AomAV1Backend(), CopyBackend()]
+}
+
+
+@functools.cache
+def get_available_encoders():
+    """Get the names of the encoders ffmpeg was built with, from `ffmpeg -encoders`.
+
+    Returns:
+        set: The encoder names.
+    """
+    try:
+        output = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, check=True, text=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.error(f"Failed to list ffmpeg encoders: {repr(e)}")
+        return set()
+
+    encoders = set()
+    listing = False
+    for line in output.splitlines():
+        if line.strip().startswith("------"):
+            listing = True
+            continue
+        fields = line.split()
+        # e.g. " V....D libsvtav1            SVT-AV1(Scalable Video Technology for AV1) encoder"
+        if listing and len(fields) >= 2 and fields[0].startswith("V"):
+            encoders.add(fields[1])
+    return encoders
+
+
+def is_usable(backend: EncoderBackend):
+    """Whether the backend can encode on this host. Hardware encoders are listed by ffmpeg even
+    without a GPU, so they are tried on a few blank frames.
+    """
+    if isinstance(backend, CopyBackend):
+        return True
+    if backend.name not in get_available_encoders():
+        return False
+    if not backend.hardware:
+        return True
+    try:
+        ffmpeg.input("color=size=256x256:duration=0.1", f="lavfi").output(
+            "-", f="null", **backend.output_kwargs()
+        ).run(capture_stdout=True, capture_stderr=True)
+    except ffmpeg.Error:
+        return False
+    return True
+
+
+@functools.cache
+def get_encoder():
+    """Get the encoder backend selected by ENCODER. With "auto", the fastest usable backend is
+    chosen. Capabilities are detected once per process.
+
+    Returns:
+        EncoderBackend: The selected backend.
+    """
+    if Settings.ENCODER != "auto":
+        backend = ENCODERS[Settings.ENCODER]
+        if not is_usable(backend):
+            logger.warning(f"Encoder {backend.name} is not usable on this host")
+        return backend
+
+    for backend in ENCODERS.values():
+        if is_usable(backend):
+            break
+    logger.info(f"Selected encoder {backend.name}")
+    return backend
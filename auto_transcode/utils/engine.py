@@ -0,0 +1,258 @@
+import asyncio
+import collections
+import itertools
+import signal
+import threading
+import time
+from concurrent.futures import CancelledError as FutureCancelledError
+from typing import Any, Callable
+
+import ffmpeg
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.admission import admission
+from auto_transcode.utils.jobs import JobStatus, registry
+from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.progress import parse_progress
+
+
+logger = get_logger(__name__)
+
+# Number of stderr lines kept per job for error messages
+STDERR_LINES = 200
+# Time in seconds given to ffmpeg to exit after SIGTERM before it is killed
+TERMINATE_TIMEOUT = 5
+
+
+class FFmpegTimeout(ffmpeg.Error):
+    """Raised when an ffmpeg job runs past its timeout. The process is killed."""
+
+    def __init__(self, timeout: float, stderr: bytes):
+        super().__init__("ffmpeg", b"", stderr)
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"ffmpeg timed out after {self.timeout:.0f} sec"
+
+
+class FFmpegCancelled(ffmpeg.Error):
+    """Raised when an ffmpeg job is cancelled. The process is killed."""
+
+    def __init__(self, stderr: bytes):
+        super().__init__("ffmpeg", b"", stderr)
+
+    def __str__(self):
+        return "ffmpeg was cancelled"
+
+
+class FFmpegJob:
+    __slots__ = ("id", "args", "started_at", "stderr", "task", "status")
+
+    def __init__(self, id: int, args: list[str], status: JobStatus | None):
+        self.id = id
+        self.args = args
+        self.started_at = time.time()
+        # tail of the stderr output
+        self.stderr: collections.deque[bytes] = collections.deque(maxlen=STDERR_LINES)
+        self.task: asyncio.Task | None = None
+        # the remux or transcode job the process belongs to, updated with the progress
+        self.status = status
+
+
+class FFmpegEngine:
+    """Run ffmpeg processes with asyncio subprocesses on one event loop. At most FFMPEG_PROCESSES
+    run at once, the others wait on a semaphore.
+
+    The engine runs on the app event loop when started from the FastAPI lifespan, or on a private
+    loop thread otherwise, e.g. in the scripts. Blocking code in worker threads uses `run_sync`.
+
+    Every process reports its `-progress pipe:1` output on stdout, which updates the job it runs
+    for in the job registry. stderr is streamed into a ring buffer so that the output of long
+    encodes is never held in memory.
+    """
+
+    def __init__(self):
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.semaphore: asyncio.Semaphore | None = None
+        self.jobs: dict[int, FFmpegJob] = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def start(self, loop: asyncio.AbstractEventLoop | None = None):
+        """Start the engine on `loop`, or on a new loop in a daemon thread."""
+        with self.lock:
+            if self.loop is not None:
+                return
+            if loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="FFmpegEngine", daemon=True).start()
+            self.loop = loop
+            # bound to the loop on first use
+            self.semaphore = asyncio.Semaphore(Settings.FFMPEG_PROCESSES)
+
+    async def stop(self):
+        """Refuse new jobs and cancel the running ones, killing their processes."""
+        self.closed = True
+        tasks = [job.task for job in list(self.jobs.values()) if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            logger.info(f"Cancelling {len(tasks)} ffmpeg jobs")
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def cancel(self, job_id: int):
+        """Cancel the job, killing its process.
+
+        Returns:
+            bool: True if the job was running, otherwise False
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.task is None or self.loop is None:
+            return False
+        self.loop.call_soon_threadsafe(job.task.cancel)
+        return True
+
+    async def run(
+        self,
+        stream: Any,
+        timeout: float | None = None,
+        progress: Callable[[dict[str, str]], None] | None = None,
+        status: JobStatus | None = None,
+    ):
+        """Run the ffmpeg command of the ffmpeg-python `stream`.
+
+        Parameters:
+        - timeout: In seconds. The process is killed if it runs longer. None or 0 for no timeout.
+        - progress: Called with each block of the `-progress` output. An exception raised by the
+        callback kills the process and is re-raised.
+        - status: The job to report the progress to
+
+        Raises:
+            FFmpegTimeout: The job timed out.
+            FFmpegCancelled: The job was cancelled.
+            ffmpeg.Error: ffmpeg exited with an error.
+        """
+        if self.closed or self.semaphore is None:
+            raise FFmpegCancelled(b"")
+        args = ffmpeg.compile(stream, overwrite_output=True)
+        args[1:1] = ["-progress", "pipe:1", "-nostats"]
+        job = FFmpegJob(next(self.ids), args, status)
+        job.task = asyncio.current_task()
+        self.jobs[job.id] = job
+        try:
+            async with self.semaphore:
+                job.started_at = time.time()
+                return await self.execute(job, timeout or None, progress)
+        finally:
+            del self.jobs[job.id]
+
+    async def execute(
+        self,
+        job: FFmpegJob,
+        timeout: float | None,
+        progress: Callable[[dict[str, str]], None] | None,
+    ):
+        process = await asyncio.create_subprocess_exec(
+            *job.args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        admission.register(process.pid)
+        assert process.stderr is not None
+        stderr_reader = asyncio.create_task(self.read_stderr(process.stderr, job))
+
+        async def communicate():
+            assert process.stdout is not None
+            lines = []
+            async for line in process.stdout:
+                lines.append(line.decode("utf8", errors="replace"))
+                if not line.startswith(b"progress="):
+                    continue
+                for block in parse_progress(lines):
+                    if job.status is not None:
+                        registry.update(job.status, job.id, block)
+                    if progress is not None:
+                        progress(block)
+                lines = []
+            await stderr_reader
+            return await process.wait()
+
+        try:
+            returncode = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            await self.terminate(process)
+            assert timeout is not None
+            raise FFmpegTimeout(timeout, b"".join(job.stderr))
+        except asyncio.CancelledError:
+            await self.terminate(process)
+            raise FFmpegCancelled(b"".join(job.stderr))
+        except BaseException:
+            await self.terminate(process)
+            raise
+        finally:
+            stderr_reader.cancel()
+            admission.unregister(process.pid)
+
+        if returncode != 0:
+            raise ffmpeg.Error("ffmpeg", b"", b"".join(job.stderr))
+
+    async def read_stderr(self, stderr: asyncio.StreamReader, job: FFmpegJob):
+        async for line in stderr:
+            job.stderr.append(line)
+
+    async def terminate(self, process: asyncio.subprocess.Process):
+        """Stop ffmpeg with SIGTERM, so that it can close the output, then kill it."""
+        if process.returncode is not None:
+            return
+        # a paused process does not handle SIGTERM until it is resumed
+        process.send_signal(signal.SIGCONT)
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), TERMINATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+    def run_sync(
+        self,
+        stream: Any,
+        timeout: float | None = None,
+        progress: Callable[[dict[str, str]], None] | None = None,
+    ):
+        """Run `run` from a worker thread and wait for it, see `run`. The progress is reported to
+        the current job of the thread.
+        """
+        if self.closed:
+            raise FFmpegCancelled(b"")
+        if self.loop is None:
+            self.start()
+        assert self.loop is not None and not self.in_loop()
+        future = asyncio.run_coroutine_threadsafe(
+            self.run(stream, timeout, progress, registry.current()), self.loop
+        )
+        try:
+            return future.result()
+        except FutureCancelledError:
+            raise FFmpegCancelled(b"")
+
+
+engine = FFmpegEngine()
+
+
+def run_ffmpeg(
+    stream: Any,
+    timeout: float | None = None,
+    progress: Callable[[dict[str, str]], None] | None = None,
+):
+    """Run the ffmpeg command of the ffmpeg-python `stream` on the engine and wait for it. Drop-in
+    replacement of `stream.run(overwrite_output=True, capture_stdout=True, capture_stderr=True)`.
+    """
+    return engine.run_sync(stream, timeout, progress)
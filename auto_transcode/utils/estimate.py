@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import time
+
+import ffmpeg
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.encoder import EncoderBackend
+from auto_transcode.utils.engine import run_ffmpeg
+from auto_transcode.utils.jobs import registry
+from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.progress import get_out_time, get_total_size
+
+
+logger = get_logger(__name__)
+
+
+class CompressionAborted(Exception):
+    """Raised when the watchdog stops an encode that is not going to shrink the video."""
+
+    def __init__(self, compression_rate: float, progress: float, elapsed: float):
+        super().__init__(
+            f"Projected compression rate {compression_rate * 100:.0f}% "
+            f"after {progress * 100:.0f}% of the video"
+        )
+        self.compression_rate = compression_rate
+        self.progress = progress
+        self.elapsed = elapsed
+
+    @property
+    def time_saved(self):
+        """Estimated encode time saved by aborting, in seconds."""
+        return self.elapsed / self.progress * (1 - self.progress)
+
+
+class Estimate:
+    __slots__ = ("compression_rate", "encode_time", "estimate_time")
+
+    def __init__(self, compression_rate: float, encode_time: float, estimate_time: float):
+        self.compression_rate = compression_rate
+        # projected time of the full encode, in seconds
+        self.encode_time = encode_time
+        # time spent estimating, in seconds
+        self.estimate_time = estimate_time
+
+
+def estimate_compression(source_path: str, duration: float, backend: EncoderBackend):
+    """Project the compression rate and the encode time of the video by encoding ESTIMATE_SAMPLES
+    samples of ESTIMATE_SAMPLE_DURATION seconds spread across it.
+
+    Returns:
+        Estimate: The projection.
+        None: The video is too short to be sampled, the estimator is disabled, or a sample failed.
+    """
+    samples = Settings.ESTIMATE_SAMPLES
+    sample_duration = Settings.ESTIMATE_SAMPLE_DURATION
+    if backend.codec_name is None or samples == 0 or duration < 2 * samples * sample_duration:
+        return
+
+    registry.set_stage("estimating")
+    start = time.perf_counter()
+    work_dir = tempfile.mkdtemp(prefix=".estimate-", dir=Settings.CACHE_DIR)
+    input_bytes = output_bytes = 0
+    encode_time = 0.0
+    try:
+        for i in range(samples):
+            offset = duration * (i + 1) / (samples + 1)
+            sample_path = os.path.join(work_dir, f"sample_{i}.mkv")
+            encoded_path = os.path.join(work_dir, f"encoded_{i}.mkv")
+            # a stream copy of the sample gives the input bytes of that span
+            run_ffmpeg(
+                ffmpeg.input(source_path, ss=offset, t=sample_duration).output(
+                    sample_path, c="copy"
+                )
+            )
+            encode_start = time.perf_counter()
+            run_ffmpeg(
+                ffmpeg.input(sample_path).output(
+                    encoded_path, acodec="copy", **backend.output_kwargs(Settings.ENCODER_THREADS)
+                )
+            )
+            encode_time += time.perf_counter() - encode_start
+            input_bytes += os.path.getsize(sample_path)
+            output_bytes += os.path.getsize(encoded_path)
+    except ffmpeg.Error as e:
+        logger.warning(f"Failed to estimate the compression of {repr(source_path)}")
+        logger.warning(f"stderr: {e.stderr.decode('utf8')}")
+        return
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if input_bytes == 0:
+        return
+    return Estimate(
+        compression_rate=output_bytes / input_bytes,
+        encode_time=encode_time / (samples * sample_duration) * duration,
+        estimate_time=time.perf_counter() - start,
+    )
+
+
+def encode_with_watchdog(
+    source_path: str, target_path: str, duration: float, backend: EncoderBackend
+):
+    """Encode the video while watching the output size against the input progress. The encode is
+    stopped once at least WATCHDOG_MIN_PROGRESS of the video is done and the projected compression
+    rate reaches ABORT_COMPRESSION_RATE.
+
+    Raises:
+        CompressionAborted: The watchdog stopped the encode. The target is removed.
+        ffmpeg.Error: ffmpeg failed or timed out after TRANSCODE_TIMEOUT seconds.
+    """
+    source_size = os.path.getsize(source_path)
+    start = time.perf_counter()
+
+    def watch(block: dict[str, str]):
+        out_time = get_out_time(block)
+        total_size = get_total_size(block)
+        if not (duration and source_size and out_time and total_size):
+            return
+        progress = out_time / duration
+        if (
+            progress < Settings.WATCHDOG_MIN_PROGRESS
+            or not Settings.ABORT_COMPRESSION_RATE
+            or backend.codec_name is None
+        ):
+            return
+        compression_rate = total_size / (progress * source_size)
+        if compression_rate >= Settings.ABORT_COMPRESSION_RATE:
+            raise CompressionAborted(compression_rate, progress, time.perf_counter() - start)
+
+    stream = ffmpeg.input(source_path).output(
+        target_path, acodec="copy", **backend.output_kwargs(Settings.ENCODER_THREADS)
+    )
+    try:
+        run_ffmpeg(stream, timeout=Settings.TRANSCODE_TIMEOUT, progress=watch)
+    except CompressionAborted:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        raise
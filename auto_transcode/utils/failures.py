@@ -0,0 +1,180 @@
+import os
+import time
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.danmaku import find_danmaku, split_danmaku_ext
+from auto_transcode.utils.danmaku_index import get_index_path
+from auto_transcode.utils.db import get_connection, transaction
+from auto_transcode.utils.file import get_file_identity, safe_move_and_rename_file
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS failures (
+    name TEXT NOT NULL,
+    source TEXT NOT NULL,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    reason TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    failed_at REAL NOT NULL,
+    retry_at REAL NOT NULL,
+    quarantined TEXT,
+    PRIMARY KEY (name, source)
+);
+"""
+
+# Longest time in seconds between two attempts
+MAX_BACKOFF = 86400
+
+
+class JobFailed(Exception):
+    """Raised by a job when the source file cannot be processed. Logged without a traceback."""
+
+
+class Failure:
+    __slots__ = ("name", "source", "reason", "count", "failed_at", "retry_at", "quarantined")
+
+    def __init__(
+        self,
+        name: str,
+        source: str,
+        reason: str,
+        count: int,
+        failed_at: float,
+        retry_at: float,
+        quarantined: str | None,
+    ):
+        self.name = name
+        self.source = source
+        self.reason = reason
+        # consecutive failures
+        self.count = count
+        self.failed_at = failed_at
+        self.retry_at = retry_at
+        # where the source was moved to, None if it is not quarantined
+        self.quarantined = quarantined
+
+    def to_dict(self):
+        return {
+            "process": self.name,
+            "source": self.source,
+            "reason": self.reason,
+            "count": self.count,
+            "failed_at": self.failed_at,
+            "retry_at": self.retry_at,
+            "quarantined": self.quarantined,
+        }
+
+
+class FailureCache:
+    """Persistent negative cache of the source files that failed, by file identity.
+
+    A failed file is retried after FAILURE_BACKOFF seconds, doubled after each failure. After
+    MAX_FAILURES failures it is moved to QUARANTINE_DIR, or left in place and never retried if
+    QUARANTINE_DIR is not set. Modifying the file gives it a fresh start.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def connection(self):
+        return get_connection("failures", SCHEMA)
+
+    def should_skip(self, source: str):
+        """Whether the file failed and is waiting for its next attempt, or is quarantined."""
+        row = (
+            self.connection()
+            .execute(
+                "SELECT dev, ino, size, mtime_ns, retry_at, quarantined FROM failures "
+                "WHERE name=? AND source=?",
+                (self.name, source),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return False
+        identity = get_file_identity(source)
+        if identity is not None and identity != tuple(row[:4]):
+            logger.info(f"{repr(source)} changed since it failed, retrying")
+            self.clear(source)
+            return False
+        retry_at, quarantined = row[4:]
+        return quarantined is not None or time.time() < retry_at
+
+    def record(self, source: str, reason: str):
+        """Record a failure of the file and schedule its next attempt.
+
+        Returns:
+            Failure: The failure, with the number of consecutive failures.
+        """
+        conn = self.connection()
+        with transaction(conn):
+            row = conn.execute(
+                "SELECT dev, ino, size, mtime_ns, count FROM failures WHERE name=? AND source=?",
+                (self.name, source),
+            ).fetchone()
+            identity = get_file_identity(source) or (0, 0, 0, 0)
+            count = 1
+            if row is not None and identity == tuple(row[:4]):
+                count = row[4] + 1
+            failed_at = time.time()
+            backoff = min(MAX_BACKOFF, Settings.FAILURE_BACKOFF * 2 ** (count - 1))
+            conn.execute(
+                "INSERT OR REPLACE INTO failures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                (self.name, source, *identity, reason, count, failed_at, failed_at + backoff),
+            )
+        return Failure(self.name, source, reason, count, failed_at, failed_at + backoff, None)
+
+    def quarantine(self, source: str):
+        """Move the file and its xml file to QUARANTINE_DIR, or keep them in place if it is not
+        set. Either way the file is not attempted again.
+
+        Returns:
+            str: The quarantined path.
+        """
+        path = source
+        if Settings.QUARANTINE_DIR:
+            dir, filename = os.path.split(source)
+            basename, _ = os.path.splitext(filename)
+            quarantine_dir = os.path.join(Settings.QUARANTINE_DIR, self.name.lower())
+            os.makedirs(quarantine_dir, exist_ok=True)
+            path = safe_move_and_rename_file(source, os.path.join(quarantine_dir, filename))
+            danmaku_path = find_danmaku(dir, basename)
+            if danmaku_path is not None:
+                new_basename, _ = os.path.splitext(os.path.basename(path))
+                _, ext = split_danmaku_ext(danmaku_path)
+                safe_move_and_rename_file(
+                    danmaku_path, os.path.join(quarantine_dir, f"{new_basename}{ext}")
+                )
+            index_path = get_index_path(dir, basename)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+        self.connection().execute(
+            "UPDATE failures SET quarantined=? WHERE name=? AND source=?",
+            (path, self.name, source),
+        )
+        return path
+
+    def clear(self, source: str):
+        """Forget the failures of the file, e.g. once it was processed."""
+        self.connection().execute(
+            "DELETE FROM failures WHERE name=? AND source=?", (self.name, source)
+        )
+
+
+def list_failures(quarantined: bool = False):
+    """Get the failed files of all the processes, most recent first.
+
+    Parameters:
+    - quarantined: Only list the quarantined files
+    """
+    query = "SELECT name, source, reason, count, failed_at, retry_at, quarantined FROM failures"
+    if quarantined:
+        query += " WHERE quarantined IS NOT NULL"
+    rows = get_connection("failures", SCHEMA).execute(f"{query} ORDER BY failed_at DESC")
+    return [Failure(*row).to_dict() for row in rows]
@@ -1,29 +1,95 @@
+import errno
+import fcntl
+import hashlib
 import os
-import shutil
+import tempfile
+import time
+from contextlib import contextmanager
 from typing import Any, cast
 
 import ffmpeg
 
+from auto_transcode.settings import Settings
+from auto_transcode.utils import metrics, probe_cache
+from auto_transcode.utils.admission import admission
 from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.native_probe import native_probe
 
 
 logger = get_logger(__name__)
 
 
+def get_file_identity(file_path: str):
+    """Get the identity of the current version of the file, which changes whenever the file is
+    replaced or modified.
+
+    Returns:
+        tuple: (device, inode, size, mtime_ns) of the file.
+        None: The file does not exist.
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def sample_checksum(file_path: str, samples: int = 16, sample_size: int = 64 * 1024):
+    """Checksum of the file size and of `samples` blocks of `sample_size` bytes spread evenly
+    across the file, from the first to the last block. Reads at most `samples * sample_size` bytes,
+    so it is cheap for large videos while still telling apart files with the same size.
+
+    Returns:
+        str: The hex digest.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(size.to_bytes(8, "little"))
+        if size <= samples * sample_size:
+            h.update(f.read())
+        else:
+            step = (size - sample_size) / (samples - 1)
+            for i in range(samples):
+                f.seek(int(i * step))
+                h.update(f.read(sample_size))
+    return h.hexdigest()
+
+
 def get_video_metadata(file_path: str):
-    """Get the metadata of the video file.
+    """Get the metadata of the video file. The flv and mp4 headers are parsed natively when
+    NATIVE_PROBE is enabled, falling back to ffprobe. Results are cached on disk, so that every
+    version of a file is probed only once.
 
     Returns:
         dict: The metadata of the video file.
         None: Failed to probe the file.
     """
+    start = time.perf_counter()
+    identity = get_file_identity(file_path)
+    if identity is not None:
+        metadata = probe_cache.get(file_path, identity)
+        if metadata is not None:
+            metrics.probes.inc(source="cache")
+            metrics.probe_duration.observe(time.perf_counter() - start, source="cache")
+            return metadata
+
+    source = "native"
+    metadata = native_probe(file_path) if Settings.NATIVE_PROBE else None
     try:
-        metadata = cast(dict[str, Any], ffmpeg.probe(file_path))
+        if metadata is None:
+            source = "ffprobe"
+            metadata = cast(dict[str, Any], ffmpeg.probe(file_path))
     except ffmpeg.Error as e:
         logger.error(f"Failed to probe {repr(file_path)}")
         logger.error(f"stdout: {e.stdout.decode('utf8')}")
         logger.error(f"stderr: {e.stderr.decode('utf8')}")
     else:
+        metrics.probes.inc(source=source)
+        metrics.probe_duration.observe(time.perf_counter() - start, source=source)
+        # Do not cache the result if the file was modified while being probed
+        if identity is not None and get_file_identity(file_path) == identity:
+            probe_cache.put(file_path, identity, metadata)
         return metadata
 
 
@@ -49,17 +115,17 @@ def get_video_duration(file_path: str):
         float: The duration of the video file in seconds.
         None: Failed to probe the file.
     """
-    metadata = ffmpeg.probe(file_path)
+    metadata = get_video_metadata(file_path)
     if metadata is None:
         return
     duration = float(metadata["format"]["duration"])
     return duration
 
 
-def safe_move_and_rename_file(from_path: str, to_path: str, duplicate_count: int = 0):
+def safe_move_and_rename_file(from_path: str, to_path: str):
     """Move and rename file from `from_path` to `to_path`.
 
-    If `to_path` already exists, append a number to the file name according to `duplicate_count`
+    If `to_path` already exists, append a number to the file name
 
     Example:
         ```python
@@ -67,17 +133,173 @@ def safe_move_and_rename_file(from_path: str, to_path: str, duplicate_count: int
         move("a.txt", "b.txt") -> "a.txt" -> "b_2.txt"
         move("a.txt", "b.txt") -> "a.txt" -> "b_3.txt"
         ```
+
+    Returns:
+        str: The path the file was moved to.
     """
-    if duplicate_count:
-        basename, ext = os.path.splitext(to_path)
-        acting_to_path = f"{basename}_{duplicate_count+1}{ext}"
+    final_path, bytes_copied = move_file(from_path, to_path)
+    if bytes_copied:
+        logger.info(
+            f"Moved and renamed {repr(from_path)} to {repr(final_path)} "
+            f"({bytes_copied / 1e6:.0f} MB copied)"
+        )
     else:
-        acting_to_path = to_path
+        logger.info(f"Moved and renamed {repr(from_path)} to {repr(final_path)}")
+    return final_path
 
-    if os.path.exists(acting_to_path):
-        safe_move_and_rename_file(from_path, to_path, duplicate_count + 1)
-        return
 
-    shutil.copyfile(from_path, acting_to_path)
+def move_file(from_path: str, to_path: str):
+    """Move `from_path` to `to_path` without ever overwriting an existing file, see
+    `safe_move_and_rename_file`.
+
+    On the same filesystem the file is renamed and no data is copied. Across filesystems it is
+    copied in the kernel to a temporary file next to `to_path`, synced, and then renamed, so that
+    `to_path` never holds a partial file.
+
+    Returns:
+        tuple: The path the file was moved to, and the number of bytes copied.
+    """
+    to_dir = os.path.dirname(to_path) or "."
+    from_stat = os.stat(from_path)
+    if from_stat.st_dev == os.stat(to_dir).st_dev:
+        final_path = _claim_path(from_path, to_path)
+        _fsync_dir(to_dir)
+        metrics.moved_bytes.inc(from_stat.st_size, method="rename")
+        return final_path, 0
+
+    basename = os.path.basename(to_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{basename}.", suffix=".part", dir=to_dir)
+    start = time.perf_counter()
+    try:
+        with open(from_path, "rb") as src:
+            os.fchmod(fd, os.fstat(src.fileno()).st_mode & 0o777)
+            bytes_copied = copy_file_data(src.fileno(), fd)
+        os.fsync(fd)
+        os.close(fd)
+        fd = -1
+        final_path = _claim_path(tmp_path, to_path)
+    except BaseException:
+        if fd >= 0:
+            os.close(fd)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(to_dir)
     os.remove(from_path)
-    logger.info(f"Moved and renamed {repr(from_path)} to {repr(acting_to_path)}")
+    elapsed = time.perf_counter() - start
+    metrics.moved_bytes.inc(bytes_copied, method="copy")
+    if elapsed > 0:
+        metrics.copy_speed.observe(bytes_copied / 1e6 / elapsed)
+    return final_path, bytes_copied
+
+
+def copy_file_data(src_fd: int, dst_fd: int, chunk_size: int = 64 * 1024 * 1024):
+    """Copy the content of `src_fd` to `dst_fd` with copy_file_range, or sendfile if the kernel
+    does not support it between these files, so that the data does not go through user space. The
+    copy stops between chunks while admission control pauses the jobs.
+
+    Returns:
+        int: The number of bytes copied.
+    """
+    bytes_copied = 0
+    copy = _copy_file_range if hasattr(os, "copy_file_range") else _sendfile
+    while True:
+        try:
+            n = copy(src_fd, dst_fd, chunk_size)
+        except OSError as e:
+            if copy is _sendfile or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL):
+                raise
+            copy = _sendfile
+            continue
+        if n == 0:
+            return bytes_copied
+        bytes_copied += n
+        admission.wait()
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, count: int):
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+
+def _sendfile(src_fd: int, dst_fd: int, count: int):
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+def _claim_path(from_path: str, to_path: str):
+    """Atomically rename `from_path` to the first free name among `to_path`, `to_path` with "_2",
+    "_3", etc. `from_path` must be on the same filesystem as `to_path`.
+
+    Returns:
+        str: The claimed path.
+    """
+    basename, ext = os.path.splitext(to_path)
+    duplicate_count = 1
+    while True:
+        path = f"{basename}_{duplicate_count}{ext}" if duplicate_count > 1 else to_path
+        duplicate_count += 1
+        try:
+            # link fails if the name is taken, unlike rename which would overwrite it
+            os.link(from_path, path)
+        except FileExistsError:
+            continue
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK):
+                raise
+            # hard links are not supported, claim the name with a placeholder instead
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                continue
+            os.close(fd)
+            os.rename(from_path, path)
+            return path
+        os.remove(from_path)
+        return path
+
+
+def _fsync_dir(dir: str):
+    fd = os.open(dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def claim_file(file_path: str):
+    """Claim `file_path` for exclusive use across threads and processes, by holding an advisory
+    lock on `{file_path}.lock`. The lock is released if the holder crashes.
+
+    Example:
+        ```python
+        with claim_file("cache/a.mp4") as claimed:
+            if not claimed:
+                return
+            ...
+        ```
+
+    Yields:
+        bool: True if the file was claimed, False if it is claimed by someone else.
+    """
+    lock_path = f"{file_path}.lock"
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            yield False
+            return
+        # The previous holder may have removed the lock file between our open and flock
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    try:
+        yield True
+    finally:
+        os.remove(lock_path)
+        os.close(fd)
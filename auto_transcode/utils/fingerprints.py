@@ -0,0 +1,178 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+from auto_transcode.utils.db import get_connection
+from auto_transcode.utils.file import get_file_identity, sample_checksum
+from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.media_info import probe_media
+
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    root TEXT NOT NULL,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    room TEXT NOT NULL,
+    start REAL,
+    duration REAL NOT NULL,
+    checksum TEXT NOT NULL,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fingerprints_room ON fingerprints (room);
+"""
+
+# Fingerprints of files that are gone are kept this long, in seconds, to recognize late copies
+RETENTION_TIME = 30 * 86400
+# Blocks hashed at offsets spread across the file
+FINGERPRINT_SAMPLES = 8
+
+
+class Fingerprint:
+    __slots__ = ("path", "root", "size", "room", "start", "duration", "checksum")
+
+    def __init__(
+        self,
+        path: str,
+        root: str,
+        size: int,
+        room: str,
+        start: float | None,
+        duration: float,
+        checksum: str,
+    ):
+        self.path = path
+        # the watched directory the file was found in
+        self.root = root
+        self.size = size
+        self.room = room
+        # recording start time as a timestamp, None if the file has no recording time
+        self.start = start
+        self.duration = duration
+        # sampled checksum of the content, duration and start time
+        self.checksum = checksum
+
+    @property
+    def end(self):
+        assert self.start is not None
+        return self.start + self.duration
+
+    def covers(self, other: "Fingerprint", tolerance: float):
+        """Whether `other` is a copy of this recording, or of a part of it, written by another
+        recorder. Byte-identical copies match wherever they are.
+
+        Parameters:
+        - tolerance: In seconds. How much earlier or later than this recording the copy may start
+        and end.
+        """
+        if self.checksum == other.checksum:
+            return True
+        if self.room != other.room or self.root == other.root:
+            return False
+        if self.start is None or other.start is None:
+            return False
+        return self.start - tolerance <= other.start and other.end <= self.end + tolerance
+
+
+class FingerprintIndex:
+    """Persistent index of cheap fingerprints of the recordings, by file identity, so that each
+    version of a file is only fingerprinted once. A fingerprint reads a few blocks of the file and
+    the probe result, which is cached as well, and never the whole file.
+    """
+
+    def __init__(self):
+        self.prune()
+
+    def connection(self):
+        return get_connection("fingerprints", SCHEMA)
+
+    def prune(self):
+        try:
+            conn = self.connection()
+            rows = conn.execute(
+                "SELECT path FROM fingerprints WHERE seen_at<?", (time.time() - RETENTION_TIME,)
+            ).fetchall()
+            conn.executemany(
+                "DELETE FROM fingerprints WHERE path=?",
+                [(path,) for (path,) in rows if not os.path.exists(path)],
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Fingerprint pruning failed: {repr(e)}")
+
+    def get(self, path: str, root: str):
+        """Get the fingerprint of the file, computing it if the file changed since it was indexed.
+
+        Parameters:
+        - root: The watched directory the file was found in
+
+        Returns:
+            Fingerprint: The fingerprint.
+            None: The file is gone or cannot be probed.
+        """
+        identity = get_file_identity(path)
+        if identity is None:
+            return
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT dev, ino, size, mtime_ns, room, start, duration, checksum FROM fingerprints "
+            "WHERE path=?",
+            (path,),
+        ).fetchone()
+        if row is not None and tuple(row[:4]) == identity:
+            conn.execute("UPDATE fingerprints SET seen_at=? WHERE path=?", (time.time(), path))
+            return Fingerprint(path, root, identity[2], *row[4:])
+
+        info = probe_media(path)
+        if info is None:
+            return
+        start = info.record_time.timestamp() if info.record_time is not None else None
+        h = hashlib.blake2b(digest_size=16)
+        h.update(sample_checksum(path, samples=FINGERPRINT_SAMPLES).encode())
+        h.update(f"{info.duration:.1f}:{start}".encode())
+        fingerprint = Fingerprint(
+            path, root, identity[2], get_room(path), start, info.duration, h.hexdigest()
+        )
+        # Do not index the file if it was modified while being fingerprinted
+        if get_file_identity(path) == identity:
+            conn.execute(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    root,
+                    *identity,
+                    fingerprint.room,
+                    start,
+                    info.duration,
+                    fingerprint.checksum,
+                    time.time(),
+                ),
+            )
+        return fingerprint
+
+    def room(self, room: str):
+        """Get the indexed fingerprints of the recordings of the room, including the ones of files
+        already processed or removed.
+        """
+        rows = self.connection().execute(
+            "SELECT path, root, size, room, start, duration, checksum FROM fingerprints "
+            "WHERE room=?",
+            (room,),
+        )
+        return [Fingerprint(*row) for row in rows]
+
+    def forget(self, path: str):
+        self.connection().execute("DELETE FROM fingerprints WHERE path=?", (path,))
+
+
+def get_room(path: str):
+    """Get the room id from the name of a recording, see `RemuxProcess.get_new_basename`."""
+    basename, _ = os.path.splitext(os.path.basename(path))
+    if basename.startswith("录制"):
+        return basename.split("-", 2)[1]
+    return basename.split("_", 1)[0]
@@ -0,0 +1,173 @@
+import bisect
+import os
+
+import ffmpeg
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.engine import run_ffmpeg
+from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.media_info import RECORD_TIME_PREFIX, MediaInfo
+
+
+logger = get_logger(__name__)
+
+# Longest keyframe interval in seconds of a live stream. Joining a fragment at a point that is not
+# a keyframe keeps the packets from the keyframe before it.
+MAX_KEYFRAME_INTERVAL = 10
+
+
+class Fragment:
+    """A recording of a room, as an interval of time."""
+
+    __slots__ = ("path", "room", "start", "duration", "info")
+
+    def __init__(self, path: str, room: str, start: float, info: MediaInfo):
+        self.path = path
+        self.room = room
+        # recording start time as a timestamp
+        self.start = start
+        self.duration = info.duration
+        self.info = info
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    def joinable(self, other: "Fragment"):
+        """Whether the streams of both fragments can be joined without re-encoding."""
+        return (
+            self.info.codecs == other.info.codecs and self.info.resolution == other.info.resolution
+        )
+
+
+class Part:
+    """A fragment placed in the joined video."""
+
+    __slots__ = ("fragment", "inpoint", "offset")
+
+    def __init__(self, fragment: Fragment, inpoint: float, offset: float):
+        self.fragment = fragment
+        # time in seconds the fragment is cut at, where it stops overlapping the previous ones
+        self.inpoint = inpoint
+        # time in seconds the fragment starts at in the joined video
+        self.offset = offset
+
+
+class FragmentIndex:
+    """Interval index of the recordings of each room, by recording start time and duration.
+
+    When the connection to the stream drops, the recorder splits a broadcast into several files,
+    which may overlap when it reconnects before noticing the drop. Fragments that overlap, or that
+    are at most `gap` seconds apart, and whose streams match, are grouped into one broadcast.
+    """
+
+    def __init__(self, gap: float):
+        self.gap = gap
+        self.rooms: dict[str, list[Fragment]] = {}
+
+    def add(self, path: str, info: MediaInfo):
+        """Add the recording to the index.
+
+        Returns:
+            Fragment: The fragment.
+            None: The recording has no recording time and cannot be placed.
+        """
+        if info.record_time is None:
+            return
+        room = os.path.basename(path).split("_", 1)[0]
+        fragment = Fragment(path, room, info.record_time.timestamp(), info)
+        # the longest of the fragments starting at the same time first
+        bisect.insort(
+            self.rooms.setdefault(room, []), fragment, key=lambda f: (f.start, -f.duration)
+        )
+        return fragment
+
+    def groups(self):
+        """Group the fragments of each room into broadcasts.
+
+        Returns:
+            list: The groups, each a list of fragments sorted by start time.
+        """
+        groups = []
+        for fragments in self.rooms.values():
+            group = [fragments[0]]
+            end = fragments[0].end
+            for fragment in fragments[1:]:
+                if fragment.start <= end + self.gap and group[0].joinable(fragment):
+                    group.append(fragment)
+                    end = max(end, fragment.end)
+                else:
+                    groups.append(group)
+                    group = [fragment]
+                    end = fragment.end
+            groups.append(group)
+        return groups
+
+
+def place_fragments(group: list[Fragment]):
+    """Place the fragments of a broadcast one after the other in the joined video. A fragment that
+    overlaps the previous ones is cut where the overlap ends, and one they cover entirely is left
+    out.
+
+    Returns:
+        tuple: The parts of the joined video, and the fragments left out.
+    """
+    parts = []
+    covered = []
+    end = None
+    offset = 0.0
+    for fragment in group:
+        inpoint = 0.0 if end is None else max(0.0, end - fragment.start)
+        if inpoint >= fragment.duration:
+            covered.append(fragment)
+            continue
+        parts.append(Part(fragment, inpoint, offset))
+        offset += fragment.duration - inpoint
+        end = fragment.end if end is None else max(end, fragment.end)
+    return parts, covered
+
+
+def concat_fragments(parts: list[Part], target_path: str):
+    """Join the parts into `target_path` with the concat demuxer, without re-encoding. The joined
+    video has the recording time of the first part. The target is removed if ffmpeg fails.
+    """
+    list_path = f"{target_path}.ffconcat"
+    with open(list_path, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for part in parts:
+            path = os.path.abspath(part.fragment.path).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+            if part.inpoint:
+                f.write(f"inpoint {part.inpoint:.3f}\n")
+
+    record_time = parts[0].fragment.info.record_time
+    assert record_time is not None
+    try:
+        run_ffmpeg(
+            ffmpeg.input(list_path, f="concat", safe=0).output(
+                target_path,
+                c="copy",
+                map=0,
+                metadata=f"comment={RECORD_TIME_PREFIX}{record_time.isoformat()}",
+            ),
+            timeout=Settings.REMUX_TIMEOUT,
+        )
+    except ffmpeg.Error as e:
+        logger.error(f"Failed to join {len(parts)} fragments into {repr(target_path)}")
+        logger.error(f"stderr: {e.stderr.decode('utf8', errors='replace')}")
+        if os.path.exists(target_path):
+            os.remove(target_path)
+    finally:
+        os.remove(list_path)
+
+
+def expected_duration(parts: list[Part]):
+    """The duration range in seconds of the joined video. Each cut may keep up to a keyframe
+    interval more.
+
+    Returns:
+        tuple: The shortest and the longest expected duration.
+    """
+    duration = sum(part.fragment.duration - part.inpoint for part in parts)
+    cuts = sum(1 for part in parts if part.inpoint)
+    return duration - 1, duration + 1 + cuts * MAX_KEYFRAME_INTERVAL
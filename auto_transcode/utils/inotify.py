@@ -0,0 +1,90 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        _libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(_libc, "inotify_init1"):
+            raise OSError("inotify is not supported")
+    return _libc
+
+
+class Inotify:
+    """Minimal non-blocking wrapper of the Linux inotify API."""
+
+    def __init__(self):
+        self.libc = _get_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: str, mask: int):
+        """Watch `path` for the events in `mask`.
+
+        Returns:
+            int: The watch descriptor.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Read all pending events without blocking.
+
+        Returns:
+            list: (wd, mask, cookie, name) tuples. `name` is empty for events on the watched
+            directory itself.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
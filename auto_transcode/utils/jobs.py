@@ -0,0 +1,212 @@
+import collections
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from auto_transcode.utils.progress import get_out_time, get_total_size
+
+
+# Number of finished jobs kept for the API
+FINISHED_JOBS = 50
+
+
+class RunProgress:
+    """Latest progress of one ffmpeg process of a job."""
+
+    __slots__ = ("out_time", "fps", "speed", "total_size")
+
+    def __init__(self):
+        self.out_time = 0.0
+        self.fps = 0.0
+        self.speed = 0.0
+        self.total_size = 0
+
+
+class JobStatus:
+    """State of a remux or transcode job. The progress adds up over the ffmpeg processes of the
+    current stage, e.g. the segments encoded in parallel in chunked mode.
+    """
+
+    __slots__ = (
+        "id",
+        "kind",
+        "source",
+        "state",
+        "stage",
+        "duration",
+        "started_at",
+        "stage_started_at",
+        "updated_at",
+        "runs",
+    )
+
+    def __init__(self, id: int, kind: str, source: str):
+        self.id = id
+        self.kind = kind
+        self.source = source
+        # running, done or failed
+        self.state = "running"
+        self.stage = "starting"
+        # duration of the video processed in the current stage, None if unknown
+        self.duration: float | None = None
+        self.started_at = self.stage_started_at = self.updated_at = time.time()
+        self.runs: dict[int, RunProgress] = {}
+
+    def to_dict(self):
+        out_time = sum(run.out_time for run in self.runs.values())
+        speed = sum(run.speed for run in self.runs.values())
+        percent = eta = None
+        if self.duration:
+            percent = min(100.0, out_time / self.duration * 100)
+            if speed and self.state == "running":
+                eta = max(0.0, (self.duration - out_time) / speed)
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "source": self.source,
+            "state": self.state,
+            "stage": self.stage,
+            "started_at": self.started_at,
+            "stage_started_at": self.stage_started_at,
+            "updated_at": self.updated_at,
+            "duration": self.duration,
+            "out_time": out_time,
+            "percent": percent,
+            "eta": eta,
+            "fps": sum(run.fps for run in self.runs.values()),
+            "speed": speed,
+            "total_size": sum(run.total_size for run in self.runs.values()),
+        }
+
+
+class JobRegistry:
+    """Registry of the running and recently finished jobs, shared by the worker threads and read by
+    the API. The worker thread running a job sees it as the current job, so that stages and ffmpeg
+    progress are attached to it without passing it around.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.running: dict[int, JobStatus] = {}
+        self.finished: collections.deque[JobStatus] = collections.deque(maxlen=FINISHED_JOBS)
+        self.local = threading.local()
+        # incremented on every change, so that readers can tell if anything changed
+        self.version = 0
+
+    def start(self, kind: str, source: str):
+        """Register a running job, which is finished with `finish`."""
+        with self.lock:
+            status = JobStatus(next(self.ids), kind, source)
+            self.running[status.id] = status
+            self.version += 1
+        return status
+
+    @contextmanager
+    def track(self, kind: str, source: str):
+        """Register a job for the `with` block, as the current job of the thread."""
+        status = self.start(kind, source)
+        self.local.status = status
+        try:
+            yield status
+        except BaseException:
+            self.finish(status, "failed")
+            raise
+        else:
+            self.finish(status, "done")
+        finally:
+            self.local.status = None
+
+    @contextmanager
+    def attach(self, status: JobStatus | None):
+        """Make `status` the current job of a helper thread for the `with` block."""
+        self.local.status = status
+        try:
+            yield
+        finally:
+            self.local.status = None
+
+    def finish(self, status: JobStatus, state: str):
+        with self.lock:
+            status.state = state
+            status.updated_at = time.time()
+            self.running.pop(status.id, None)
+            self.finished.append(status)
+            self.version += 1
+
+    def current(self) -> JobStatus | None:
+        return getattr(self.local, "status", None)
+
+    def set_stage(self, stage: str, duration: float | None = None):
+        """Set the stage of the current job, if any.
+
+        Parameters:
+        - duration: The duration of the video processed by the stage, to compute the percent
+        complete and the ETA
+        """
+        status = self.current()
+        if status is None:
+            return
+        with self.lock:
+            status.stage = stage
+            status.duration = duration
+            status.stage_started_at = status.updated_at = time.time()
+            status.runs = {}
+            self.version += 1
+
+    def update(self, status: JobStatus, run_id: int, block: dict[str, str]):
+        """Update the job with a block of `ffmpeg -progress` output of one of its processes."""
+        with self.lock:
+            run = status.runs.get(run_id)
+            if run is None:
+                run = status.runs[run_id] = RunProgress()
+            run.out_time = get_out_time(block) or run.out_time
+            run.total_size = get_total_size(block) or run.total_size
+            run.fps = parse_float(block.get("fps", "")) or 0.0
+            run.speed = parse_float(block.get("speed", "").rstrip("x")) or 0.0
+            if block.get("progress") == "end":
+                run.fps = run.speed = 0.0
+            status.updated_at = time.time()
+            self.version += 1
+
+    def report(self, status: JobStatus, progress: dict[str, float]):
+        """Update the job with the progress reported by a remote worker, see `JobStatus.to_dict`."""
+        with self.lock:
+            run = RunProgress()
+            run.out_time = progress.get("out_time") or 0.0
+            run.fps = progress.get("fps") or 0.0
+            run.speed = progress.get("speed") or 0.0
+            run.total_size = int(progress.get("total_size") or 0)
+            status.runs = {0: run}
+            status.updated_at = time.time()
+            self.version += 1
+
+    def get(self, job_id: int):
+        """Get a snapshot of the job.
+
+        Returns:
+            dict: The job.
+            None: Unknown job.
+        """
+        with self.lock:
+            status = self.running.get(job_id)
+            if status is None:
+                status = next((job for job in self.finished if job.id == job_id), None)
+            return status.to_dict() if status is not None else None
+
+    def snapshot(self):
+        """Get a snapshot of the running jobs, then of the finished jobs, most recent first."""
+        with self.lock:
+            jobs = list(self.running.values()) + list(reversed(self.finished))
+            return [status.to_dict() for status in jobs]
+
+
+def parse_float(value: str):
+    try:
+        return float(value)
+    except ValueError:
+        return
+
+
+registry = JobRegistry()
@@ -0,0 +1,179 @@
+import json
+import os
+import sqlite3
+import time
+from typing import Any
+
+from auto_transcode.utils.db import get_connection, transaction
+from auto_transcode.utils.file import get_file_identity, sample_checksum
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    name TEXT NOT NULL,
+    source TEXT NOT NULL,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    output TEXT,
+    checksum TEXT,
+    details TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (name, source)
+);
+CREATE INDEX IF NOT EXISTS journal_updated_at ON journal (updated_at);
+"""
+
+# Entries of deleted sources are kept this long, in seconds
+RETENTION_TIME = 30 * 86400
+
+# States of a source file, in order. "remuxing" and "transcoding" are recorded before the output is
+# written, the following states carry the output path and its checksum.
+STATES = [
+    "discovered",
+    "remuxing",
+    "remuxed",
+    "transcoding",
+    "transcoded",
+    "moved",
+    "source_deleted",
+]
+
+
+class JournalEntry:
+    __slots__ = ("source", "state", "output", "checksum", "details")
+
+    def __init__(
+        self,
+        source: str,
+        state: str,
+        output: str | None,
+        checksum: str | None,
+        details: dict[str, Any],
+    ):
+        self.source = source
+        self.state = state
+        self.output = output
+        # sampled checksum of the output when it reached this state
+        self.checksum = checksum
+        # what is needed to resume, e.g. the destination directory and basename
+        self.details = details
+
+
+class Journal:
+    """Write-ahead journal of the state of each source file, so that a restart resumes at the step
+    where it stopped without probing the files again.
+
+    A state is recorded after the step that reaches it is done and synced. On resume the output of
+    the entry is trusted only if its checksum still matches.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.prune()
+
+    def connection(self):
+        return get_connection("journal", SCHEMA)
+
+    def prune(self):
+        try:
+            self.connection().execute(
+                "DELETE FROM journal WHERE name=? AND state='source_deleted' AND updated_at<?",
+                (self.name, time.time() - RETENTION_TIME),
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Journal pruning failed: {repr(e)}")
+
+    def get(self, source: str):
+        """Get the entry of the source file. Entries of a previous file at the same path are
+        dropped.
+
+        Returns:
+            JournalEntry: The entry.
+            None: The source is not in the journal.
+        """
+        conn = self.connection()
+        row = conn.execute(
+            "SELECT dev, ino, size, mtime_ns, state, output, checksum, details FROM journal "
+            "WHERE name=? AND source=?",
+            (self.name, source),
+        ).fetchone()
+        if row is None:
+            return
+        identity = get_file_identity(source)
+        if identity is not None and identity != tuple(row[:4]):
+            logger.info(f"{repr(source)} changed since it was journaled")
+            self.forget(source)
+            return
+        state, output, checksum, details = row[4:]
+        return JournalEntry(source, state, output, checksum, json.loads(details))
+
+    def discover(self, source: str):
+        """Record the source file as discovered, unless it is already in the journal."""
+        identity = get_file_identity(source)
+        if identity is None:
+            return
+        self.connection().execute(
+            "INSERT OR IGNORE INTO journal VALUES (?, ?, ?, ?, ?, ?, 'discovered', NULL, NULL, "
+            "'{}', ?)",
+            (self.name, source, *identity, time.time()),
+        )
+
+    def record(
+        self,
+        source: str,
+        state: str,
+        output: str | None = None,
+        checksum: str | None = None,
+        details: dict[str, Any] | None = None,
+    ):
+        """Record that the source file reached `state`. The checksum of the output is computed if
+        it is not given.
+
+        Returns:
+            JournalEntry: The recorded entry.
+        """
+        assert state in STATES
+        if output is not None and checksum is None:
+            checksum = sample_checksum(output)
+        details = details or {}
+        conn = self.connection()
+        with transaction(conn):
+            identity = get_file_identity(source)
+            if identity is None:
+                # The source is gone, keep the identity it was journaled with
+                identity = conn.execute(
+                    "SELECT dev, ino, size, mtime_ns FROM journal WHERE name=? AND source=?",
+                    (self.name, source),
+                ).fetchone() or (0, 0, 0, 0)
+            conn.execute(
+                "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.name,
+                    source,
+                    *identity,
+                    state,
+                    output,
+                    checksum,
+                    json.dumps(details),
+                    time.time(),
+                ),
+            )
+        return JournalEntry(source, state, output, checksum, details)
+
+    def forget(self, source: str):
+        """Drop the entry, the source file will be processed from scratch."""
+        self.connection().execute(
+            "DELETE FROM journal WHERE name=? AND source=?", (self.name, source)
+        )
+
+    def verify(self, entry: JournalEntry):
+        """Whether the output of the entry is still the one that was journaled."""
+        if entry.output is None or entry.checksum is None or not os.path.exists(entry.output):
+            return False
+        return sample_checksum(entry.output) == entry.checksum
@@ -0,0 +1,117 @@
+import secrets
+import threading
+import time
+from contextlib import ExitStack
+
+from auto_transcode.utils.jobs import JobStatus
+
+
+class Lease:
+    """A transcode job handed out to a remote worker until `expires_at`, unless it is renewed."""
+
+    __slots__ = ("id", "source", "worker", "duration", "status", "claim", "expires_at")
+
+    def __init__(
+        self,
+        source: str,
+        worker: str,
+        duration: float,
+        status: JobStatus,
+        claim: ExitStack,
+        lease_time: float,
+    ):
+        # unguessable, so that only the worker holding the lease can act on it
+        self.id = secrets.token_hex(16)
+        self.source = source
+        self.worker = worker
+        self.duration = duration
+        # the job in the job registry
+        self.status = status
+        # holds the claim of the source until the lease ends
+        self.claim = claim
+        self.expires_at = time.time() + lease_time
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "source": self.source,
+            "worker": self.worker,
+            "duration": self.duration,
+            "job_id": self.status.id,
+            "expires_at": self.expires_at,
+        }
+
+
+class LeaseTable:
+    """The leases of the remote workers. Leases live in memory only: after a restart of the
+    coordinator the workers lose their leases, and the jobs are still in the persistent queue of
+    the scheduler.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.leases: dict[str, Lease] = {}
+
+    def add(self, lease: Lease):
+        with self.lock:
+            self.leases[lease.id] = lease
+
+    def get(self, lease_id: str):
+        """Get the lease if it has not expired.
+
+        Returns:
+            Lease: The lease.
+            None: Unknown or expired lease.
+        """
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None or lease.expires_at < time.time():
+                return
+            return lease
+
+    def renew(self, lease_id: str, lease_time: float):
+        """Extend the lease by `lease_time` seconds from now, unless it has expired.
+
+        Returns:
+            Lease: The renewed lease.
+            None: Unknown or expired lease.
+        """
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None or lease.expires_at < time.time():
+                return
+            lease.expires_at = time.time() + lease_time
+            return lease
+
+    def remove(self, lease_id: str):
+        """End the lease before it expires, e.g. when the worker returns the result.
+
+        Returns:
+            Lease: The removed lease.
+            None: Unknown or expired lease, which is left for `expired` to collect.
+        """
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None or lease.expires_at < time.time():
+                return
+            return self.leases.pop(lease_id)
+
+    def expired(self):
+        """Remove and get the expired leases."""
+        now = time.time()
+        with self.lock:
+            expired = [lease for lease in self.leases.values() if lease.expires_at < now]
+            for lease in expired:
+                del self.leases[lease.id]
+        return expired
+
+    def count(self):
+        with self.lock:
+            return len(self.leases)
+
+    def snapshot(self):
+        with self.lock:
+            return [lease.to_dict() for lease in self.leases.values()]
+
+
+leases = LeaseTable()
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from auto_transcode.utils.file import get_video_metadata
+
+
+RECORD_TIME_PREFIX = "录制时间: "
+
+
+class MediaInfo:
+    """The parts of the probe result used by the processes, read from a single probe."""
+
+    __slots__ = ("duration", "codecs", "bit_rate", "record_time", "resolution")
+
+    def __init__(
+        self,
+        duration: float,
+        codecs: tuple[tuple[str, str], ...],
+        bit_rate: int | None,
+        record_time: datetime | None,
+        resolution: tuple[int, int] | None = None,
+    ):
+        self.duration = duration
+        # (codec_type, codec_name) of each stream, in order
+        self.codecs = codecs
+        # overall bitrate in bits per second
+        self.bit_rate = bit_rate
+        # recording start time from the comment tag, in the recorder's time zone
+        self.record_time = record_time
+        # (width, height) of the first video stream, None if the probe did not report it
+        self.resolution = resolution
+
+    @classmethod
+    def from_metadata(cls, metadata: dict[str, Any]):
+        format = metadata["format"]
+        bit_rate = format.get("bit_rate")
+        return cls(
+            duration=float(format["duration"]),
+            codecs=tuple(
+                (stream["codec_type"], stream.get("codec_name", ""))
+                for stream in metadata["streams"]
+            ),
+            bit_rate=int(bit_rate) if bit_rate else None,
+            record_time=parse_record_time(format.get("tags", {}).get("comment", "")),
+            resolution=next(
+                (
+                    (int(stream["width"]), int(stream["height"]))
+                    for stream in metadata["streams"]
+                    if stream["codec_type"] == "video" and "width" in stream
+                ),
+                None,
+            ),
+        )
+
+    @property
+    def video_codec(self):
+        """The codec name of the first video stream, None if there is no video stream."""
+        for codec_type, codec_name in self.codecs:
+            if codec_type == "video":
+                return codec_name
+
+
+def parse_record_time(comment: str):
+    """Parse the recording start time written by the recorder in the comment tag, e.g.
+    "录制时间: 2023-01-01T20:00:00.1234567-08:00".
+
+    Returns:
+        datetime: The recording start time, with its time zone.
+        None: The comment has no recording time.
+    """
+    if RECORD_TIME_PREFIX not in comment:
+        return
+    record_time_str = comment.split(RECORD_TIME_PREFIX)[1].split("\n")[0].strip()
+    try:
+        record_time = datetime.strptime(
+            f"{record_time_str[:10]} {record_time_str[11:19]}", "%Y-%m-%d %H:%M:%S"
+        )
+        sign = -1 if record_time_str[-6] == "-" else 1
+        hours, minutes = record_time_str[-5:].split(":")
+        offset = timedelta(hours=int(hours), minutes=int(minutes))
+    except (ValueError, IndexError):
+        return
+    return record_time.replace(tzinfo=timezone(sign * offset))
+
+
+def probe_media(file_path: str):
+    """Probe the video file once and keep what the processes need.
+
+    Returns:
+        MediaInfo: The media info of the video file.
+        None: Failed to probe the file.
+    """
+    metadata = get_video_metadata(file_path)
+    if metadata is None:
+        return
+    try:
+        return MediaInfo.from_metadata(metadata)
+    except (KeyError, ValueError):
+        return
@@ -0,0 +1,226 @@
+import threading
+from typing import Callable, Iterable
+
+
+# Label values of a sample, in the order of the label names of the metric
+Labels = tuple[str, ...]
+
+
+class Metric:
+    """Base of the metrics. Samples are recorded without locking into a shard owned by the recording
+    thread, and the shards are only added up when the metrics are rendered.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.local = threading.local()
+        self.shards: list[dict] = []
+        self.shards_lock = threading.Lock()
+        registry.register(self)
+
+    def shard(self) -> dict:
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            # only taken once per thread
+            with self.shards_lock:
+                self.shards.append(shard)
+        return shard
+
+    def labels(self, labels: dict[str, str]) -> Labels:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def format_labels(self, labels: Labels, extra: dict[str, str] | None = None):
+        pairs = list(zip(self.labelnames, labels)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        escaped = (
+            (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in pairs
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        return lines + self.render_samples()
+
+    def render_samples(self) -> list[str]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        shard = self.shard()
+        key = self.labels(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def values(self):
+        totals: dict[Labels, float] = {}
+        with self.shards_lock:
+            shards = list(self.shards)
+        for shard in shards:
+            # copying a dict does not release the GIL, the owning thread cannot resize it meanwhile
+            for key, value in dict(shard).items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render_samples(self):
+        return [
+            f"{self.name}{self.format_labels(key)} {value}" for key, value in self.values().items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, help: str, buckets: Iterable[float], labelnames: Iterable[str] = ()
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value: float, **labels: str):
+        shard = self.shard()
+        key = self.labels(labels)
+        # bucket counts, then the sum and the count
+        series = shard.get(key)
+        if series is None:
+            series = shard[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def values(self):
+        totals: dict[Labels, list[float]] = {}
+        with self.shards_lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for key, series in dict(shard).items():
+                total = totals.setdefault(key, [0] * (len(self.buckets) + 2))
+                for i, value in enumerate(list(series)):
+                    total[i] += value
+        return totals
+
+    def render_samples(self):
+        lines = []
+        for key, series in self.values().items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{self.format_labels(key, {'le': str(bound)})} {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_bucket{self.format_labels(key, {'le': '+Inf'})} {series[-1]}"
+            )
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Gauge(Metric):
+    """A value read from a function when the metrics are rendered, e.g. a queue length."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.functions: dict[Labels, Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels: str):
+        with self.shards_lock:
+            self.functions[self.labels(labels)] = function
+
+    def render_samples(self):
+        with self.shards_lock:
+            functions = list(self.functions.items())
+        return [f"{self.name}{self.format_labels(key)} {function()}" for key, function in functions]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """Render all the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+SPEED_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 500, 1000, 2000)
+
+scan_duration = Histogram(
+    "auto_transcode_scan_duration_seconds",
+    "Time spent finding the due files of a watched directory",
+    SECONDS_BUCKETS,
+    ["process", "watcher"],
+)
+scan_files_visited = Counter(
+    "auto_transcode_scan_files_visited_total",
+    "Directory entries or candidate files visited while finding the due files",
+    ["process", "watcher"],
+)
+probes = Counter(
+    "auto_transcode_probes_total",
+    "Video probes, by source: cache, native or ffprobe",
+    ["source"],
+)
+probe_duration = Histogram(
+    "auto_transcode_probe_duration_seconds",
+    "Time spent probing a video",
+    SECONDS_BUCKETS,
+    ["source"],
+)
+remux_speed = Histogram(
+    "auto_transcode_remux_speed_megabytes_per_second",
+    "Size of the flv file divided by the remux time",
+    SPEED_BUCKETS,
+)
+copy_speed = Histogram(
+    "auto_transcode_copy_speed_megabytes_per_second",
+    "Speed of the copies between filesystems",
+    SPEED_BUCKETS,
+)
+moved_bytes = Counter(
+    "auto_transcode_moved_bytes_total",
+    "Bytes moved by renaming or copying",
+    ["method"],
+)
+encode_realtime_factor = Histogram(
+    "auto_transcode_encode_realtime_factor",
+    "Video duration divided by the encode time",
+    (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64),
+    ["backend"],
+)
+compression_ratio = Histogram(
+    "auto_transcode_compression_ratio",
+    "Size of the transcoded video divided by the size of the source",
+    (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.5),
+    ["backend"],
+)
+queue_depth = Gauge(
+    "auto_transcode_queue_depth",
+    "Jobs waiting for a worker",
+    ["process"],
+)
+admission_state = Gauge(
+    "auto_transcode_admission_state",
+    "Admission of the jobs: 0 run, 1 throttled while recording, 2 paused while recording",
+)
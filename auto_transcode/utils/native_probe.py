@@ -0,0 +1,307 @@
+import os
+import struct
+from typing import Any, BinaryIO
+
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+# Bytes read at most while looking for the codecs in the first flv tags
+FLV_SCAN_LIMIT = 1024 * 1024
+# Largest moov box that is parsed, bigger ones are left to ffprobe
+MP4_MOOV_LIMIT = 64 * 1024 * 1024
+
+FLV_VIDEO_CODECS = {2: "flv1", 4: "vp6f", 5: "vp6a", 7: "h264", 12: "hevc"}
+FLV_AUDIO_CODECS = {2: "mp3", 10: "aac", 11: "speex", 14: "mp3"}
+MP4_CODECS = {
+    b"avc1": "h264",
+    b"avc3": "h264",
+    b"hev1": "hevc",
+    b"hvc1": "hevc",
+    b"av01": "av1",
+    b"vp09": "vp9",
+    b"mp4a": "aac",
+    b"Opus": "opus",
+    b"fLaC": "flac",
+    b".mp3": "mp3",
+}
+MP4_HANDLERS = {b"vide": "video", b"soun": "audio"}
+MP4_TAGS = {
+    b"\xa9cmt": "comment",
+    b"\xa9nam": "title",
+    b"\xa9ART": "artist",
+    b"\xa9day": "date",
+    b"\xa9too": "encoder",
+    b"desc": "description",
+}
+
+
+class ParseError(Exception):
+    pass
+
+
+def native_probe(file_path: str):
+    """Read the duration, codecs and format tags from the flv or mp4 headers, without starting an
+    ffprobe subprocess. The result has the same layout as the subset of `ffmpeg.probe` used by this
+    project.
+
+    Returns:
+        dict: The metadata of the video file.
+        None: The file could not be parsed, ffprobe should be used instead.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            signature = f.read(8)
+            f.seek(0)
+            if signature[:3] == b"FLV":
+                format_name, duration, tags, streams = parse_flv(f)
+            elif signature[4:8] in (b"ftyp", b"moov", b"free", b"mdat", b"wide"):
+                format_name, duration, tags, streams = parse_mp4(f)
+            else:
+                return
+            size = os.fstat(f.fileno()).st_size
+    except (OSError, ParseError, struct.error, UnicodeDecodeError) as e:
+        logger.debug(f"Native probe failed for {repr(file_path)}: {repr(e)}")
+        return
+
+    if not duration or not any(stream["codec_type"] == "video" for stream in streams):
+        return
+    return {
+        "format": {
+            "format_name": format_name,
+            "duration": f"{duration:.6f}",
+            "size": str(size),
+            "bit_rate": str(int(size * 8 / duration)),
+            "tags": tags,
+        },
+        "streams": streams,
+    }
+
+
+def parse_flv(f: BinaryIO):
+    header = f.read(9)
+    if len(header) < 9:
+        raise ParseError("Truncated flv header")
+    f.seek(struct.unpack(">I", header[5:9])[0])
+
+    duration = None
+    tags: dict[str, str] = {}
+    video_codec = audio_codec = None
+    metadata_video_codec = metadata_audio_codec = None
+    width = height = None
+    scanned = 0
+    while scanned < FLV_SCAN_LIMIT and (video_codec is None or audio_codec is None):
+        # previous tag size, then the tag header
+        tag_header = f.read(15)
+        if len(tag_header) < 15:
+            break
+        tag_type = tag_header[4] & 0x1F
+        data_size = int.from_bytes(tag_header[5:8], "big")
+        scanned += 15 + data_size
+        if tag_type == 18 and duration is None:
+            data = f.read(data_size)
+            name, offset = read_amf(data, 0)
+            if name == "onMetaData":
+                metadata, _ = read_amf(data, offset)
+                if isinstance(metadata, dict):
+                    duration = metadata.get("duration")
+                    metadata_video_codec = FLV_VIDEO_CODECS.get(metadata.get("videocodecid"))
+                    metadata_audio_codec = FLV_AUDIO_CODECS.get(metadata.get("audiocodecid"))
+                    width, height = metadata.get("width"), metadata.get("height")
+                    for key, value in metadata.items():
+                        if isinstance(value, str):
+                            tags[key] = value
+            continue
+        if tag_type == 9 and video_codec is None and data_size:
+            video_codec = FLV_VIDEO_CODECS.get(f.read(1)[0] & 0x0F)
+            data_size -= 1
+        elif tag_type == 8 and audio_codec is None and data_size:
+            audio_codec = FLV_AUDIO_CODECS.get(f.read(1)[0] >> 4)
+            data_size -= 1
+        f.seek(data_size, os.SEEK_CUR)
+
+    streams = []
+    video_codec = video_codec or metadata_video_codec
+    audio_codec = audio_codec or metadata_audio_codec
+    if video_codec is not None:
+        stream: dict[str, Any] = {"codec_type": "video", "codec_name": video_codec}
+        if isinstance(width, (int, float)) and isinstance(height, (int, float)):
+            stream.update(width=int(width), height=int(height))
+        streams.append(stream)
+    if audio_codec is not None:
+        streams.append({"codec_type": "audio", "codec_name": audio_codec})
+    if not isinstance(duration, (int, float)):
+        duration = None
+    return "flv", duration, tags, streams
+
+
+def read_amf(data: bytes, offset: int) -> tuple[Any, int]:
+    """Read one AMF0 value.
+
+    Returns:
+        tuple: The value and the offset after it.
+    """
+    marker = data[offset]
+    offset += 1
+    if marker == 0x00:  # number
+        return struct.unpack_from(">d", data, offset)[0], offset + 8
+    if marker == 0x01:  # boolean
+        return bool(data[offset]), offset + 1
+    if marker == 0x02:  # string
+        length = struct.unpack_from(">H", data, offset)[0]
+        offset += 2
+        return data[offset : offset + length].decode("utf8"), offset + length
+    if marker == 0x0C:  # long string
+        length = struct.unpack_from(">I", data, offset)[0]
+        offset += 4
+        return data[offset : offset + length].decode("utf8"), offset + length
+    if marker in (0x03, 0x08):  # object, ecma array
+        if marker == 0x08:
+            offset += 4
+        obj = {}
+        while offset + 3 <= len(data):
+            length = struct.unpack_from(">H", data, offset)[0]
+            offset += 2
+            if length == 0 and data[offset] == 0x09:
+                return obj, offset + 1
+            key = data[offset : offset + length].decode("utf8")
+            obj[key], offset = read_amf(data, offset + length)
+        return obj, offset
+    if marker == 0x0A:  # strict array
+        count = struct.unpack_from(">I", data, offset)[0]
+        offset += 4
+        values = []
+        for _ in range(count):
+            value, offset = read_amf(data, offset)
+            values.append(value)
+        return values, offset
+    if marker == 0x0B:  # date
+        return struct.unpack_from(">d", data, offset)[0], offset + 10
+    if marker in (0x05, 0x06):  # null, undefined
+        return None, offset
+    raise ParseError(f"Unsupported AMF0 marker {marker}")
+
+
+def iter_boxes(data: bytes, start: int = 0, end: int | None = None):
+    """Iterate over the mp4 boxes in `data[start:end]`.
+
+    Yields:
+        tuple: The box type, and the start and end offsets of its payload.
+    """
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise ParseError(f"Invalid {box_type} box size")
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def find_box(data: bytes, start: int, end: int, *path: bytes):
+    """Find the payload of the first box at `path` below `data[start:end]`.
+
+    Returns:
+        tuple: The start and end offsets of the payload.
+        None: Not found.
+    """
+    for box_type, box_start, box_end in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return box_start, box_end
+            return find_box(data, box_start, box_end, *path[1:])
+
+
+def read_moov(f: BinaryIO):
+    """Read the moov box, which may be at the end of the file, skipping over the others."""
+    file_size = os.fstat(f.fileno()).st_size
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        header = f.read(16)
+        size, box_type = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header_size:
+            raise ParseError(f"Invalid {box_type} box size")
+        if box_type == b"moov":
+            if size > MP4_MOOV_LIMIT:
+                raise ParseError("moov box too large")
+            f.seek(offset + header_size)
+            return f.read(size - header_size)
+        offset += size
+    raise ParseError("moov box not found")
+
+
+def parse_mp4(f: BinaryIO):
+    moov = read_moov(f)
+
+    mvhd = find_box(moov, 0, len(moov), b"mvhd")
+    if mvhd is None:
+        raise ParseError("mvhd box not found")
+    version = moov[mvhd[0]]
+    if version == 1:
+        timescale, duration = struct.unpack_from(">IQ", moov, mvhd[0] + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", moov, mvhd[0] + 12)
+    if not timescale:
+        raise ParseError("Invalid timescale")
+
+    streams = []
+    for box_type, start, end in iter_boxes(moov):
+        if box_type != b"trak":
+            continue
+        hdlr = find_box(moov, start, end, b"mdia", b"hdlr")
+        stsd = find_box(moov, start, end, b"mdia", b"minf", b"stbl", b"stsd")
+        if hdlr is None or stsd is None:
+            continue
+        codec_type = MP4_HANDLERS.get(moov[hdlr[0] + 8 : hdlr[0] + 12])
+        # version and flags, entry count, then the size and format of the first entry
+        codec_tag = moov[stsd[0] + 12 : stsd[0] + 16]
+        if codec_type is None:
+            continue
+        codec_name = MP4_CODECS.get(codec_tag, codec_tag.decode("latin1").strip())
+        stream = {"codec_type": codec_type, "codec_name": codec_name}
+        if codec_type == "video" and stsd[0] + 44 <= stsd[1]:
+            # the visual sample entry has the width and height after 24 bytes of other fields
+            stream["width"], stream["height"] = struct.unpack_from(">HH", moov, stsd[0] + 40)
+        streams.append(stream)
+
+    return "mov,mp4,m4a,3gp,3g2,mj2", duration / timescale, parse_mp4_tags(moov), streams
+
+
+def parse_mp4_tags(moov: bytes):
+    tags: dict[str, str] = {}
+    udta = find_box(moov, 0, len(moov), b"udta")
+    if udta is None:
+        return tags
+
+    # iTunes style metadata, written by ffmpeg in mp4 mode
+    meta = find_box(moov, udta[0], udta[1], b"meta")
+    if meta is not None:
+        # meta is a full box, skip its version and flags
+        ilst = find_box(moov, meta[0] + 4, meta[1], b"ilst")
+        if ilst is not None:
+            for box_type, start, end in iter_boxes(moov, ilst[0], ilst[1]):
+                data = find_box(moov, start, end, b"data")
+                if box_type in MP4_TAGS and data is not None:
+                    # type indicator and locale precede the value
+                    tags[MP4_TAGS[box_type]] = moov[data[0] + 8 : data[1]].decode("utf8")
+
+    # QuickTime style metadata, a 16 bits length and language precede the value
+    for box_type, start, end in iter_boxes(moov, udta[0], udta[1]):
+        if box_type in MP4_TAGS and MP4_TAGS[box_type] not in tags and end - start >= 4:
+            length = struct.unpack_from(">H", moov, start)[0]
+            tags[MP4_TAGS[box_type]] = moov[start + 4 : start + 4 + length].decode("utf8")
+    return tags
@@ -0,0 +1,155 @@
+import os
+import time
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.db import get_connection, transaction
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+# Space in bytes left free on each cache filesystem on top of the reservations
+FREE_SPACE_MARGIN = 1024**3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reservations (
+    id INTEGER PRIMARY KEY,
+    dir TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    pid INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+class InsufficientSpace(Exception):
+    """Raised when no cache directory has enough free space for a job."""
+
+
+class Reservation:
+    """Space reserved in a cache directory for the output of a job. Released when the `with` block
+    exits.
+    """
+
+    __slots__ = ("placement", "id", "path", "size")
+
+    def __init__(self, placement: "CachePlacement", id: int, path: str, size: int):
+        self.placement = placement
+        self.id = id
+        self.path = path
+        self.size = size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.placement.release(self)
+
+
+class CachePlacement:
+    """Place the outputs of the jobs in the cache directories.
+
+    Each job reserves the expected size of its output before it starts. The directory with the
+    fewest jobs and the most free space after the pending reservations is picked, so that the
+    staging I/O is spread over CACHE_DIRS and no job runs out of space halfway. A reservation only
+    counts the part of the output that is not written yet.
+
+    Reservations are stored in CACHE_DIR, so that they are shared with other processes using the
+    same cache directories.
+    """
+
+    def connection(self):
+        return get_connection("placement", SCHEMA)
+
+    def cleanup(self):
+        """Drop the reservations of processes that are not running anymore, e.g. after a crash.
+        Called on startup, so the reservations with the pid of this process are stale as well.
+        """
+        conn = self.connection()
+        with transaction(conn):
+            rows = conn.execute("SELECT id, pid FROM reservations").fetchall()
+            stale = [(id,) for id, pid in rows if pid == os.getpid() or not is_running(pid)]
+            conn.executemany("DELETE FROM reservations WHERE id = ?", stale)
+        if stale:
+            logger.info(f"Dropped {len(stale)} stale cache reservations")
+
+    def find(self, filename: str):
+        """Get the path of `filename` in the first cache directory that has it.
+
+        Returns:
+            str: The path.
+            None: No cache directory has the file.
+        """
+        for dir in Settings.CACHE_DIRS:
+            path = os.path.join(dir, filename)
+            if os.path.exists(path):
+                return path
+
+    def reserve(self, filename: str, size: int):
+        """Reserve `size` bytes for `filename` in a cache directory. The directory already holding
+        `filename`, e.g. from an interrupted run, is preferred.
+
+        Raises:
+            InsufficientSpace: No cache directory can fit the file.
+        """
+        conn = self.connection()
+        with transaction(conn):
+            rows = conn.execute("SELECT dir, path, size FROM reservations").fetchall()
+            # pending bytes and jobs per filesystem
+            pending: dict[int, int] = {}
+            jobs: dict[int, int] = {}
+            for dir, path, reserved in rows:
+                try:
+                    device = os.stat(dir).st_dev
+                except FileNotFoundError:
+                    continue
+                pending[device] = pending.get(device, 0) + max(0, reserved - get_size(path))
+                jobs[device] = jobs.get(device, 0) + 1
+
+            candidates = []
+            for dir in Settings.CACHE_DIRS:
+                path = os.path.join(dir, filename)
+                stat = os.statvfs(dir)
+                device = os.stat(dir).st_dev
+                available = stat.f_bavail * stat.f_frsize - pending.get(device, 0)
+                if available - max(0, size - get_size(path)) < FREE_SPACE_MARGIN:
+                    continue
+                existing = os.path.exists(path)
+                candidates.append((not existing, jobs.get(device, 0), -available, dir))
+            if not candidates:
+                raise InsufficientSpace(
+                    f"No cache directory has {size / 1e9:.1f} GB free for {repr(filename)}"
+                )
+            dir = min(candidates)[-1]
+            path = os.path.join(dir, filename)
+            cursor = conn.execute(
+                "INSERT INTO reservations (dir, path, size, pid, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (dir, path, size, os.getpid(), time.time()),
+            )
+        assert cursor.lastrowid is not None
+        return Reservation(self, cursor.lastrowid, path, size)
+
+    def release(self, reservation: Reservation):
+        self.connection().execute("DELETE FROM reservations WHERE id = ?", (reservation.id,))
+
+
+def get_size(path: str):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def is_running(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+placement = CachePlacement()
@@ -0,0 +1,101 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Callable
+
+from auto_transcode.utils.admission import admission
+from auto_transcode.utils.failures import JobFailed
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class WorkerPool:
+    """Run jobs on a bounded number of worker threads. The heavy lifting is done by ffmpeg
+    subprocesses, so threads are enough to run several jobs at once.
+
+    Jobs are identified by a key, usually the source path, and a key is never queued twice. Each job
+    also holds a slot on the devices of the paths it reads and writes, so that no more than
+    `jobs_per_device` jobs hit the same disk at once.
+    """
+
+    def __init__(self, name: str, max_workers: int, jobs_per_device: int):
+        self.name = name
+        self.jobs_per_device = jobs_per_device
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.pending: set[str] = set()
+        self.running = 0
+        self.device_semaphores: dict[int, threading.BoundedSemaphore] = {}
+
+    def submit(self, key: str, fn: Callable[..., None], *args, devices: list[str] = []):
+        """Queue `fn(*args)` unless a job with the same `key` is queued or running.
+
+        Parameters:
+        - key: The job identifier
+        - fn: The job function
+        - devices: Paths whose devices the job reads from or writes to
+
+        Returns:
+            bool: True if the job was queued, otherwise False
+        """
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        self.executor.submit(self.run, key, fn, args, devices)
+        return True
+
+    def run(self, key: str, fn: Callable[..., None], args: tuple, devices: list[str]):
+        with self.lock:
+            self.running += 1
+        try:
+            # hold new jobs while admission control pauses them
+            admission.wait()
+            with self.device_slots(devices):
+                fn(*args)
+        except JobFailed as e:
+            logger.error(f"{self.name} job {repr(key)} failed: {e}")
+        except Exception as e:
+            logger.exception(f"{self.name} job {repr(key)} failed: {repr(e)}")
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.pending.discard(key)
+
+    @contextmanager
+    def device_slots(self, paths: list[str]):
+        """Hold one slot on each device of `paths`. Devices are acquired in a fixed order to avoid
+        deadlocks between jobs.
+        """
+        devices = sorted({os.stat(path).st_dev for path in paths})
+        with ExitStack() as stack:
+            for device in devices:
+                with self.lock:
+                    semaphore = self.device_semaphores.get(device)
+                    if semaphore is None:
+                        semaphore = threading.BoundedSemaphore(self.jobs_per_device)
+                        self.device_semaphores[device] = semaphore
+                semaphore.acquire()
+                stack.callback(semaphore.release)
+            yield
+
+    def is_pending(self, key: str):
+        """Whether a job with the `key` is queued or running."""
+        with self.lock:
+            return key in self.pending
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def queue_depth(self):
+        """Number of jobs waiting for a worker."""
+        with self.lock:
+            return len(self.pending) - self.running
+
+    def shutdown(self):
+        logger.info(f"Waiting for {self.pending_count()} {self.name} jobs to finish")
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,85 @@
+import json
+import sqlite3
+import time
+from typing import Any
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.db import get_connection, transaction
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probe (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns)
+);
+CREATE INDEX IF NOT EXISTS probe_path ON probe (path);
+CREATE INDEX IF NOT EXISTS probe_last_access ON probe (last_access);
+"""
+
+FileIdentity = tuple[int, int, int, int]
+
+
+def _connection():
+    return get_connection("probe_cache", SCHEMA)
+
+
+def get(file_path: str, identity: FileIdentity):
+    """Get the cached ffprobe result of the file version identified by `identity`.
+
+    Returns:
+        dict: The cached metadata.
+        None: Cache miss.
+    """
+    try:
+        conn = _connection()
+        row = conn.execute(
+            "SELECT metadata FROM probe WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+            identity,
+        ).fetchone()
+        if row is None:
+            # The file might have changed since it was last probed
+            conn.execute("DELETE FROM probe WHERE path=?", (file_path,))
+            return
+        conn.execute(
+            "UPDATE probe SET path=?, last_access=? "
+            "WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+            (file_path, time.time(), *identity),
+        )
+    except sqlite3.Error as e:
+        logger.warning(f"Probe cache lookup failed: {repr(e)}")
+        return
+    return json.loads(row[0])
+
+
+def put(file_path: str, identity: FileIdentity, metadata: dict[str, Any]):
+    """Store the ffprobe result of the file version identified by `identity`. Entries of older
+    versions of the same file are dropped, and the least recently used entries are evicted when the
+    cache holds more than PROBE_CACHE_SIZE entries.
+    """
+    dev, ino, _, _ = identity
+    try:
+        conn = _connection()
+        with transaction(conn):
+            conn.execute(
+                "DELETE FROM probe WHERE path=? OR (dev=? AND ino=?)", (file_path, dev, ino)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*identity, file_path, json.dumps(metadata), time.time()),
+            )
+            conn.execute(
+                "DELETE FROM probe WHERE rowid IN "
+                "(SELECT rowid FROM probe ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (Settings.PROBE_CACHE_SIZE,),
+            )
+    except sqlite3.Error as e:
+        logger.warning(f"Probe cache update failed: {repr(e)}")
@@ -0,0 +1,46 @@
+from typing import Iterable
+
+
+def parse_progress(lines: Iterable[str]):
+    """Parse the output of `ffmpeg -progress`, which is made of blocks of key=value lines, each
+    ending with a "progress" key.
+
+    Yields:
+        dict: The fields of each block, e.g. {"out_time_us": "1000000", "total_size": "1024",
+        "speed": "2.5x", "progress": "continue"}.
+    """
+    block: dict[str, str] = {}
+    for line in lines:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        block[key] = value
+        if key == "progress":
+            yield block
+            block = {}
+
+
+def get_out_time(block: dict[str, str]):
+    """Get the position of the output in seconds.
+
+    Returns:
+        float: The output time.
+        None: Not known yet.
+    """
+    try:
+        return int(block["out_time_us"]) / 1e6
+    except (KeyError, ValueError):
+        return
+
+
+def get_total_size(block: dict[str, str]):
+    """Get the number of bytes written to the output.
+
+    Returns:
+        int: The output size.
+        None: Not known yet.
+    """
+    try:
+        return int(block["total_size"])
+    except (KeyError, ValueError):
+        return
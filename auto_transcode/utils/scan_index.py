@@ -0,0 +1,229 @@
+import heapq
+import os
+import time
+
+from auto_transcode.utils.db import get_connection, transaction
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    root TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    path TEXT NOT NULL,
+    parent TEXT,
+    mtime_ns INTEGER,
+    PRIMARY KEY (root, ext, path)
+);
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    path TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (root, ext, path)
+);
+"""
+
+# Directories modified less than this many seconds before being listed are listed again on the
+# next scan, since an entry added within the same mtime tick would not change the mtime
+MTIME_SETTLE_TIME = 2
+
+
+class ScanStats:
+    def __init__(self):
+        self.start_time = time.time()
+        self.duration = 0.0
+        self.dirs_checked = 0
+        self.dirs_listed = 0
+        self.entries_visited = 0
+
+    def finish(self):
+        self.duration = time.time() - self.start_time
+
+    def __repr__(self):
+        return (
+            f"duration={self.duration:.3f}s, dirs_checked={self.dirs_checked}, "
+            f"dirs_listed={self.dirs_listed}, entries_visited={self.entries_visited}"
+        )
+
+
+class ScanIndex:
+    """Persistent index of the files with extension `ext` under `root`, used to find due files
+    without walking the whole tree.
+
+    A scan only lists the directories whose mtime changed since the last scan, and only the files
+    whose deadline passed are stat'ed again, so that growing files are not reported early.
+    """
+
+    def __init__(self, root: str, ext: str):
+        self.root = root
+        self.ext = ext
+        # path -> mtime_ns of the last listing, None if the directory has to be listed again
+        self.dirs: dict[str, int | None] = {}
+        self.subdirs: dict[str, set[str]] = {}
+        self.files: dict[str, float] = {}
+        self.files_by_dir: dict[str, set[str]] = {}
+        self.heap: list[tuple[float, str]] = []
+        self.last_stats: ScanStats | None = None
+        self.load()
+
+    def connection(self):
+        return get_connection("scan_index", SCHEMA)
+
+    def load(self):
+        conn = self.connection()
+        key = (self.root, self.ext)
+        for path, parent, mtime_ns in conn.execute(
+            "SELECT path, parent, mtime_ns FROM dirs WHERE root=? AND ext=?", key
+        ):
+            self.dirs[path] = mtime_ns
+            self.subdirs.setdefault(path, set())
+            if parent is not None:
+                self.subdirs.setdefault(parent, set()).add(path)
+        for path, dir, mtime in conn.execute(
+            "SELECT path, dir, mtime FROM files WHERE root=? AND ext=?", key
+        ):
+            self.files[path] = mtime
+            self.files_by_dir.setdefault(dir, set()).add(path)
+            self.heap.append((mtime, path))
+        heapq.heapify(self.heap)
+
+    def scan(self):
+        """Bring the index up to date with the directory tree.
+
+        Returns:
+            ScanStats: The scan duration and number of entries visited.
+        """
+        stats = ScanStats()
+        dir_updates: list[tuple[str, str | None, int | None]] = []
+        dir_deletes: list[str] = []
+        file_updates: list[tuple[str, str, float]] = []
+        file_deletes: list[str] = []
+
+        stack: list[tuple[str, str | None]] = [(self.root, None)]
+        while stack:
+            dir, parent = stack.pop()
+            try:
+                dir_stat = os.stat(dir)
+            except FileNotFoundError:
+                self.remove_dir(dir, dir_deletes, file_deletes)
+                continue
+            stats.dirs_checked += 1
+
+            if dir in self.dirs and self.dirs[dir] == dir_stat.st_mtime_ns:
+                # No entry was added or removed, only the subdirectories need to be checked
+                stack.extend((subdir, dir) for subdir in self.subdirs.get(dir, ()))
+                continue
+
+            stats.dirs_listed += 1
+            subdirs: set[str] = set()
+            files: dict[str, float] = {}
+            try:
+                with os.scandir(dir) as it:
+                    for entry in it:
+                        stats.entries_visited += 1
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.add(entry.path)
+                        elif os.path.splitext(entry.name)[1] == self.ext:
+                            try:
+                                files[entry.path] = entry.stat().st_mtime
+                            except FileNotFoundError:
+                                continue
+            except FileNotFoundError:
+                self.remove_dir(dir, dir_deletes, file_deletes)
+                continue
+
+            for subdir in self.subdirs.get(dir, set()) - subdirs:
+                self.remove_dir(subdir, dir_deletes, file_deletes)
+            for file_path in self.files_by_dir.get(dir, set()) - files.keys():
+                del self.files[file_path]
+                file_deletes.append(file_path)
+            for file_path, mtime in files.items():
+                if self.files.get(file_path) != mtime:
+                    self.files[file_path] = mtime
+                    heapq.heappush(self.heap, (mtime, file_path))
+                    file_updates.append((file_path, dir, mtime))
+
+            settled = stats.start_time - dir_stat.st_mtime > MTIME_SETTLE_TIME
+            mtime_ns = dir_stat.st_mtime_ns if settled else None
+            self.dirs[dir] = mtime_ns
+            self.subdirs[dir] = subdirs
+            self.files_by_dir[dir] = set(files)
+            dir_updates.append((dir, parent, mtime_ns))
+            stack.extend((subdir, dir) for subdir in subdirs)
+
+        self.save(dir_updates, dir_deletes, file_updates, file_deletes)
+        stats.finish()
+        self.last_stats = stats
+        logger.debug(f"Scanned {repr(self.root)}: {stats}")
+        return stats
+
+    def remove_dir(self, dir: str, dir_deletes: list[str], file_deletes: list[str]):
+        for subdir in self.subdirs.pop(dir, set()):
+            self.remove_dir(subdir, dir_deletes, file_deletes)
+        for file_path in self.files_by_dir.pop(dir, set()):
+            self.files.pop(file_path, None)
+            file_deletes.append(file_path)
+        self.dirs.pop(dir, None)
+        dir_deletes.append(dir)
+
+    def save(
+        self,
+        dir_updates: list[tuple[str, str | None, int | None]],
+        dir_deletes: list[str],
+        file_updates: list[tuple[str, str, float]],
+        file_deletes: list[str],
+    ):
+        if not (dir_updates or dir_deletes or file_updates or file_deletes):
+            return
+        key = (self.root, self.ext)
+        conn = self.connection()
+        with transaction(conn):
+            conn.executemany(
+                "DELETE FROM dirs WHERE root=? AND ext=? AND path=?",
+                ((*key, path) for path in dir_deletes),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                ((*key, *update) for update in dir_updates),
+            )
+            conn.executemany(
+                "DELETE FROM files WHERE root=? AND ext=? AND path=?",
+                ((*key, path) for path in file_deletes),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                ((*key, *update) for update in file_updates),
+            )
+
+    def due_files(self, delay: float):
+        """Get the indexed files whose deadline, `delay` seconds after their last modification,
+        has passed. Only those files are stat'ed again.
+
+        Returns:
+            list: The full paths of the due files.
+        """
+        files_due = []
+        deadline = time.time() - delay
+        while self.heap and self.heap[0][0] < deadline:
+            last_modified, file_path = heapq.heappop(self.heap)
+            if self.files.get(file_path) != last_modified:
+                # stale heap entry
+                continue
+            try:
+                current_modified = os.path.getmtime(file_path)
+            except FileNotFoundError:
+                # picked up by the next listing of its directory
+                continue
+            if current_modified != last_modified:
+                self.files[file_path] = current_modified
+                heapq.heappush(self.heap, (current_modified, file_path))
+                continue
+            files_due.append(file_path)
+
+        for file_path in files_due:
+            heapq.heappush(self.heap, (self.files[file_path], file_path))
+        return files_due
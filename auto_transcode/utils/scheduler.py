@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+
+from auto_transcode.utils.db import get_connection
+from auto_transcode.utils.file import get_video_duration
+from auto_transcode.utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    enqueued_at REAL NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (name, path)
+);
+"""
+
+# Rough bitrate in bits per second of a transcoded recording, used to rank jobs by expected savings
+EXPECTED_BITRATE = 2_000_000
+
+
+class Job:
+    __slots__ = ("path", "enqueued_at", "mtime", "size", "duration")
+
+    def __init__(self, path: str, enqueued_at: float, mtime: float, size: int, duration: float):
+        self.path = path
+        self.enqueued_at = enqueued_at
+        self.mtime = mtime
+        self.size = size
+        self.duration = duration
+
+    @property
+    def room(self):
+        return os.path.basename(self.path).split("_", 1)[0]
+
+    @property
+    def expected_savings(self):
+        return self.size - self.duration * EXPECTED_BITRATE / 8
+
+
+class JobScheduler:
+    """Persistent priority queue of jobs. Jobs stay in the queue until they are done, so that the
+    queue survives a restart without probing the files again.
+
+    Policies:
+    - oldest: The least recently modified file first
+    - smallest: The smallest file first
+    - fair: Round robin over the rooms, the oldest file of each room first
+    - savings: The file with the highest expected savings first
+
+    Regardless of the policy, jobs queued for more than `max_delay` seconds go first.
+    """
+
+    def __init__(self, name: str, policy: str, max_delay: float):
+        self.name = name
+        self.policy = policy
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.jobs: dict[str, Job] = {}
+        self.running: set[str] = set()
+        self.room_last_served: dict[str, float] = {}
+        self.load()
+
+    def connection(self):
+        return get_connection("scheduler", SCHEMA)
+
+    def load(self):
+        for path, *fields in self.connection().execute(
+            "SELECT path, enqueued_at, mtime, size, duration FROM queue WHERE name=?",
+            (self.name,),
+        ):
+            self.jobs[path] = Job(path, *fields)
+        if self.jobs:
+            logger.info(f"Restored {len(self.jobs)} {self.name} jobs")
+
+    def push(self, path: str):
+        """Queue the file unless it is already queued."""
+        with self.lock:
+            if path in self.jobs:
+                return
+        duration = get_video_duration(path)
+        if duration is None:
+            return
+        stat = os.stat(path)
+        job = Job(path, time.time(), stat.st_mtime, stat.st_size, duration)
+        with self.lock:
+            self.jobs[path] = job
+        self.connection().execute(
+            "INSERT OR REPLACE INTO queue VALUES (?, ?, ?, ?, ?, ?)",
+            (self.name, path, job.enqueued_at, job.mtime, job.size, job.duration),
+        )
+
+    def pop(self):
+        """Get the job to run next and mark it running.
+
+        Returns:
+            str: The path of the job.
+            None: No job is waiting.
+        """
+        with self.lock:
+            while True:
+                waiting = [job for path, job in self.jobs.items() if path not in self.running]
+                if not waiting:
+                    return
+                job = self.select(waiting)
+                if not os.path.exists(job.path):
+                    self.remove(job.path)
+                    continue
+                self.running.add(job.path)
+                self.room_last_served[job.room] = time.time()
+                return job.path
+
+    def select(self, waiting: list[Job]):
+        overdue_time = time.time() - self.max_delay
+        overdue = [job for job in waiting if job.enqueued_at < overdue_time]
+        if overdue:
+            return min(overdue, key=lambda job: job.enqueued_at)
+
+        if self.policy == "smallest":
+            return min(waiting, key=lambda job: job.size)
+        if self.policy == "savings":
+            return max(waiting, key=lambda job: job.expected_savings)
+        if self.policy == "fair":
+            return min(waiting, key=lambda job: (self.room_last_served.get(job.room, 0), job.mtime))
+        return min(waiting, key=lambda job: job.mtime)
+
+    def done(self, path: str):
+        """Remove the job from the queue. It is queued again if the watcher finds the file again."""
+        with self.lock:
+            self.remove(path)
+
+    def requeue(self, path: str):
+        """Put the running job back in the queue, e.g. when a remote worker lost it."""
+        with self.lock:
+            self.running.discard(path)
+
+    def remove(self, path: str):
+        self.jobs.pop(path, None)
+        self.running.discard(path)
+        self.connection().execute("DELETE FROM queue WHERE name=? AND path=?", (self.name, path))
+
+    def is_queued(self, path: str):
+        """Whether the file is queued or running."""
+        with self.lock:
+            return path in self.jobs
+
+    def running_count(self):
+        with self.lock:
+            return len(self.running)
+
+    def queue_depth(self):
+        with self.lock:
+            return len(self.jobs) - len(self.running)
@@ -0,0 +1,272 @@
+import heapq
+import os
+import time
+
+from auto_transcode.settings import Settings
+from auto_transcode.utils.inotify import (
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_DELETE_SELF,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MOVE_SELF,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    IN_ONLYDIR,
+    IN_Q_OVERFLOW,
+    Inotify,
+)
+from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.scan_index import ScanIndex
+
+
+logger = get_logger(__name__)
+
+# Filesystems on which inotify does not report changes made by other hosts
+NETWORK_FILESYSTEMS = {
+    "9p",
+    "afs",
+    "ceph",
+    "cifs",
+    "fuse.glusterfs",
+    "fuse.rclone",
+    "fuse.sshfs",
+    "glusterfs",
+    "nfs",
+    "nfs4",
+    "smb3",
+    "smbfs",
+}
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_ONLYDIR
+)
+
+
+class PollingWatcher:
+    """Find the files that are due by polling the directory tree. A persistent scan index is used,
+    so that only the directories that changed since the last poll are listed again.
+    """
+
+    def __init__(self, dir: str, ext: str):
+        self.dir = dir
+        self.ext = ext
+        self.index = ScanIndex(dir, ext)
+        # number of entries visited by the last call of due_files
+        self.last_visited = 0
+
+    def due_files(self, delay: float):
+        """Get the files that have not been modified for `delay` seconds.
+
+        Returns:
+            list: The full paths of the due files.
+        """
+        stats = self.index.scan()
+        self.last_visited = stats.entries_visited
+        return self.index.due_files(delay)
+
+    def files(self):
+        """Get the files found by the last scan, due or not."""
+        return list(self.index.files)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Keep the candidate files and their modification times in memory, updated by inotify events.
+    The directory tree is only walked once, or again when the kernel event queue overflows.
+    """
+
+    def __init__(self, dir: str, ext: str):
+        self.dir = dir
+        self.ext = ext
+        self.inotify = Inotify()
+        self.wd_to_dir: dict[int, str] = {}
+        self.candidates: dict[str, float] = {}
+        # files created since the tree was walked and not closed yet, e.g. live recordings. They
+        # only become candidates once closed.
+        self.growing: set[str] = set()
+        self.heap: list[tuple[float, str]] = []
+        # number of candidates checked by the last call of due_files
+        self.last_visited = 0
+        try:
+            self.rescan()
+        except OSError:
+            self.inotify.close()
+            raise
+
+    def rescan(self):
+        for wd in self.wd_to_dir:
+            self.inotify.rm_watch(wd)
+        self.wd_to_dir.clear()
+        self.candidates.clear()
+        self.growing.clear()
+        self.heap.clear()
+        self.add_tree(self.dir)
+
+    def add_tree(self, dir: str):
+        """Watch `dir` and its subdirectories and add their files to the candidates. Watches are
+        added before listing, so that files created in between are not missed.
+        """
+        for root, subdirs, files in os.walk(dir):
+            try:
+                wd = self.inotify.add_watch(root, WATCH_MASK)
+            except FileNotFoundError:
+                subdirs.clear()
+                continue
+            self.wd_to_dir[wd] = root
+            for file in files:
+                self.add_file(os.path.join(root, file))
+
+    def remove_tree(self, dir: str):
+        prefix = os.path.join(dir, "")
+        for wd, path in list(self.wd_to_dir.items()):
+            if path == dir or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.wd_to_dir[wd]
+        for path in list(self.candidates):
+            if path.startswith(prefix):
+                del self.candidates[path]
+        self.growing = {path for path in self.growing if not path.startswith(prefix)}
+
+    def add_file(self, file_path: str):
+        if os.path.splitext(file_path)[1] != self.ext:
+            return
+        try:
+            last_modified = os.path.getmtime(file_path)
+        except FileNotFoundError:
+            self.candidates.pop(file_path, None)
+            return
+        if self.candidates.get(file_path) != last_modified:
+            self.candidates[file_path] = last_modified
+            heapq.heappush(self.heap, (last_modified, file_path))
+
+    def process_events(self):
+        for wd, mask, _, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                logger.warning(f"Inotify event queue overflowed, rescanning {repr(self.dir)}")
+                self.rescan()
+                return
+            if mask & IN_IGNORED:
+                self.wd_to_dir.pop(wd, None)
+                continue
+            dir = self.wd_to_dir.get(wd)
+            if dir is None or not name:
+                continue
+            path = os.path.join(dir, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    self.remove_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.growing.discard(path)
+                self.add_file(path)
+            elif mask & IN_CREATE:
+                if os.path.splitext(path)[1] == self.ext:
+                    self.growing.add(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.growing.discard(path)
+                self.candidates.pop(path, None)
+
+    def due_files(self, delay: float):
+        """Get the files that have not been modified for `delay` seconds. Due files stay
+        candidates until they are deleted or moved away, the same as with polling.
+
+        Returns:
+            list: The full paths of the due files.
+        """
+        self.process_events()
+
+        files_due = []
+        deadline = time.time() - delay
+        self.last_visited = 0
+        while self.heap and self.heap[0][0] < deadline:
+            last_modified, file_path = heapq.heappop(self.heap)
+            self.last_visited += 1
+            if self.candidates.get(file_path) != last_modified:
+                # stale heap entry
+                continue
+            # the file may have been written to without being closed since it was added
+            try:
+                current_modified = os.path.getmtime(file_path)
+            except FileNotFoundError:
+                del self.candidates[file_path]
+                continue
+            if current_modified != last_modified:
+                self.candidates[file_path] = current_modified
+                heapq.heappush(self.heap, (current_modified, file_path))
+                continue
+            files_due.append(file_path)
+
+        for file_path in files_due:
+            heapq.heappush(self.heap, (self.candidates[file_path], file_path))
+        return files_due
+
+    def files(self):
+        """Get the candidate files, due or not, and the files still being written."""
+        return [*self.candidates, *self.growing]
+
+    def close(self):
+        self.inotify.close()
+
+
+def get_filesystem_type(path: str):
+    """Get the filesystem type of the mount containing `path` from /proc/mounts.
+
+    Returns:
+        str: The filesystem type, e.g. "ext4".
+        None: The mount table is not available.
+    """
+    path = os.path.realpath(path)
+    best_mount, best_type = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # spaces in mount points are escaped as \040
+                mount_point = fields[1].replace("\\040", " ")
+                if os.path.commonpath([path, mount_point]) != mount_point:
+                    continue
+                if len(mount_point) >= len(best_mount):
+                    best_mount, best_type = mount_point, fields[2]
+    except OSError:
+        return
+    return best_type
+
+
+def create_watcher(dir: str, ext: str):
+    """Create the watcher backend for `dir` according to WATCHER_BACKEND. With "auto", inotify is
+    used unless it is unavailable or `dir` is on a network filesystem.
+    """
+    backend = Settings.WATCHER_BACKEND
+    if backend == "auto":
+        fs_type = get_filesystem_type(dir)
+        if fs_type in NETWORK_FILESYSTEMS:
+            logger.info(f"{repr(dir)} is on a {fs_type} filesystem, using polling")
+            backend = "polling"
+        else:
+            backend = "inotify"
+
+    if backend == "inotify":
+        try:
+            watcher = InotifyWatcher(dir, ext)
+        except OSError as e:
+            logger.warning(f"Failed to watch {repr(dir)} with inotify, using polling: {repr(e)}")
+        else:
+            logger.info(f"Watching {repr(dir)} with inotify")
+            return watcher
+
+    logger.info(f"Watching {repr(dir)} with polling")
+    return PollingWatcher(dir, ext)
@@ -0,0 +1,306 @@
+"""Remote transcode worker. Leases transcode jobs from a coordinator running with
+REMOTE_WORKERS=true, transcodes them locally and uploads the results.
+
+Usage:
+    python -m auto_transcode.worker --coordinator http://nas:8000 --work-dir /ssd/work \\
+        --shared-dir /mnt/nas/remux
+
+The encoder settings are read from the environment like on the coordinator. With --shared-dir,
+sources are read from a mount of the REMUX_DIR of the coordinator instead of being downloaded.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from auto_transcode.modules.transcode import TranscodeProcess
+from auto_transcode.settings import Settings
+from auto_transcode.utils.encoder import get_encoder
+from auto_transcode.utils.engine import engine
+from auto_transcode.utils.estimate import CompressionAborted, estimate_compression
+from auto_transcode.utils.jobs import JobStatus, registry
+from auto_transcode.utils.logger import get_logger
+from auto_transcode.utils.media_info import probe_media
+
+
+logger = get_logger(__name__)
+
+# Settings used by the worker, the other ones only matter on the coordinator
+WORKER_SETTINGS = [
+    "FFMPEG_PROCESSES",
+    "TRANSCODE_TIMEOUT",
+    "CHUNKED_TRANSCODE",
+    "CHUNK_DURATION",
+    "CHUNK_WORKERS",
+    "ENCODER",
+    "ENCODER_THREADS",
+    "NVENC_CQ",
+    "NVENC_PRESET",
+    "SVTAV1_CRF",
+    "SVTAV1_PRESET",
+    "AOM_CRF",
+    "AOM_CPU_USED",
+    "ESTIMATE_SAMPLES",
+    "ESTIMATE_SAMPLE_DURATION",
+    "SKIP_COMPRESSION_RATE",
+    "ABORT_COMPRESSION_RATE",
+    "WATCHDOG_MIN_PROGRESS",
+]
+# Seconds to wait before asking for a job again when none is waiting or the coordinator is down
+POLL_INTERVAL = 30
+# Attempts to download a source, each resuming where the previous one stopped
+DOWNLOAD_ATTEMPTS = 5
+# Size in bytes of the chunks of the downloads
+CHUNK_SIZE = 1024 * 1024
+# Errors of a request to the coordinator, including dropped connections
+REQUEST_ERRORS = (OSError, http.client.HTTPException)
+
+
+class LeaseExpired(Exception):
+    """Raised when the coordinator gave the job of the lease to another worker."""
+
+
+class RemoteWorker:
+    def __init__(
+        self, coordinator: str, name: str, work_dir: str, shared_dir: str | None, token: str
+    ):
+        self.coordinator = coordinator.rstrip("/")
+        self.name = name
+        self.work_dir = work_dir
+        self.shared_dir = shared_dir
+        self.token = token
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        data=None,
+        headers: dict[str, str] | None = None,
+        timeout: float = 60,
+    ):
+        """Send a request to the coordinator.
+
+        Raises:
+            LeaseExpired: The lease expired.
+            OSError, http.client.HTTPException: The request failed, see REQUEST_ERRORS.
+        """
+        headers = dict(headers or {})
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        request = urllib.request.Request(
+            f"{self.coordinator}{path}", data=data, headers=headers, method=method
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 410:
+                raise LeaseExpired(path)
+            raise
+
+    def request_json(self, method: str, path: str, body=None):
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        with self.request(method, path, data, headers) as response:
+            if response.status == 204:
+                return
+            return json.load(response)
+
+    def run(self):
+        os.makedirs(self.work_dir, exist_ok=True)
+        backend = get_encoder()
+        logger.info(
+            f"Worker {repr(self.name)} transcoding with {backend.name} for {self.coordinator}"
+        )
+        while True:
+            try:
+                lease = self.request_json("POST", f"/leases?worker={self.name}")
+            except REQUEST_ERRORS as e:
+                logger.warning(f"Failed to lease a job from {self.coordinator}: {e}")
+                lease = None
+            if lease is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            self.process(lease)
+
+    def process(self, lease: dict):
+        """Transcode the source of the lease and upload the result, or give the job up."""
+        basename, _ = os.path.splitext(os.path.basename(lease["name"]))
+        logger.info(f"Leased {repr(lease['name'])}, lease {lease['id']}")
+        work_paths = [
+            os.path.join(self.work_dir, f"{basename}.source.mp4"),
+            os.path.join(self.work_dir, f"{basename}.source.mp4.part"),
+            os.path.join(self.work_dir, f"{basename}.mp4"),
+        ]
+        stop = threading.Event()
+        expired = threading.Event()
+        try:
+            with registry.track("transcode", lease["name"]) as status:
+                heartbeat = threading.Thread(
+                    target=self.heartbeat,
+                    args=(lease, status, stop, expired),
+                    name="Heartbeat",
+                    daemon=True,
+                )
+                heartbeat.start()
+                try:
+                    self.handle(lease, basename, expired)
+                finally:
+                    stop.set()
+                    heartbeat.join()
+        except LeaseExpired:
+            logger.warning(f"Lease of {repr(lease['name'])} expired, dropped the job")
+        except Exception as e:
+            reason = repr(e)
+            if expired.is_set():
+                logger.warning(f"Lease of {repr(lease['name'])} expired, dropped the job")
+            else:
+                logger.exception(f"Failed to transcode {repr(lease['name'])}")
+                try:
+                    query = urllib.parse.urlencode({"reason": reason})
+                    self.request("DELETE", f"/leases/{lease['id']}?{query}").close()
+                except (LeaseExpired, *REQUEST_ERRORS):
+                    pass
+        finally:
+            for path in work_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def handle(self, lease: dict, basename: str, expired: threading.Event):
+        registry.set_stage("downloading")
+        source_path = self.fetch(lease, os.path.join(self.work_dir, f"{basename}.source.mp4"))
+        source_info = probe_media(source_path)
+        if source_info is None:
+            raise RuntimeError(f"Mp4 is invalid: {repr(source_path)}")
+
+        backend = get_encoder()
+        estimate = estimate_compression(source_path, source_info.duration, backend)
+        if estimate is not None and estimate.compression_rate >= Settings.SKIP_COMPRESSION_RATE:
+            logger.warning(
+                f"Skipped transcoding {repr(lease['name'])}: estimated compression rate "
+                f"{estimate.compression_rate * 100:.0f}%"
+            )
+            self.request("POST", f"/leases/{lease['id']}/skip", timeout=600).close()
+            return
+
+        target_path = os.path.join(self.work_dir, f"{basename}.mp4")
+        registry.set_stage("transcoding", source_info.duration)
+        try:
+            TranscodeProcess.transcode(source_path, target_path, backend, source_info.duration)
+        except CompressionAborted as e:
+            logger.warning(f"Stopped transcoding {repr(lease['name'])}: {e}")
+            self.request("POST", f"/leases/{lease['id']}/skip", timeout=600).close()
+            return
+        if expired.is_set():
+            raise LeaseExpired(lease["id"])
+
+        registry.set_stage("validating")
+        if not TranscodeProcess.validate_video(target_path, source_info, backend=backend):
+            raise RuntimeError(f"Failed to transcode {repr(lease['name'])}")
+
+        registry.set_stage("uploading")
+        with open(target_path, "rb") as f:
+            self.request(
+                "PUT",
+                f"/leases/{lease['id']}/result?encoder={backend.name}",
+                data=f,
+                headers={
+                    "Content-Length": str(os.path.getsize(target_path)),
+                    "Content-Type": "video/mp4",
+                },
+                timeout=600,
+            ).close()
+        logger.info(f"Uploaded {repr(lease['name'])} transcoded with {backend.name}")
+
+    def fetch(self, lease: dict, to_path: str):
+        """Get the source of the lease, from the shared directory if it has it, otherwise by
+        downloading it, resuming with range requests after a connection error.
+
+        Returns:
+            str: The path of the source.
+        """
+        if self.shared_dir is not None:
+            path = os.path.join(self.shared_dir, lease["name"])
+            if os.path.exists(path) and os.path.getsize(path) == lease["size"]:
+                return path
+
+        part_path = f"{to_path}.part"
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset >= lease["size"]:
+                break
+            try:
+                with (
+                    self.request(
+                        "GET",
+                        f"/leases/{lease['id']}/source",
+                        headers={"Range": f"bytes={offset}-"},
+                    ) as response,
+                    open(part_path, "ab" if response.status == 206 else "wb") as f,
+                ):
+                    shutil.copyfileobj(response, f, CHUNK_SIZE)
+            except REQUEST_ERRORS as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                logger.warning(f"Download of {repr(lease['name'])} interrupted, resuming: {e}")
+        if os.path.getsize(part_path) != lease["size"]:
+            raise RuntimeError(f"Incomplete download of {repr(lease['name'])}")
+        os.replace(part_path, to_path)
+        return to_path
+
+    def heartbeat(
+        self, lease: dict, status: JobStatus, stop: threading.Event, expired: threading.Event
+    ):
+        """Renew the lease with the progress of the job until `stop` is set. Cancel the encode if
+        the lease expired.
+        """
+        while not stop.wait(lease["lease_time"] / 3):
+            job = status.to_dict()
+            progress = {key: job[key] for key in ("out_time", "fps", "speed", "total_size")}
+            try:
+                self.request_json("POST", f"/leases/{lease['id']}/heartbeat", progress)
+            except LeaseExpired:
+                expired.set()
+                for ffmpeg_job in list(engine.jobs.values()):
+                    if ffmpeg_job.status is status:
+                        engine.cancel(ffmpeg_job.id)
+                return
+            except REQUEST_ERRORS as e:
+                logger.warning(f"Heartbeat of {repr(lease['name'])} failed: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcode the jobs leased from a coordinator")
+    parser.add_argument("--coordinator", required=True, help="URL of the coordinator")
+    parser.add_argument(
+        "--name", default=f"{socket.gethostname()}-{os.getpid()}", help="Name of the worker"
+    )
+    parser.add_argument("--work-dir", required=True, help="Directory of the sources and results")
+    parser.add_argument("--shared-dir", help="Mount of the REMUX_DIR of the coordinator")
+    parser.add_argument(
+        "--token", default=os.getenv("WORKER_TOKEN", ""), help="WORKER_TOKEN of the coordinator"
+    )
+    args = parser.parse_args()
+
+    Settings.init(names=WORKER_SETTINGS)
+    Settings.CACHE_DIRS = [args.work_dir]
+    Settings.CACHE_DIR = args.work_dir
+    worker = RemoteWorker(args.coordinator, args.name, args.work_dir, args.shared_dir, args.token)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
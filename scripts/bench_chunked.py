@@ -0,0 +1,74 @@
+# bench_chunked.py
+"""Measure the throughput of the chunked software transcode with 1, 2, 4 and 8 workers.
+
+Usage:
+    USE_DEV_SETTINGS=true python scripts/bench_chunked.py --duration 600 --encoder libsvtav1
+
+Without --source, a test video of the given duration is generated with the lavfi test source.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import ffmpeg
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from auto_transcode.settings import Settings  # noqa: E402
+from auto_transcode.utils.chunked import chunked_transcode  # noqa: E402
+from auto_transcode.utils.encoder import ENCODERS  # noqa: E402
+
+
+def make_source(path: str, duration: float, size: str, fps: int):
+    video = ffmpeg.input(f"testsrc2=size={size}:rate={fps}", f="lavfi", t=duration)
+    audio = ffmpeg.input("sine", f="lavfi", t=duration)
+    ffmpeg.output(video, audio, path, vcodec="libx264", g=fps * 2, acodec="aac").run(
+        overwrite_output=True, capture_stdout=True, capture_stderr=True
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--source", help="video to transcode")
+    parser.add_argument("--duration", type=float, default=300, help="generated video duration")
+    parser.add_argument("--size", default="1920x1080", help="generated video size")
+    parser.add_argument("--fps", type=int, default=30, help="generated video frame rate")
+    parser.add_argument("--encoder", default="libsvtav1", choices=["libsvtav1", "libaom-av1"])
+    parser.add_argument("--chunk-duration", type=float, default=60)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        Settings.CACHE_DIR = tmp
+        Settings.CACHE_DIRS = [tmp]
+        Settings.CHUNK_DURATION = args.chunk_duration
+
+        source_path = args.source
+        duration = args.duration
+        if source_path is None:
+            source_path = os.path.join(tmp, "source.mp4")
+            make_source(source_path, args.duration, args.size, args.fps)
+        else:
+            duration = float(ffmpeg.probe(source_path)["format"]["duration"])
+
+        backend = ENCODERS[args.encoder]
+
+        print(f"{'workers':>8}{'time s':>10}{'realtime x':>12}")
+        for workers in args.workers:
+            Settings.CHUNK_WORKERS = workers
+            target_path = os.path.join(tmp, f"target_{workers}.mp4")
+            start = time.perf_counter()
+            chunked_transcode(source_path, target_path, backend)
+            elapsed = time.perf_counter() - start
+            if not os.path.exists(target_path):
+                print(f"{workers:>8}{'failed':>10}")
+                continue
+            print(f"{workers:>8}{elapsed:>10.1f}{duration / elapsed:>12.2f}")
+            os.remove(target_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# bench_move.py
+"""Compare the bytes copied and time spent moving files through the pipeline directories, between
+the legacy copy-then-remove move and `move_file`.
+
+Usage:
+    USE_DEV_SETTINGS=true python scripts/bench_move.py --size 1000 --cache /ssd/cache \\
+        --remux /hdd/remux --save /hdd/save
+
+Without directories, temporary directories on the same filesystem are used.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from auto_transcode.utils.file import move_file  # noqa: E402
+
+
+def legacy_move(from_path: str, to_path: str):
+    shutil.copyfile(from_path, to_path)
+    os.remove(from_path)
+    return to_path, os.path.getsize(to_path)
+
+
+def make_file(path: str, size: int):
+    chunk = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size // len(chunk)):
+            f.write(chunk)
+
+
+def run_pipeline(mover, cache_dir: str, dest_dir: str, size: int):
+    src = os.path.join(cache_dir, "bench.mp4")
+    make_file(src, size)
+    start = time.perf_counter()
+    final_path, bytes_copied = mover(src, os.path.join(dest_dir, "bench.mp4"))
+    elapsed = time.perf_counter() - start
+    os.remove(final_path)
+    return bytes_copied, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=512, help="file size in MB")
+    parser.add_argument("--cache", help="cache directory")
+    parser.add_argument("--remux", help="remux directory")
+    parser.add_argument("--save", help="save directory")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dirs = {}
+        for name in ["cache", "remux", "save"]:
+            dirs[name] = getattr(args, name) or os.path.join(tmp, name)
+            os.makedirs(dirs[name], exist_ok=True)
+
+        size = args.size * 1024 * 1024
+        pipelines = [("cache -> remux", "remux"), ("cache -> save", "save")]
+        print(f"{'pipeline':<16}{'mover':<10}{'copied MB':>12}{'time s':>10}")
+        for label, dest in pipelines:
+            for mover_name, mover in [("legacy", legacy_move), ("move_file", move_file)]:
+                bytes_copied, elapsed = run_pipeline(mover, dirs["cache"], dirs[dest], size)
+                print(f"{label:<16}{mover_name:<10}{bytes_copied / 1e6:>12.0f}{elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# bench_probe.py
+"""Compare the probes per second of the native flv and mp4 header parsers against ffmpeg.probe.
+
+Usage:
+    USE_DEV_SETTINGS=true python scripts/bench_probe.py --iterations 200 video.flv video.mp4
+
+Without files, a short flv and mp4 are generated with the lavfi test source.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import ffmpeg
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from auto_transcode.utils.native_probe import native_probe  # noqa: E402
+
+
+def make_sources(dir: str):
+    video = ffmpeg.input("testsrc2=size=1280x720:rate=30", f="lavfi", t=10)
+    audio = ffmpeg.input("sine", f="lavfi", t=10)
+    paths = []
+    for ext in ("flv", "mp4"):
+        path = os.path.join(dir, f"source.{ext}")
+        ffmpeg.output(
+            video, audio, path, vcodec="libx264", acodec="aac", metadata="comment=bench"
+        ).run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
+        paths.append(path)
+    return paths
+
+
+def bench(probe, path: str, iterations: int):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        probe(path)
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("files", nargs="*", help="videos to probe")
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.files or make_sources(tmp)
+
+        print(f"{'file':<30}{'native/s':>12}{'ffprobe/s':>12}{'speedup':>10}")
+        for path in paths:
+            name = os.path.basename(path)
+            if native_probe(path) is None:
+                print(f"{name:<30}{'unparsed':>12}")
+                continue
+            native = bench(native_probe, path, args.iterations)
+            try:
+                ffprobe = bench(ffmpeg.probe, path, args.iterations)
+            except (ffmpeg.Error, FileNotFoundError):
+                print(f"{name:<30}{native:>12.0f}{'failed':>12}")
+                continue
+            print(f"{name:<30}{native:>12.0f}{ffprobe:>12.0f}{native / ffprobe:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()